@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+
+from pathlib import Path
+
+from learner.benchmark import BENCHMARK_SUITE, run_benchmark, compare_with_baseline, print_comparison
+from learner.src.iteration import EncodingType
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the sketch learner over fixed subsets of the tractable domains.")
+    parser.add_argument("--workspace", type=Path, required=True, help="The directory containing intermediate files.")
+    parser.add_argument("--benchmarks_directory", type=Path, default=Path(__file__).resolve().parent / "benchmarks" / "tractable", help="The directory containing the tractable domains.")
+    parser.add_argument("--domains", nargs='*', default=None, choices=sorted(BENCHMARK_SUITE.keys()), help="The domains to run. Default is all domains of the suite.")
+    parser.add_argument("--num_workers", type=int, default=1, help="The number of worker processes used for preprocessing and verification.")
+    parser.add_argument("--encoding_type", type=EncodingType, default=EncodingType.D2, choices=[EncodingType.D2, EncodingType.EXPLICIT], help="The encoding type of the complete pipeline runs.")
+    parser.add_argument("--num_repetitions", type=int, default=1, help="The number of repetitions, times are the minimum over all repetitions.")
+    parser.add_argument("--output", type=Path, default=None, help="The file to write the results to. Default is results.json in the workspace.")
+    parser.add_argument("--baseline", type=Path, default=None, help="The results of a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="The relative slowdown or memory increase over the baseline that is tolerated. Default is 0.2.")
+    parser.add_argument("--min_time_delta_sec", type=float, default=0.5, help="The absolute slowdown in seconds over the baseline that is always tolerated. Default is 0.5.")
+    parser.add_argument("--counter_tolerance", type=float, default=0.0, help="The relative deviation of counters from the baseline that is tolerated. Default is 0.0.")
+
+    args = parser.parse_args()
+
+    workspace = args.workspace.resolve()
+    output = args.output.resolve() if args.output is not None else workspace / "results.json"
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_benchmark(args.benchmarks_directory.resolve(), workspace, args.domains, args.num_workers, args.num_repetitions, args.encoding_type)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to:", output)
+
+    if baseline is not None:
+        print_comparison(results, baseline)
+        regressions = compare_with_baseline(results, baseline, args.tolerance, args.min_time_delta_sec, args.counter_tolerance)
+        for domain, name, metric, baseline_value, value in regressions:
+            print(f"Regression in {domain} {name} {metric}: {baseline_value} -> {value}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions.")
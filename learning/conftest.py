@@ -0,0 +1 @@
+# Makes the learner package importable when running pytest from this directory, e.g., python -m pytest tests.
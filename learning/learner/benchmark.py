@@ -0,0 +1,211 @@
+import json
+import logging
+import shutil
+import subprocess
+import sys
+import time
+
+from pathlib import Path
+from termcolor import colored
+from typing import List, Dict, Tuple
+
+import numpy as np
+
+from .learner import compute_preprocessing_data, compute_iteration_equivalences, add_initial_facts, ground_and_solve
+from .src.iteration import EncodingType, ASPFactory, IterationData, compute_feature_pool
+from .src.util import profiler, create_experiment_workspace, change_working_directory, add_console_handler, print_separation_line
+
+
+# Fixed small subsets of the tractable training instances such that the suite runs in minutes on a single machine.
+# Maps a domain to the width and the problem filenames in training/easy.
+BENCHMARK_SUITE: Dict[str, Tuple[int, List[str]]] = {
+    "blocks_4_clear": (1, ["p-2-0.pddl", "p-3-0.pddl", "p-4-0.pddl"]),
+    "childsnack": (1, ["p-1-1.0-0.0-1-1.pddl", "p-1-1.0-0.0-1-2.pddl"]),
+    "delivery": (1, ["instance_1_1_1_0.pddl", "instance_2_1_1_0.pddl", "instance_2_2_1_0.pddl"]),
+    "gripper": (1, ["p-1-0.pddl", "p-2-0.pddl", "p-3-0.pddl"]),
+    "miconic": (0, ["p-2-1-0.pddl", "p-2-1-1.pddl", "p-3-1-0.pddl"]),
+    "spanner": (1, ["p-1-1-1-0.pddl", "p-2-1-1-0.pddl", "p-1-2-2-0.pddl"]),
+    "visitall": (0, ["p-1-0.5-2-0.pddl", "p-1-0.5-3-0.pddl", "p-2-0.5-2-0.pddl"]),
+}
+
+# Metrics of stages that are compared against the baseline.
+# The peak RSS of a stage is only compared if it was measured per stage, see Profiler.
+STAGE_METRICS = ["wall_time_sec", "peak_rss_mib"]
+
+
+def _summarize_profile(report: Dict) -> Tuple[Dict[str, Dict[str, float]], Dict[str, int]]:
+    """ Sum stages and counters of a profile report over all iterations. """
+    stages: Dict[str, Dict] = dict()
+    for record in report["stages"]:
+        summary = stages.setdefault(record["stage"], {"wall_time_sec": 0.0, "cpu_time_sec": 0.0, "peak_rss_mib": 0.0, "peak_rss_scope": "stage"})
+        summary["wall_time_sec"] += record["wall_time_sec"]
+        summary["cpu_time_sec"] += record["cpu_time_sec"]
+        summary["peak_rss_mib"] = max(summary["peak_rss_mib"], record["peak_rss_mib"])
+        if record.get("peak_rss_scope", "process") != "stage":
+            summary["peak_rss_scope"] = "process"
+    counters: Dict[str, int] = dict()
+    for record in report["counters"]:
+        counters[record["counter"]] = counters.get(record["counter"], 0) + record["value"]
+    counters["num_iterations"] = len(set(record["iteration"] for record in report["stages"] if record["iteration"] is not None))
+    return stages, counters
+
+
+def run_stages_in_isolation(domain_filepath: Path, instance_filepaths: List[Path], workspace: Path, width: int, num_workers: int = 1):
+    """ Run each stage of a single learning iteration once over all given instances.
+
+    In contrast to the learning loop, no instances are selected and no D2-separation constraints are added,
+    such that each stage processes the same data in every run.
+    The stages are the same functions that the learner runs, see learn_sketch_for_problem_class.
+    """
+    profiler.reset()
+    create_experiment_workspace(workspace)
+    change_working_directory(workspace)
+
+    preprocessing_data, _, _ = compute_preprocessing_data(domain_filepath, instance_filepaths, width, False, 10000, 10000, False, None, num_workers)
+
+    iteration_data = IterationData()
+    iteration_data.instance_datas = preprocessing_data.instance_datas
+    iteration_data.gfa_states = list(set(gfa_state for instance_data in preprocessing_data.instance_datas for gfa_state in instance_data.gfa.get_states()))
+    iteration_data.feature_pool = compute_feature_pool(preprocessing_data, iteration_data, preprocessing_data.gfa_state_global_idx_to_tuple_graph, preprocessing_data.state_finder, False, False, 9, 9, 9, 9, 9, 1000000, [], [])
+    compute_iteration_equivalences(preprocessing_data, iteration_data, False)
+
+    asp_factory = ASPFactory(EncodingType.D2, False, 4, 1, "split", None, None)
+    d2_facts = add_initial_facts(asp_factory, preprocessing_data, iteration_data)
+    profiler.count("num_d2_facts", len(d2_facts))
+    ground_and_solve(asp_factory, list(d2_facts))
+
+    return profiler.to_dict()
+
+
+def run_pipeline(domain_filepath: Path, problems_directory: Path, workspace: Path, width: int, num_workers: int = 1, encoding_type: EncodingType = EncodingType.D2):
+    """ Run the complete learner in a separate process and return its profile report, wall time, and learned sketch. """
+    main_filepath = Path(__file__).resolve().parent.parent / "main.py"
+    start = time.perf_counter()
+    with open(workspace.parent / f"{workspace.name}.log", "w") as log_file:
+        subprocess.run([
+            sys.executable, str(main_filepath),
+            "--domain_filepath", str(domain_filepath),
+            "--problems_directory", str(problems_directory),
+            "--workspace", str(workspace),
+            "--width", str(width),
+            "--num_workers", str(num_workers),
+            "--encoding_type", encoding_type.value,
+            "--asp_num_threads", "1",
+            "--disable_cache"],
+            stdout=log_file, stderr=subprocess.STDOUT, check=True)
+    wall_time_sec = time.perf_counter() - start
+    with open(workspace / "output" / "profile.json") as f:
+        report = json.load(f)
+    with open(workspace / "output" / f"sketch_{width}.txt") as f:
+        sketch = f.read()
+    return report, wall_time_sec, sketch
+
+
+def run_benchmark(benchmarks_directory: Path, workspace: Path, domains: List[str] = None, num_workers: int = 1, num_repetitions: int = 1, encoding_type: EncodingType = EncodingType.D2):
+    """ Run the stages in isolation and the complete pipeline for each domain of the suite.
+
+    Times are the minimum and memory, counters and the sketch are the values of the last of all repetitions.
+    The peak RSS of the whole pipeline run is reported separately from the stages.
+    """
+    add_console_handler(logging.getLogger(), logging.INFO)
+    if domains is None:
+        domains = sorted(BENCHMARK_SUITE.keys())
+    results = dict()
+    for domain in domains:
+        width, problem_filenames = BENCHMARK_SUITE[domain]
+        domain_directory = benchmarks_directory / domain
+        domain_workspace = workspace / domain
+        # The learner expects a directory with the problems, so we link the subset into the workspace.
+        # Links of an earlier run into the same workspace are removed, since the suite might have changed.
+        problems_directory = domain_workspace / "problems"
+        shutil.rmtree(problems_directory, ignore_errors=True)
+        create_experiment_workspace(problems_directory)
+        for problem_filename in problem_filenames:
+            (problems_directory / problem_filename).symlink_to(domain_directory / "training" / "easy" / problem_filename)
+        instance_filepaths = sorted(problems_directory.iterdir())
+
+        stages: Dict[str, Dict] = dict()
+        counters: Dict[str, int] = dict()
+        peak_rss_mib = 0.0
+        for repetition in range(num_repetitions):
+            logging.info(colored(f"Benchmark: {domain} width {width} repetition {repetition}", "red", "on_grey"))
+            repetition_stages: Dict[str, Dict] = dict()
+            isolated_stages, isolated_counters = _summarize_profile(run_stages_in_isolation(domain_directory / "domain.pddl", instance_filepaths, domain_workspace / f"isolated_{repetition}", width, num_workers))
+            for name, summary in isolated_stages.items():
+                repetition_stages[f"isolated/{name}"] = summary
+            for name, value in isolated_counters.items():
+                counters[f"isolated/{name}"] = value
+            report, wall_time_sec, sketch = run_pipeline(domain_directory / "domain.pddl", problems_directory, domain_workspace / f"pipeline_{repetition}", width, num_workers, encoding_type)
+            pipeline_stages, pipeline_counters = _summarize_profile(report)
+            for name, summary in pipeline_stages.items():
+                repetition_stages[f"pipeline/{name}"] = summary
+            # The peak RSS of the subprocess is not a per stage measurement, hence, it is only kept as the peak of the run.
+            repetition_stages["pipeline/total"] = {"wall_time_sec": wall_time_sec, "cpu_time_sec": 0.0, "peak_rss_mib": report["peak_rss_mib"], "peak_rss_scope": "process"}
+            peak_rss_mib = report["peak_rss_mib"]
+            for name, value in pipeline_counters.items():
+                counters[f"pipeline/{name}"] = value
+
+            for name, summary in repetition_stages.items():
+                if name not in stages:
+                    stages[name] = summary
+                else:
+                    stages[name]["wall_time_sec"] = min(stages[name]["wall_time_sec"], summary["wall_time_sec"])
+                    stages[name]["cpu_time_sec"] = min(stages[name]["cpu_time_sec"], summary["cpu_time_sec"])
+                    stages[name]["peak_rss_mib"] = summary["peak_rss_mib"]
+                    stages[name]["peak_rss_scope"] = summary["peak_rss_scope"]
+        results[domain] = {"width": width, "problems": problem_filenames, "stages": stages, "counters": counters, "peak_rss_mib": peak_rss_mib, "sketch": sketch}
+    return results
+
+
+def compare_with_baseline(results: Dict, baseline: Dict, tolerance: float, min_time_delta_sec: float, counter_tolerance: float):
+    """ Return the regressions of results with respect to the baseline.
+
+    A metric regresses if it exceeds the baseline by more than the relative tolerance,
+    times additionally by more than min_time_delta_sec to ignore noise in fast stages.
+    The peak RSS of a stage is only compared if it was measured per stage in both results,
+    the peak RSS of the whole pipeline run is compared under the name pipeline/run.
+    A counter regresses if it deviates from the baseline by more than the relative counter tolerance.
+    The learned sketch regresses if it differs from the sketch of the baseline, since the pipeline runs with a single solver thread.
+    """
+    regressions = []
+    for domain, result in results.items():
+        if domain not in baseline:
+            logging.warning(f"No baseline for domain {domain}.")
+            continue
+        baseline_result = baseline[domain]
+        for name, summary in result["stages"].items():
+            baseline_summary = baseline_result["stages"].get(name)
+            if baseline_summary is None:
+                continue
+            for metric in STAGE_METRICS:
+                if metric == "peak_rss_mib" and (summary.get("peak_rss_scope") != "stage" or baseline_summary.get("peak_rss_scope") != "stage"):
+                    continue
+                value, baseline_value = summary[metric], baseline_summary[metric]
+                delta = value - baseline_value
+                if delta > tolerance * baseline_value and (metric != "wall_time_sec" or delta > min_time_delta_sec):
+                    regressions.append((domain, name, metric, baseline_value, value))
+        if "peak_rss_mib" in baseline_result:
+            value, baseline_value = result["peak_rss_mib"], baseline_result["peak_rss_mib"]
+            if value - baseline_value > tolerance * baseline_value:
+                regressions.append((domain, "pipeline/run", "peak_rss_mib", baseline_value, value))
+        if "sketch" in baseline_result and result["sketch"] != baseline_result["sketch"]:
+            regressions.append((domain, "pipeline/sketch", "text", baseline_result["sketch"], result["sketch"]))
+        for name, value in result["counters"].items():
+            baseline_value = baseline_result["counters"].get(name)
+            if baseline_value is None:
+                continue
+            if abs(value - baseline_value) > counter_tolerance * baseline_value:
+                regressions.append((domain, name, "value", baseline_value, value))
+    return regressions
+
+
+def print_comparison(results: Dict, baseline: Dict):
+    print_separation_line()
+    print(f"{'domain':<16} {'stage':<40} {'baseline':>10} {'current':>10} {'ratio':>8}")
+    for domain, result in results.items():
+        baseline_stages = baseline.get(domain, dict()).get("stages", dict())
+        for name, summary in sorted(result["stages"].items()):
+            baseline_value = baseline_stages.get(name, dict()).get("wall_time_sec", np.nan)
+            ratio = summary["wall_time_sec"] / baseline_value if baseline_value > 0 else np.nan
+            print(f"{domain:<16} {name:<40} {baseline_value:>10.3f} {summary['wall_time_sec']:>10.3f} {ratio:>8.2f}")
+    print_separation_line()
@@ -2,27 +2,124 @@ import logging
 
 from pathlib import Path
 from termcolor import colored
-from typing import List, MutableSet, Dict
+from typing import List, MutableSet, Dict, Set, Tuple
 
+import numpy as np
 import pymimir as mm
 from dlplan.policy import PolicyMinimizer
 
 from .src.exit_codes import ExitCode
-from .src.iteration import EncodingType, ASPFactory, ClingoExitCode, IterationData, LearningStatistics, Sketch, D2sepDlplanPolicyFactory, ExplicitDlplanPolicyFactory, compute_feature_pool, compute_per_state_feature_valuations, compute_state_pair_equivalences, compute_tuple_graph_equivalences, minimize_tuple_graph_equivalences
-from .src.util import Timer, create_experiment_workspace, change_working_directory, write_file, change_dir, memory_usage, add_console_handler, print_separation_line
-from .src.preprocessing import InstanceData, PreprocessingData, StateFinder, compute_instance_datas, compute_tuple_graphs
+from .src.iteration import EncodingType, ASPFactory, ClingoExitCode, IterationCache, IterationData, LearningStatistics, Sketch, D2sepDlplanPolicyFactory, ExplicitDlplanPolicyFactory, compute_feature_pool, compute_feature_representatives, compute_per_state_feature_valuations, compute_state_pair_equivalences, compute_tuple_graph_equivalences, minimize_tuple_graph_equivalences, compute_smallest_unsolved_instance, create_worker_pool
+from .src.util import get_num_available_cores, profiler, Timer, create_experiment_workspace, change_working_directory, write_file, change_dir, memory_usage, add_console_handler, print_separation_line
+from .src.preprocessing import InstanceData, PreprocessingData, StateFinder, TupleGraphData, ResolvedTupleGraph, compute_instance_datas, compute_tuple_graphs, resolve_tuple_graphs, compute_cache_key, load_tuple_graphs, save_tuple_graphs
 
 
-def compute_smallest_unsolved_instance(
-        preprocessing_data: PreprocessingData,
-        iteration_data: IterationData,
-        selected_instance_datas: List[InstanceData],
-        sketch: Sketch,
-        enable_goal_separating_features: bool):
-    for instance_data in selected_instance_datas:
-        if not sketch.solves(preprocessing_data, iteration_data, instance_data, enable_goal_separating_features):
-            return instance_data
-    return None
+def compute_preprocessing_data(
+    domain_filepath: Path,
+    instance_filepaths: List[Path],
+    width: int,
+    disable_closed_Q: bool,
+    max_num_states_per_instance: int,
+    max_time_per_instance: int,
+    enable_dump_files: bool,
+    cache_directory: Path = None,
+    num_workers: int = 1,
+) -> Tuple[PreprocessingData, int, int]:
+    """ Construct the InstanceDatas and the TupleGraphs of all instances.
+
+    Returns the PreprocessingData and the number of concrete and of global faithful abstract states.
+    """
+    logging.info(colored("Constructing InstanceDatas...", "blue", "on_grey"))
+    with profiler.stage("instance_datas"):
+        domain_data, instance_datas, num_ss_states, num_gfa_states = compute_instance_datas(domain_filepath, instance_filepaths, disable_closed_Q, max_num_states_per_instance, max_time_per_instance, enable_dump_files, cache_directory, num_workers)
+    logging.info(colored("..done", "blue", "on_grey"))
+    if instance_datas is None:
+        raise Exception("Failed to create InstanceDatas.")
+
+    profiler.count("num_gfa_states", num_gfa_states)
+
+    state_finder = StateFinder(domain_data, instance_datas)
+
+    logging.info(colored("Initializing TupleGraphs...", "blue", "on_grey"))
+    with profiler.stage("tuple_graphs"):
+        gfa_state_id_to_tuple_graph: Dict[int, TupleGraphData] = load_tuple_graphs(cache_directory, len(instance_datas))
+        if gfa_state_id_to_tuple_graph is None:
+            gfa_state_id_to_tuple_graph = compute_tuple_graphs(domain_data, instance_datas, state_finder, width, enable_dump_files, num_workers)
+            save_tuple_graphs(cache_directory, gfa_state_id_to_tuple_graph)
+        else:
+            logging.info("Loaded TupleGraphs from preprocessing cache.")
+        gfa_state_id_to_resolved_tuple_graph: Dict[int, ResolvedTupleGraph] = resolve_tuple_graphs(state_finder, gfa_state_id_to_tuple_graph)
+    profiler.count("num_tuple_graph_nodes", sum(len(tuple_graph.t_idx_to_gfa_state_global_idxs) for tuple_graph in gfa_state_id_to_resolved_tuple_graph.values()))
+    logging.info(colored("..done", "blue", "on_grey"))
+
+    return PreprocessingData(domain_data, instance_datas, state_finder, gfa_state_id_to_resolved_tuple_graph), num_ss_states, num_gfa_states
+
+
+def compute_iteration_equivalences(
+    preprocessing_data: PreprocessingData,
+    iteration_data: IterationData,
+    enable_goal_separating_features: bool,
+    disable_feature_collapsing: bool = False,
+    iteration_cache: IterationCache = None,
+):
+    """ Compute the valuations, the state pair and tuple graph equivalences over the feature pool of the iteration data,
+    and the representatives of the features that the ASP encoding distinguishes.
+    """
+    logging.info(colored("Constructing PerStateFeatureValuations...", "blue", "on_grey"))
+    with profiler.stage("valuations"):
+        iteration_data.feature_valuations = compute_per_state_feature_valuations(preprocessing_data, iteration_data, iteration_cache)
+    logging.info(colored("..done", "blue", "on_grey"))
+
+    logging.info(colored("Constructing StatePairEquivalenceDatas...", "blue", "on_grey"))
+    with profiler.stage("state_pair_equivalences"):
+        iteration_data.state_pair_equivalences, iteration_data.gfa_state_global_idx_to_state_pair_equivalence = compute_state_pair_equivalences(preprocessing_data, iteration_data, iteration_cache)
+    profiler.count("num_state_pair_classes", len(iteration_data.state_pair_equivalences))
+    logging.info(colored("..done", "blue", "on_grey"))
+
+    logging.info(colored("Constructing TupleGraphEquivalences...", "blue", "on_grey"))
+    with profiler.stage("tuple_graph_equivalences"):
+        iteration_data.gfa_state_global_idx_to_tuple_graph_equivalence = compute_tuple_graph_equivalences(preprocessing_data, iteration_data, iteration_cache)
+    logging.info(colored("..done", "blue", "on_grey"))
+
+    logging.info(colored("Minimizing TupleGraphEquivalences...", "blue", "on_grey"))
+    with profiler.stage("tuple_graph_minimization"):
+        minimize_tuple_graph_equivalences(preprocessing_data, iteration_data)
+    logging.info(colored("..done", "blue", "on_grey"))
+
+    logging.info(colored("Collapsing equivalent features...", "blue", "on_grey"))
+    with profiler.stage("feature_collapsing"):
+        if disable_feature_collapsing:
+            iteration_data.asp_f_idx_to_f_idx = np.arange(len(iteration_data.feature_pool), dtype=np.int64)
+        else:
+            iteration_data.asp_f_idx_to_f_idx = compute_feature_representatives(iteration_data, enable_goal_separating_features)
+    profiler.count("num_asp_features", len(iteration_data.asp_f_idx_to_f_idx))
+    logging.info(colored("..done", "blue", "on_grey"))
+
+
+def add_initial_facts(asp_factory: ASPFactory, preprocessing_data: PreprocessingData, iteration_data: IterationData) -> Set:
+    """ Add the facts of the iteration data to the base program.
+
+    Returns the initial D2-separation facts with the D2 encoding, which are grounded separately, and an empty set otherwise.
+    """
+    with profiler.stage("fact_generation"):
+        profiler.count("num_facts", asp_factory.add_facts(asp_factory.make_facts(preprocessing_data, iteration_data)))
+        if asp_factory.encoding_type != EncodingType.D2:
+            return set()
+        return asp_factory.make_initial_d2_facts(preprocessing_data, iteration_data)
+
+
+def ground_and_solve(asp_factory: ASPFactory, facts: List = None):
+    """ Ground the given parametrized facts, see ASPFactory.ground, and solve the logic program. """
+    logging.info(colored("Grounding Logic Program...", "blue", "on_grey"))
+    with profiler.stage("grounding"):
+        asp_factory.ground(facts)
+    logging.info(colored("..done", "blue", "on_grey"))
+
+    logging.info(colored("Solving Logic Program...", "blue", "on_grey"))
+    with profiler.stage("solving"):
+        symbols, returncode = asp_factory.solve()
+    logging.info(colored("..done", "blue", "on_grey"))
+    return symbols, returncode
 
 
 def learn_sketch_for_problem_class(
@@ -47,18 +144,37 @@ def learn_sketch_for_problem_class(
     additional_booleans: List[str] = None,
     additional_numericals: List[str] = None,
     enable_dump_files: bool = False,
+    num_workers: int = 1,
+    cache_directory: Path = None,
+    disable_cache: bool = False,
+    asp_num_threads: int = None,
+    asp_parallel_mode: str = "split",
+    asp_configuration: str = None,
+    asp_opt_strategy: str = None,
+    disable_incremental_iterations: bool = False,
+    initial_complexity_limit: int = None,
+    disable_feature_collapsing: bool = False,
 ):
     # Setup arguments and workspace
     if additional_booleans is None:
         additional_booleans = []
     if additional_numericals is None:
         additional_numericals = []
+    if asp_num_threads is None:
+        asp_num_threads = get_num_available_cores()
     instance_filepaths = list(problems_directory.iterdir())
+    if disable_cache:
+        cache_directory = None
+    else:
+        if cache_directory is None:
+            cache_directory = workspace / "cache"
+        cache_directory = cache_directory / compute_cache_key(domain_filepath, instance_filepaths, disable_closed_Q, max_num_states_per_instance, max_time_per_instance, width)
     add_console_handler(logging.getLogger(), logging.INFO)
     create_experiment_workspace(workspace)
     change_working_directory(workspace)
 
-    # Keep track of time
+    # Keep track of time, memory, and sizes per stage
+    profiler.reset()
     total_timer = Timer()
     preprocessing_timer = Timer()
     asp_timer = Timer(stopped=True)
@@ -66,23 +182,24 @@ def learn_sketch_for_problem_class(
 
     # Generate data
     with change_dir("input"):
-        logging.info(colored("Constructing InstanceDatas...", "blue", "on_grey"))
-        domain_data, instance_datas, num_ss_states, num_gfa_states = compute_instance_datas(domain_filepath, instance_filepaths, disable_closed_Q, max_num_states_per_instance, max_time_per_instance, enable_dump_files)
-        logging.info(colored("..done", "blue", "on_grey"))
-        if instance_datas is None:
-            raise Exception("Failed to create InstanceDatas.")
-
-        state_finder = StateFinder(domain_data, instance_datas)
-
-        logging.info(colored("Initializing TupleGraphs...", "blue", "on_grey"))
-        gfa_state_id_to_tuple_graph: Dict[int, mm.TupleGraph] = compute_tuple_graphs(domain_data, instance_datas, state_finder, width, enable_dump_files)
-        logging.info(colored("..done", "blue", "on_grey"))
-
-    preprocessing_data = PreprocessingData(domain_data, instance_datas, state_finder, gfa_state_id_to_tuple_graph)
+        preprocessing_data, num_ss_states, num_gfa_states = compute_preprocessing_data(domain_filepath, instance_filepaths, width, disable_closed_Q, max_num_states_per_instance, max_time_per_instance, enable_dump_files, cache_directory, num_workers)
+    domain_data = preprocessing_data.domain_data
+    instance_datas = preprocessing_data.instance_datas
     preprocessing_timer.stop()
 
     # Learn sketch
     iteration_data = IterationData()
+    # Iterative deepening over the complexity of features, which is raised if no sketch exists with the current pool.
+    max_complexity_limit = max(concept_complexity_limit, role_complexity_limit, boolean_complexity_limit, count_numerical_complexity_limit, distance_numerical_complexity_limit)
+    complexity_limit = max_complexity_limit if initial_complexity_limit is None else min(initial_complexity_limit, max_complexity_limit)
+    # The complexity limit of the feature pool that is extended when the same iteration is repeated with a larger limit.
+    previous_complexity_limit = None
+    if initial_complexity_limit is not None and disable_incremental_iterations:
+        logging.warning("With disabled incremental iterations, the valuations of the whole feature pool are recomputed after each increase of the complexity limit.")
+    # Valuations and equivalences of states are kept across iterations.
+    iteration_cache = None if disable_incremental_iterations else IterationCache()
+    # Workers are forked before any clingo Control exists, see create_worker_pool.
+    worker_pool = create_worker_pool(preprocessing_data, num_workers) if num_workers > 1 else None
     with change_dir("iterations"):
         i = 0
         with change_dir(str(i), enable=enable_dump_files):
@@ -90,6 +207,7 @@ def learn_sketch_for_problem_class(
             create_experiment_workspace(workspace)
             while True:
                 logging.info(colored(f"Iteration: {i}", "red", "on_grey"))
+                profiler.set_iteration(i)
 
                 preprocessing_timer.resume()
                 iteration_data.instance_datas = [preprocessing_data.instance_datas[subproblem_idx] for subproblem_idx in selected_instance_idxs]
@@ -109,71 +227,66 @@ def learn_sketch_for_problem_class(
                 for instance_data in iteration_data.instance_datas:
                     gfa_states.update(instance_data.gfa.get_states())
                 iteration_data.gfa_states = list(gfa_states)
+                profiler.count("num_gfa_states", len(iteration_data.gfa_states))
                 logging.info(colored("..done", "blue", "on_grey"))
 
-                logging.info(colored("Initializing DomainFeatureData...", "blue", "on_grey"))
+                logging.info(colored(f"Initializing DomainFeatureData with complexity limit {complexity_limit}...", "blue", "on_grey"))
                 iteration_data.feature_pool = compute_feature_pool(
                     preprocessing_data,
                     iteration_data,
-                    gfa_state_id_to_tuple_graph,
-                    state_finder,
+                    preprocessing_data.gfa_state_global_idx_to_tuple_graph,
+                    preprocessing_data.state_finder,
                     disable_feature_generation,
                     enable_incomplete_feature_pruning,
-                    concept_complexity_limit,
-                    role_complexity_limit,
-                    boolean_complexity_limit,
-                    count_numerical_complexity_limit,
-                    distance_numerical_complexity_limit,
+                    min(concept_complexity_limit, complexity_limit),
+                    min(role_complexity_limit, complexity_limit),
+                    min(boolean_complexity_limit, complexity_limit),
+                    min(count_numerical_complexity_limit, complexity_limit),
+                    min(distance_numerical_complexity_limit, complexity_limit),
                     feature_limit,
                     additional_booleans,
-                    additional_numericals)
+                    additional_numericals,
+                    iteration_cache,
+                    num_workers,
+                    worker_pool,
+                    previous_complexity_limit)
+                previous_complexity_limit = None
                 logging.info(colored("..done", "blue", "on_grey"))
 
-                logging.info(colored("Constructing PerStateFeatureValuations...", "blue", "on_grey"))
-                iteration_data.gfa_state_global_idx_to_feature_evaluations = compute_per_state_feature_valuations(preprocessing_data, iteration_data)
-                logging.info(colored("..done", "blue", "on_grey"))
-
-                logging.info(colored("Constructing StatePairEquivalenceDatas...", "blue", "on_grey"))
-                iteration_data.state_pair_equivalences, iteration_data.gfa_state_global_idx_to_state_pair_equivalence = compute_state_pair_equivalences(preprocessing_data, iteration_data)
-                logging.info(colored("..done", "blue", "on_grey"))
-
-                logging.info(colored("Constructing TupleGraphEquivalences...", "blue", "on_grey"))
-                iteration_data.gfa_state_global_idx_to_tuple_graph_equivalence = compute_tuple_graph_equivalences(preprocessing_data, iteration_data)
-                logging.info(colored("..done", "blue", "on_grey"))
-
-                logging.info(colored("Minimizing TupleGraphEquivalences...", "blue", "on_grey"))
-                minimize_tuple_graph_equivalences(preprocessing_data, iteration_data)
-                logging.info(colored("..done", "blue", "on_grey"))
+                compute_iteration_equivalences(preprocessing_data, iteration_data, enable_goal_separating_features, disable_feature_collapsing, iteration_cache)
                 preprocessing_timer.stop()
 
                 asp_timer.resume()
+                is_unsatisfiable = False
                 if encoding_type == EncodingType.D2:
+                    # The base program is grounded once and D2-separation constraints are added incrementally.
+                    asp_factory = ASPFactory(encoding_type, enable_goal_separating_features, max_num_rules, asp_num_threads, asp_parallel_mode, asp_configuration, asp_opt_strategy)
                     d2_facts = set()
                     symbols = None
                     j = 0
                     while True:
-                        asp_factory = ASPFactory(encoding_type, enable_goal_separating_features, max_num_rules)
-                        facts = asp_factory.make_facts(preprocessing_data, iteration_data)
+                        facts = []
                         if j == 0:
-                            d2_facts.update(asp_factory.make_initial_d2_facts(preprocessing_data, iteration_data))
-                            print("Number of initial D2 facts:", len(d2_facts))
+                            new_d2_facts = add_initial_facts(asp_factory, preprocessing_data, iteration_data)
+                            print("Number of initial D2 facts:", len(new_d2_facts))
                         elif j > 0:
-                            unsatisfied_d2_facts = asp_factory.make_unsatisfied_d2_facts(iteration_data, symbols)
-                            d2_facts.update(unsatisfied_d2_facts)
+                            with profiler.stage("fact_generation"):
+                                unsatisfied_d2_facts = asp_factory.make_unsatisfied_d2_facts(iteration_data, symbols)
+                            new_d2_facts = unsatisfied_d2_facts - d2_facts
                             print("Number of unsatisfied D2 facts:", len(unsatisfied_d2_facts))
+                        d2_facts.update(new_d2_facts)
                         print("Number of D2 facts:", len(d2_facts), "of", len(iteration_data.state_pair_equivalences) ** 2)
-                        facts.extend(list(d2_facts))
-
-                        logging.info(colored("Grounding Logic Program...", "blue", "on_grey"))
-                        asp_factory.ground(facts)
-                        logging.info(colored("..done", "blue", "on_grey"))
+                        facts.extend(list(new_d2_facts))
+                        profiler.count("num_d2_facts", len(new_d2_facts))
+                        profiler.count("num_asp_iterations")
 
-                        logging.info(colored("Solving Logic Program...", "blue", "on_grey"))
-                        symbols, returncode = asp_factory.solve()
-                        logging.info(colored("..done", "blue", "on_grey"))
+                        symbols, returncode = ground_and_solve(asp_factory, facts)
 
                         if returncode in [ClingoExitCode.UNSATISFIABLE, ClingoExitCode.EXHAUSTED]:
                             print(colored("ASP is unsatisfiable!", "red", "on_grey"))
+                            if complexity_limit < max_complexity_limit:
+                                is_unsatisfiable = True
+                                break
                             print(colored(f"No sketch of width {width} exists that solves all instances!", "red", "on_grey"))
                             exit(ExitCode.UNSOLVABLE)
                         elif returncode == ClingoExitCode.UNKNOWN:
@@ -188,43 +301,56 @@ def learn_sketch_for_problem_class(
                         sketch = Sketch(dlplan_policy, width)
                         logging.info("Learned the following sketch:")
                         sketch.print()
-                        if compute_smallest_unsolved_instance(preprocessing_data, iteration_data, iteration_data.instance_datas, sketch, enable_goal_separating_features) is None:
+                        with profiler.stage("verification"):
+                            is_solved = compute_smallest_unsolved_instance(preprocessing_data, iteration_data, iteration_data.instance_datas, sketch, enable_goal_separating_features, num_workers, worker_pool) is None
+                        if is_solved:
                             # Stop adding D2-separation constraints
                             # if sketch solves all training instances
                             break
                         j += 1
                 elif encoding_type == EncodingType.EXPLICIT:
-                    asp_factory = ASPFactory(encoding_type, enable_goal_separating_features, max_num_rules)
-                    facts = asp_factory.make_facts(preprocessing_data, iteration_data)
+                    asp_factory = ASPFactory(encoding_type, enable_goal_separating_features, max_num_rules, asp_num_threads, asp_parallel_mode, asp_configuration, asp_opt_strategy)
+                    add_initial_facts(asp_factory, preprocessing_data, iteration_data)
+                    profiler.count("num_asp_iterations")
 
-                    logging.info(colored("Grounding Logic Program...", "blue", "on_grey"))
-                    asp_factory.ground(facts)
-                    logging.info(colored("..done", "blue", "on_grey"))
-
-                    logging.info(colored("Solving Logic Program...", "blue", "on_grey"))
-                    symbols, returncode = asp_factory.solve()
-                    logging.info(colored("..done", "blue", "on_grey"))
+                    symbols, returncode = ground_and_solve(asp_factory)
 
                     if returncode == ClingoExitCode.UNSATISFIABLE:
                         print("UNSAT")
-                        return None, None, None
-                    asp_factory.print_statistics()
+                        if complexity_limit == max_complexity_limit:
+                            return None, None, None
+                        is_unsatisfiable = True
+                    else:
+                        asp_factory.print_statistics()
 
-                    dlplan_policy = ExplicitDlplanPolicyFactory().make_dlplan_policy_from_answer_set(symbols, preprocessing_data, iteration_data)
-                    sketch = Sketch(dlplan_policy, width)
-                    logging.info("Learned the following sketch:")
-                    sketch.print()
+                        dlplan_policy = ExplicitDlplanPolicyFactory().make_dlplan_policy_from_answer_set(symbols, preprocessing_data, iteration_data)
+                        sketch = Sketch(dlplan_policy, width)
+                        logging.info("Learned the following sketch:")
+                        sketch.print()
                 else:
                     raise RuntimeError("Unknown encoding type:", encoding_type)
 
+                if is_unsatisfiable:
+                    # Repeat the iteration with the feature pool extended by the features of the next complexity.
+                    asp_timer.stop()
+                    previous_complexity_limit = complexity_limit
+                    complexity_limit += 1
+                    profiler.count("num_complexity_limit_increases")
+                    print(colored(f"Increasing complexity limit to {complexity_limit}.", "red", "on_grey"))
+                    continue
+
                 asp_timer.stop()
+                profiler.count("num_sketch_rules", len(sketch.dlplan_policy.get_rules()))
 
                 verification_timer.resume()
                 logging.info(colored("Verifying learned sketch...", "blue", "on_grey"))
-                assert compute_smallest_unsolved_instance(preprocessing_data, iteration_data, iteration_data.instance_datas, sketch, enable_goal_separating_features) is None
-                smallest_unsolved_instance = compute_smallest_unsolved_instance(preprocessing_data, iteration_data, instance_datas, sketch, enable_goal_separating_features)
+                with profiler.stage("verification"):
+                    assert compute_smallest_unsolved_instance(preprocessing_data, iteration_data, iteration_data.instance_datas, sketch, enable_goal_separating_features, num_workers, worker_pool) is None
+                    smallest_unsolved_instance = compute_smallest_unsolved_instance(preprocessing_data, iteration_data, instance_datas, sketch, enable_goal_separating_features, num_workers, worker_pool)
                 logging.info(colored("..done", "blue", "on_grey"))
                 verification_timer.stop()
+                # Write the profile after each iteration such that interrupted runs leave a report.
+                profiler.write(workspace / "output")
 
                 if smallest_unsolved_instance is None:
                     print(colored("Sketch solves all instances!", "red", "on_grey"))
@@ -238,6 +364,8 @@ def learn_sketch_for_problem_class(
                     print("Selected instances:", selected_instance_idxs)
                 i += 1
 
+    if worker_pool is not None:
+        worker_pool.shutdown()
     total_timer.stop()
 
     # Output the result
@@ -266,6 +394,8 @@ def learn_sketch_for_problem_class(
         create_experiment_workspace(workspace / "output")
         write_file(f"sketch_{width}.txt", str(sketch.dlplan_policy))
         write_file(f"sketch_minimized_{width}.txt", str(sketch_minimized.dlplan_policy))
+        profiler.set_iteration(None)
+        profiler.write(workspace / "output")
 
         print_separation_line()
         print(f"Preprocessing time: {int(preprocessing_timer.get_elapsed_sec()) + 1} seconds.")
@@ -1,12 +1,17 @@
-from .asp import ASPFactory, ClingoExitCode, EncodingType
+from .asp import ASPFactory, ClingoExitCode, EncodingType, PARALLEL_MODES, CONFIGURATIONS, OPT_STRATEGIES
 from .dlplan_policy_factory import DlplanPolicyFactory, ExplicitDlplanPolicyFactory, D2sepDlplanPolicyFactory
-from .feature_pool_utils import compute_feature_pool
+from .feature_pool_utils import compute_feature_pool, compute_feature_representatives
 from .feature_pool import Feature
 from .feature_valuations_utils import compute_per_state_feature_valuations
+from .feature_valuations import FeatureValuations
+from .iteration_cache import IterationCache
 from .iteration_data import IterationData
 from .learning_statistics import LearningStatistics
 from .sketch import Sketch
+from .state_pair_classes import StatePairClasses
 from .state_pair_equivalence_utils import compute_state_pair_equivalences
 from .state_pair_equivalence import StatePairEquivalence
 from .tuple_graph_equivalence_utils import compute_tuple_graph_equivalences, minimize_tuple_graph_equivalences
 from .tuple_graph_equivalence import TupleGraphEquivalence
+from .verification_utils import compute_smallest_unsolved_instance
+from .worker_pool_utils import create_worker_pool
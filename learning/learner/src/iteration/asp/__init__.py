@@ -1,3 +1,3 @@
-from .asp_factory import ASPFactory
+from .asp_factory import ASPFactory, PARALLEL_MODES, CONFIGURATIONS, OPT_STRATEGIES
 from .returncodes import ClingoExitCode
 from .encoding_type import EncodingType
@@ -1,13 +1,14 @@
+import io
 import os
 
 from collections import defaultdict
-from typing import List, Union, Dict
+from typing import List, Union, Dict, Iterable, MutableSet, Tuple
 from pathlib import Path
 
+import numpy as np
 import pymimir as mm
 
 import dlplan.core as dlplan_core
-import dlplan.policy as dlplan_policy
 
 from clingo import Control, Number, Symbol, String
 
@@ -15,50 +16,49 @@ from .returncodes import ClingoExitCode
 from .encoding_type import EncodingType
 
 from ...preprocessing.preprocessing_data import PreprocessingData
+from ...util import profiler
 from ..iteration_data import IterationData
 
 
 LIST_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 
+# Number of facts that are buffered as text before they are added to the base program.
+FACT_CHUNK_SIZE = 100000
+
+# Values of the clingo options that ASPFactory accepts, such that invalid values are rejected before creating the Control.
+PARALLEL_MODES = ["split", "compete"]
+CONFIGURATIONS = ["auto", "frumpy", "jumpy", "tweety", "handy", "crafty", "trendy", "many"]
+OPT_STRATEGIES = ["bb", "bb,lin", "bb,hier", "bb,inc", "bb,dec", "usc", "usc,oll", "usc,one", "usc,k", "usc,pmres"]
+
 
 class ASPFactory:
-    def __init__(self, encoding_type: EncodingType, enable_goal_separating_features: bool, max_num_rules: int):
-        add_arguments = []
+    def __init__(self,
+                 encoding_type: EncodingType,
+                 enable_goal_separating_features: bool,
+                 max_num_rules: int,
+                 num_threads: int = 1,
+                 parallel_mode: str = "split",
+                 configuration: str = None,
+                 opt_strategy: str = None):
+        if num_threads < 1:
+            raise ValueError(f"Number of threads must be positive: {num_threads}")
+        if parallel_mode not in PARALLEL_MODES:
+            raise ValueError(f"Unknown parallel mode: {parallel_mode}")
+        if configuration is not None and configuration not in CONFIGURATIONS:
+            raise ValueError(f"Unknown configuration: {configuration}")
+        if opt_strategy is not None and opt_strategy not in OPT_STRATEGIES:
+            raise ValueError(f"Unknown optimization strategy: {opt_strategy}")
+        self.arguments = ["-n", "0"]
+        if num_threads > 1:
+            self.arguments.append(f"--parallel-mode={num_threads},{parallel_mode}")
+        if configuration is not None:
+            self.arguments.append(f"--configuration={configuration}")
+        if opt_strategy is not None:
+            self.arguments.append(f"--opt-strategy={opt_strategy}")
         if encoding_type == EncodingType.EXPLICIT:
-            add_arguments.extend(["--const", f"max_num_rules={max_num_rules}"])
-
-        self.ctl = Control(arguments=["--parallel-mode=32,split", "-n", "0"] + add_arguments)
-
-        # features
-        self.ctl.add("boolean", ["b"], "boolean(b).")
-        self.ctl.add("numerical", ["n"], "numerical(n).")
-        self.ctl.add("feature", ["f"], "feature(f).")
-        self.ctl.add("complexity", ["f", "c"], "complexity(f,c).")
-        self.ctl.add("value", ["s","f","v"], "value(s,f,v).")
-        self.ctl.add("b_value", ["s","f","v"], "b_value(s,f,v).")
-        # state space
-        self.ctl.add("state", ["s"], "state(s).")
-        self.ctl.add("initial", ["s"], "initial(s).")
-        self.ctl.add("solvable", ["s"], "solvable(s).")
-        self.ctl.add("unsolvable", ["s"], "unsolvable(s).")
-        self.ctl.add("goal", ["s"], "goal(s).")
-        self.ctl.add("nongoal", ["s"], "nongoal(s).")
-        self.ctl.add("alive", ["s"], "alive(s).")
-        self.ctl.add("expanded", ["s"], "expanded(s).")
-        # rule equivalences
-        self.ctl.add("feature_condition", ["r", "f", "v"], "feature_condition(r,f,v).")
-        self.ctl.add("feature_effect", ["r", "f", "v"], "feature_effect(r,f,v).")
-        self.ctl.add("state_pair_class", ["r"], "state_pair_class(r).")
-        # d2-separation constraints
-        self.ctl.add("d2_separate", ["r1", "r2"], "d2_separate(r1,r2).")
-        # tuple graph
-        self.ctl.add("tuple", ["s", "t"], "tuple(s,t).")
-        self.ctl.add("contain", ["s", "t", "r"], "contain(s,t,r).")
-        self.ctl.add("cover", ["s1", "s2", "r"], "cover(s1,s2,r).")
-        self.ctl.add("t_distance", ["s", "t", "d"], "t_distance(s,t,d).")
-        self.ctl.add("d_distance", ["s", "r", "d"], "d_distance(s,r,d).")
-        self.ctl.add("r_distance", ["s", "r", "d"], "r_distance(s,r,d).")
-        self.ctl.add("s_distance", ["s1", "s2", "d"], "s_distance(s1,s2,d).")
+            self.arguments.extend(["--const", f"max_num_rules={max_num_rules}"])
+
+        self.ctl = Control(arguments=self.arguments)
 
         if encoding_type == EncodingType.D2:
             self.ctl.load(str(LIST_DIR / "sketch-d2.lp"))
@@ -69,6 +69,10 @@ class ASPFactory:
 
         if enable_goal_separating_features:
             self.ctl.load(str(LIST_DIR / "goal_separation.lp"))
+        self.enable_goal_separating_features = enable_goal_separating_features
+        self.encoding_type = encoding_type
+
+        self.is_base_grounded = False
 
 
     def _create_initial_fact(self, gfa_state_global_idx: int):
@@ -97,27 +101,33 @@ class ASPFactory:
                                 iteration_data: IterationData):
         """ Create facts that encode the state space.
         """
-        facts = set()
+        initial_gfa_state_global_idxs = set()
+        gfa_state_global_idxs = set()
         for instance_data in iteration_data.instance_datas:
             for initial_gfa_idx in instance_data.initial_gfa_state_idxs:
                 initial_gfa_state = instance_data.gfa.get_states()[initial_gfa_idx]
                 initial_gfa_state_global_idx = initial_gfa_state.get_global_index()
-                facts.add(self._create_initial_fact(initial_gfa_state_global_idx))
+                if initial_gfa_state_global_idx in initial_gfa_state_global_idxs:
+                    continue
+                initial_gfa_state_global_idxs.add(initial_gfa_state_global_idx)
+                yield self._create_initial_fact(initial_gfa_state_global_idx)
             for gfa_state in instance_data.gfa.get_states():
                 gfa_state_global_idx = gfa_state.get_global_index()
                 gfa_state_idx = gfa_state.get_index()
-                facts.add(self._create_state_fact(gfa_state_global_idx))
+                if gfa_state_global_idx in gfa_state_global_idxs:
+                    continue
+                gfa_state_global_idxs.add(gfa_state_global_idx)
+                yield self._create_state_fact(gfa_state_global_idx)
                 if instance_data.gfa.is_deadend_state(gfa_state_idx):
-                    facts.add(self._create_unsolvable_fact(gfa_state_global_idx))
+                    yield self._create_unsolvable_fact(gfa_state_global_idx)
                 else:
-                    facts.add(self._create_solvable_fact(gfa_state_global_idx))
+                    yield self._create_solvable_fact(gfa_state_global_idx)
                 if instance_data.gfa.is_goal_state(gfa_state_idx):
-                    facts.add(self._create_goal_fact(gfa_state_global_idx))
+                    yield self._create_goal_fact(gfa_state_global_idx)
                 else:
-                    facts.add(self._create_nongoal_fact(gfa_state_global_idx))
+                    yield self._create_nongoal_fact(gfa_state_global_idx)
                 if instance_data.gfa.is_alive_state(gfa_state_idx):
-                    facts.add(self._create_alive_fact(gfa_state_global_idx))
-        return sorted(list(facts))
+                    yield self._create_alive_fact(gfa_state_global_idx)
 
 
     def _create_feature_fact(self, f_idx: int):
@@ -135,100 +145,66 @@ class ASPFactory:
     def _make_domain_feature_data_facts(self,
                                         preprocessing_data: PreprocessingData,
                                         iteration_data: IterationData):
-        facts = []
-        # Domain feature facts
-        for f_idx, feature in enumerate(iteration_data.feature_pool):
-            facts.append(self._create_feature_fact(f_idx))
-            facts.append(self._create_complexity_fact(f_idx, feature.complexity))
+        # Domain feature facts, only for representatives of equivalent features
+        for asp_f_idx, f_idx in enumerate(iteration_data.asp_f_idx_to_f_idx.tolist()):
+            feature = iteration_data.feature_pool[f_idx]
+            yield self._create_feature_fact(asp_f_idx)
+            yield self._create_complexity_fact(asp_f_idx, feature.complexity)
             if isinstance(feature.dlplan_feature, dlplan_core.Boolean):
-                facts.append(self._create_boolean_fact(f_idx))
+                yield self._create_boolean_fact(asp_f_idx)
             elif isinstance(feature.dlplan_feature, dlplan_core.Numerical):
-                facts.append(self._create_numerical_fact(f_idx))
-        return facts
+                yield self._create_numerical_fact(asp_f_idx)
 
 
-    def _create_value_fact(self, gfa_state_id: int, f_idx: int, val: Union[bool, int]):
-        return ("value", (Number(gfa_state_id), Number(f_idx), Number(val)))
-
-    def _create_b_value_fact(self, dlplan_feature: Union[dlplan_core.Boolean, dlplan_core.Numerical], gfa_state_id: int, f_idx: int, val: Union[bool, int]):
-        if isinstance(dlplan_feature, dlplan_core.Boolean):
-            return ("b_value", (Number(gfa_state_id), Number(f_idx), Number(1 if val else 0)))
-        elif isinstance(dlplan_feature, dlplan_core.Numerical):
-            return ("b_value", (Number(gfa_state_id), Number(f_idx), Number(1 if val > 0 else 0)))
-        else:
-            raise RuntimeError("Expected Boolean or Numerical feature.")
+    def _create_b_value_fact(self, gfa_state_id: int, f_idx: int, b_val: int):
+        return ("b_value", (Number(gfa_state_id), Number(f_idx), Number(b_val)))
 
     def _make_instance_feature_data_facts(self,
                                           preprocessing_data: PreprocessingData,
                                           iteration_data: IterationData):
-        facts = []
-        # Instance feature valuation facts
-        feature_pool = iteration_data.feature_pool
-        for gfa_state_id, feature_valuations in iteration_data.gfa_state_global_idx_to_feature_evaluations.items():
-            for f_idx, (feature, val) in enumerate(zip(feature_pool, feature_valuations)):
-                facts.append(self._create_value_fact(gfa_state_id, f_idx, val))
-                facts.append(self._create_b_value_fact(feature.dlplan_feature, gfa_state_id, f_idx, val))
-        return facts
+        # Instance feature valuation facts, only needed for goal separation, where b_value is val > 0 for all features
+        if not self.enable_goal_separating_features:
+            return
+        feature_valuations = iteration_data.feature_valuations
+        b_valuations = feature_valuations.valuations[:, iteration_data.asp_f_idx_to_f_idx] > 0
+        for gfa_state_id, b_vals in zip(feature_valuations.gfa_state_global_idxs.tolist(), b_valuations.astype(int).tolist()):
+            for asp_f_idx, b_val in enumerate(b_vals):
+                yield self._create_b_value_fact(gfa_state_id, asp_f_idx, b_val)
 
 
     def _create_state_pair_class_fact(self, r_idx: int):
         return ("state_pair_class", (Number(r_idx),))
 
-    def _create_feature_condition_fact(self, condition: Union[dlplan_policy.PositiveBooleanCondition, dlplan_policy.NegativeBooleanCondition, dlplan_policy.GreaterNumericalCondition, dlplan_policy.EqualNumericalCondition], r_idx: int, f_idx: int):
-        if isinstance(condition, dlplan_policy.PositiveBooleanCondition):
-            return ("feature_condition", (Number(r_idx), Number(f_idx), String("c_b_pos"),))
-        elif isinstance(condition, dlplan_policy.NegativeBooleanCondition):
-            return ("feature_condition", (Number(r_idx), Number(f_idx), String("c_b_neg"),))
-        elif isinstance(condition, dlplan_policy.GreaterNumericalCondition):
-            return ("feature_condition", (Number(r_idx), Number(f_idx), String("c_n_gt"),))
-        elif isinstance(condition, dlplan_policy.EqualNumericalCondition):
-            return ("feature_condition", (Number(r_idx), Number(f_idx), String("c_n_eq"),))
-        else:
-            raise RuntimeError(f"Cannot parse condition {str(condition)}")
-
-    def _create_feature_effect_fact(self, effect: Union[dlplan_policy.PositiveBooleanEffect, dlplan_policy.NegativeBooleanEffect, dlplan_policy.UnchangedBooleanEffect, dlplan_policy.IncrementNumericalEffect, dlplan_policy.DecrementNumericalEffect, dlplan_policy.UnchangedNumericalEffect], r_idx: int, f_idx: int):
-        if isinstance(effect, dlplan_policy.PositiveBooleanEffect):
-            return ("feature_effect", (Number(r_idx), Number(f_idx), String("e_b_pos"),))
-        elif isinstance(effect, dlplan_policy.NegativeBooleanEffect):
-            return ("feature_effect", (Number(r_idx), Number(f_idx), String("e_b_neg"),))
-        elif isinstance(effect, dlplan_policy.UnchangedBooleanEffect):
-            return ("feature_effect", (Number(r_idx), Number(f_idx), String("e_b_bot"),))
-        elif isinstance(effect, dlplan_policy.IncrementNumericalEffect):
-            return ("feature_effect", (Number(r_idx), Number(f_idx), String("e_n_inc"),))
-        elif isinstance(effect, dlplan_policy.DecrementNumericalEffect):
-            return ("feature_effect", (Number(r_idx), Number(f_idx), String("e_n_dec"),))
-        elif isinstance(effect, dlplan_policy.UnchangedNumericalEffect):
-            return ("feature_effect", (Number(r_idx), Number(f_idx), String("e_n_bot"),))
-        else:
-            raise RuntimeError(f"Cannot parse effect {str(effect)}")
+    def _create_feature_condition_fact(self, r_idx: int, f_idx: int, condition: str):
+        return ("feature_condition", (Number(r_idx), Number(f_idx), String(condition),))
+
+    def _create_feature_effect_fact(self, r_idx: int, f_idx: int, effect: str):
+        return ("feature_effect", (Number(r_idx), Number(f_idx), String(effect),))
 
     def _create_r_distance_fact(self, gfa_state_id: int, r_idx: int, d: int):
         return ("r_distance", (Number(gfa_state_id), Number(r_idx), Number(d)))
 
-    def _create_cover_fact(self, gfa_state_id: int, gfa_state_prime_id: int, r_idx: int):
-        return ("cover", (Number(gfa_state_id), Number(gfa_state_prime_id), Number(r_idx)))
-
     def _make_state_pair_equivalence_data_facts(self,
                                                 preprocessing_data: PreprocessingData,
-                                                iteration_data: IterationData):
-        facts = []
-        # State pair facts
-        for r_idx, rule in enumerate(iteration_data.state_pair_equivalences):
-            facts.append(self._create_state_pair_class_fact(r_idx))
-            for condition in rule.get_conditions():
-                f_idx = int(condition.get_named_element().get_key()[1:])
-                facts.append(self._create_feature_condition_fact(condition, r_idx, f_idx))
-            for effect in rule.get_effects():
-                f_idx = int(effect.get_named_element().get_key()[1:])
-                facts.append(self._create_feature_effect_fact(effect, r_idx, f_idx))
+                                                iteration_data: IterationData,
+                                                r_reachable_gfa_state_global_idxs: MutableSet[int]):
+        # State pair facts, the names of conditions and effects are indexed by the condition bit and effect sign + 1
+        asp_f_idx_to_f_idx = iteration_data.asp_f_idx_to_f_idx
+        is_boolean = [isinstance(iteration_data.feature_pool[f_idx].dlplan_feature, dlplan_core.Boolean) for f_idx in asp_f_idx_to_f_idx.tolist()]
+        condition_names = {True: ("c_b_neg", "c_b_pos"), False: ("c_n_eq", "c_n_gt")}
+        effect_names = {True: ("e_b_neg", "e_b_bot", "e_b_pos"), False: ("e_n_dec", "e_n_bot", "e_n_inc")}
+        state_pair_classes = iteration_data.state_pair_equivalences
+        for r_idx, (conditions, effects) in enumerate(zip(state_pair_classes.conditions[:, asp_f_idx_to_f_idx], state_pair_classes.effects[:, asp_f_idx_to_f_idx])):
+            yield self._create_state_pair_class_fact(r_idx)
+            for asp_f_idx, (condition, effect) in enumerate(zip(conditions.tolist(), effects.tolist())):
+                yield self._create_feature_condition_fact(r_idx, asp_f_idx, condition_names[is_boolean[asp_f_idx]][condition])
+                yield self._create_feature_effect_fact(r_idx, asp_f_idx, effect_names[is_boolean[asp_f_idx]][effect + 1])
         # State pair equivalence facts
         for gfa_state_id, state_pair_equivalence in iteration_data.gfa_state_global_idx_to_state_pair_equivalence.items():
+            if gfa_state_id not in r_reachable_gfa_state_global_idxs:
+                continue
             for r_idx, d in state_pair_equivalence.r_idx_to_closest_subgoal_distance.items():
-                facts.append(self._create_r_distance_fact(gfa_state_id, r_idx, d))
-            for r_idx, gfa_state_prime_ids in state_pair_equivalence.r_idx_to_subgoal_gfa_state_ids.items():
-                for gfa_state_prime_id in gfa_state_prime_ids:
-                    facts.append(self._create_cover_fact(gfa_state_id, gfa_state_prime_id, r_idx))
-        return facts
+                yield self._create_r_distance_fact(gfa_state_id, r_idx, d)
 
 
     def _create_tuple_fact(self, gfa_state_global_idx: int, t_idx: int):
@@ -245,59 +221,104 @@ class ASPFactory:
 
     def _make_tuple_graph_equivalence_facts(self,
                                             preprocessing_data: PreprocessingData,
-                                            iteration_data: IterationData):
-        facts = []
+                                            iteration_data: IterationData,
+                                            r_reachable_gfa_state_global_idxs: MutableSet[int]):
         for gfa_state_global_idx, tuple_graph_equivalence in iteration_data.gfa_state_global_idx_to_tuple_graph_equivalence.items():
+            if gfa_state_global_idx not in r_reachable_gfa_state_global_idxs:
+                continue
             for t_idx, r_idxs in tuple_graph_equivalence.t_idx_to_r_idxs.items():
-                facts.append(self._create_tuple_fact(gfa_state_global_idx, t_idx))
+                yield self._create_tuple_fact(gfa_state_global_idx, t_idx)
                 for r_idx in r_idxs:
-                    facts.append(self._create_contain_fact(gfa_state_global_idx, t_idx, r_idx))
+                    yield self._create_contain_fact(gfa_state_global_idx, t_idx, r_idx)
             for t_idx, d in tuple_graph_equivalence.t_idx_to_distance.items():
-                facts.append(self._create_t_distance_fact(gfa_state_global_idx, t_idx, d))
+                yield self._create_t_distance_fact(gfa_state_global_idx, t_idx, d)
             for r_idx, d in tuple_graph_equivalence.r_idx_to_deadend_distance.items():
-                facts.append(self._create_d_distance_fact(gfa_state_global_idx, r_idx, d))
-        return facts
+                yield self._create_d_distance_fact(gfa_state_global_idx, r_idx, d)
 
 
-    def _create_s_distance_fact(self, gfa_state_global_idx: int, gfa_state_prime_id: int, d: int):
-        return ("s_distance", (Number(gfa_state_global_idx), Number(gfa_state_prime_id), Number(d)))
+    def _create_pair_fact(self, gfa_state_global_idx: int, gfa_state_prime_global_idx: int, r_idx: int, d: int):
+        return ("pair", (Number(gfa_state_global_idx), Number(gfa_state_prime_global_idx), Number(r_idx), Number(d)))
 
-    def _make_tuple_graph_facts(self,
-                                preprocessing_data: PreprocessingData,
-                                iteration_data: IterationData):
-        facts = []
+    def _compute_max_subgoal_distances(self, iteration_data: IterationData) -> Dict[int, int]:
+        """ Map each state with subgoal tuples to the largest distance of its subgoal tuples. """
+        gfa_state_global_idx_to_max_subgoal_distance = dict()
+        for gfa_state_global_idx, tuple_graph_equivalence in iteration_data.gfa_state_global_idx_to_tuple_graph_equivalence.items():
+            if tuple_graph_equivalence.t_idx_to_distance:
+                gfa_state_global_idx_to_max_subgoal_distance[gfa_state_global_idx] = max(tuple_graph_equivalence.t_idx_to_distance.values())
+        return gfa_state_global_idx_to_max_subgoal_distance
+
+    def _make_pair_facts(self,
+                         preprocessing_data: PreprocessingData,
+                         iteration_data: IterationData,
+                         r_reachable_gfa_state_global_idxs: MutableSet[int],
+                         gfa_state_global_idx_to_max_subgoal_distance: Dict[int, int]):
+        """ Create one fact pair(S, S', C, D) per state S' at distance D in the tuple graph of S with class C.
+
+        Pairs farther than the largest subgoal distance of S can never make S' R-reachable,
+        but both encodings require termination over all rule compatible pairs, i.e., sat_pair and good(S, S'),
+        hence, all pairs are kept such that no encoding accepts sketches with cycles through far pairs.
+        """
+        for gfa_state_global_idx in gfa_state_global_idx_to_max_subgoal_distance.keys():
+            if gfa_state_global_idx not in r_reachable_gfa_state_global_idxs:
+                continue
+            tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
+            subgoal_gfa_state_id_to_r_idx = iteration_data.gfa_state_global_idx_to_state_pair_equivalence[gfa_state_global_idx].subgoal_gfa_state_id_to_r_idx
+            for s_distance, gfa_state_prime_global_idxs in enumerate(tuple_graph.gfa_state_global_idxs_by_distance):
+                for gfa_state_prime_global_idx in gfa_state_prime_global_idxs.tolist():
+                    yield self._create_pair_fact(gfa_state_global_idx, gfa_state_prime_global_idx, subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx], s_distance)
+
+    def _compute_possibly_r_reachable_gfa_state_global_idxs(self,
+                                                            preprocessing_data: PreprocessingData,
+                                                            iteration_data: IterationData,
+                                                            gfa_state_global_idx_to_max_subgoal_distance: Dict[int, int]) -> MutableSet[int]:
+        """ Compute the states that can become R-reachable in any answer set.
+
+        These are the initial states and, transitively, the states within the largest subgoal distance
+        of a possibly R-reachable nongoal state. Facts about state pairs and tuple graphs of other states
+        only occur in rule bodies together with r_reachable and can be omitted.
+        In the closed-Q setting all alive states are initial and nothing is omitted.
+        """
+        is_goal = dict()
         for gfa_state in iteration_data.gfa_states:
-            instance_idx = gfa_state.get_faithful_abstraction_index()
-            instance_data = preprocessing_data.instance_datas[instance_idx]
-
+            gfa = preprocessing_data.instance_datas[gfa_state.get_faithful_abstraction_index()].gfa
             gfa_state_global_idx = gfa_state.get_global_index()
-            gfa_state_idx = instance_data.gfa.get_abstract_state_index(gfa_state_global_idx)
-            if instance_data.gfa.is_deadend_state(gfa_state_idx):
-                continue
+            is_goal[gfa_state_global_idx] = gfa.is_goal_state(gfa.get_abstract_state_index(gfa_state_global_idx))
 
+        queue = []
+        for instance_data in iteration_data.instance_datas:
+            gfa_states = instance_data.gfa.get_states()
+            for initial_gfa_idx in instance_data.initial_gfa_state_idxs:
+                queue.append(gfa_states[initial_gfa_idx].get_global_index())
+        r_reachable_gfa_state_global_idxs = set(queue)
+        while queue:
+            gfa_state_global_idx = queue.pop()
+            max_subgoal_distance = gfa_state_global_idx_to_max_subgoal_distance.get(gfa_state_global_idx)
+            if is_goal[gfa_state_global_idx] or max_subgoal_distance is None:
+                continue
             tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
-            tuple_graph_states_by_distance = tuple_graph.get_states_grouped_by_distance()
-
-            for s_distance, mimir_ss_states_prime in enumerate(tuple_graph_states_by_distance):
-                for mimir_ss_state_prime in mimir_ss_states_prime:
-                    gfa_state_prime = preprocessing_data.state_finder.get_gfa_state_from_ss_state_idx(instance_idx, instance_data.mimir_ss.get_state_index(mimir_ss_state_prime))
-                    gfa_state_prime_global_idx = gfa_state_prime.get_global_index()
-                    facts.append(self._create_s_distance_fact(gfa_state_global_idx, gfa_state_prime_global_idx, s_distance))
-
-        return facts
-
+            for gfa_state_prime_global_idxs in tuple_graph.gfa_state_global_idxs_by_distance[:max_subgoal_distance + 1]:
+                for gfa_state_prime_global_idx in gfa_state_prime_global_idxs.tolist():
+                    if gfa_state_prime_global_idx not in r_reachable_gfa_state_global_idxs:
+                        r_reachable_gfa_state_global_idxs.add(gfa_state_prime_global_idx)
+                        queue.append(gfa_state_prime_global_idx)
+        return r_reachable_gfa_state_global_idxs
 
     def make_facts(self,
                    preprocessing_data: PreprocessingData,
                    iteration_data: IterationData):
-        facts = []
-        facts.extend(self._make_state_space_facts(preprocessing_data, iteration_data))
-        facts.extend(self._make_domain_feature_data_facts(preprocessing_data, iteration_data))
-        facts.extend(self._make_instance_feature_data_facts(preprocessing_data, iteration_data))
-        facts.extend(self._make_state_pair_equivalence_data_facts(preprocessing_data, iteration_data))
-        facts.extend(self._make_tuple_graph_equivalence_facts(preprocessing_data, iteration_data))
-        facts.extend(self._make_tuple_graph_facts(preprocessing_data, iteration_data))
-        return facts
+        """ Lazily create all facts, such that they can be added to the program while being generated.
+
+        Facts about state pairs and tuple graphs are only created for states that can become R-reachable.
+        """
+        gfa_state_global_idx_to_max_subgoal_distance = self._compute_max_subgoal_distances(iteration_data)
+        r_reachable_gfa_state_global_idxs = self._compute_possibly_r_reachable_gfa_state_global_idxs(preprocessing_data, iteration_data, gfa_state_global_idx_to_max_subgoal_distance)
+        profiler.count("num_possibly_r_reachable_states", len(r_reachable_gfa_state_global_idxs))
+        yield from self._make_state_space_facts(preprocessing_data, iteration_data)
+        yield from self._make_domain_feature_data_facts(preprocessing_data, iteration_data)
+        yield from self._make_instance_feature_data_facts(preprocessing_data, iteration_data)
+        yield from self._make_state_pair_equivalence_data_facts(preprocessing_data, iteration_data, r_reachable_gfa_state_global_idxs)
+        yield from self._make_tuple_graph_equivalence_facts(preprocessing_data, iteration_data, r_reachable_gfa_state_global_idxs)
+        yield from self._make_pair_facts(preprocessing_data, iteration_data, r_reachable_gfa_state_global_idxs, gfa_state_global_idx_to_max_subgoal_distance)
 
     def _create_d2_separate_fact(self, r_idx_1: int, r_idx_2: int):
         return ("d2_separate", (Number(r_idx_1), Number(r_idx_2)))
@@ -316,16 +337,14 @@ class ASPFactory:
 
             gfa_state_global_idx = gfa_state.get_global_index()
             tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
-            tuple_graph_vertices_by_distance = tuple_graph.get_vertices_grouped_by_distance()
 
             equivalences = set()
+            subgoal_gfa_state_id_to_r_idx = iteration_data.gfa_state_global_idx_to_state_pair_equivalence[gfa_state_global_idx].subgoal_gfa_state_id_to_r_idx
 
-            for tuple_vertex_group in tuple_graph_vertices_by_distance:
-                for tuple_vertex in tuple_vertex_group:
-                    for mimir_ss_state_prime in tuple_vertex.get_states():
-                        gfa_state_prime = preprocessing_data.state_finder.get_gfa_state_from_ss_state_idx(instance_idx, instance_data.mimir_ss.get_state_index(mimir_ss_state_prime))
-                        gfa_state_prime_global_idx = gfa_state_prime.get_global_index()
-                        equivalences.add(iteration_data.gfa_state_global_idx_to_state_pair_equivalence[gfa_state_global_idx].subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx])
+            for t_idxs in tuple_graph.t_idxs_by_distance:
+                for t_idx in t_idxs.tolist():
+                    for gfa_state_prime_global_idx in tuple_graph.t_idx_to_gfa_state_global_idxs[t_idx].tolist():
+                        equivalences.add(subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx])
 
             for i, eq_1 in enumerate(equivalences):
                 for j, eq_2 in enumerate(equivalences):
@@ -334,54 +353,68 @@ class ASPFactory:
         return facts
 
     def make_unsatisfied_d2_facts(self, iteration_data: IterationData, symbols: List[Symbol]):
-        # compute good and bad equivalences
-        good_equivalences = set()
+        """ Create the D2-separation facts of good and bad classes that no selected feature distinguishes.
+
+        Classes are grouped by their conditions and effects projected onto the selected features,
+        such that each good and bad class in the same group form an unsatisfied pair.
+        """
+        state_pair_classes = iteration_data.state_pair_equivalences
+        # compute good equivalences and selected features
+        is_good = np.zeros(len(state_pair_classes), dtype=bool)
+        selected_f_idxs = []
         for symbol in symbols:
             if symbol.name == "good":
-                good_equivalences.add(symbol.arguments[0].number)
-        bad_equivalences = set(r_idx for r_idx in range(len(iteration_data.state_pair_equivalences)) if r_idx not in good_equivalences)
-        # compute selected features
-        selected_feature_idxs = set()
-        for symbol in symbols:
-            if symbol.name == "select":
-                selected_feature_idxs.add(symbol.arguments[0].number)
-        # preprocess symbols
-        rule_to_feature_to_condition = defaultdict(dict)
-        rule_to_feature_to_effect = defaultdict(dict)
-        for symbol in symbols:
-            if symbol.name == "feature_condition":
-                r_idx = symbol.arguments[0].number
-                f_idx = symbol.arguments[1].number
-                condition = symbol.arguments[2].string
-                rule_to_feature_to_condition[r_idx][f_idx] = condition
-            if symbol.name == "feature_effect":
-                r_idx = symbol.arguments[0].number
-                f_idx = symbol.arguments[1].number
-                effect = symbol.arguments[2].string
-                rule_to_feature_to_effect[r_idx][f_idx] = effect
+                is_good[symbol.arguments[0].number] = True
+            elif symbol.name == "select":
+                selected_f_idxs.append(int(iteration_data.asp_f_idx_to_f_idx[symbol.arguments[0].number]))
+        selected_f_idxs = np.array(sorted(selected_f_idxs), dtype=np.int64)
+        # Encode the condition bit and the effect sign of each selected feature in a single byte
+        signatures = np.ascontiguousarray(state_pair_classes.conditions[:, selected_f_idxs].astype(np.int8) * 3 + state_pair_classes.effects[:, selected_f_idxs] + 1)
+        signature_to_r_idxs = defaultdict(list)
+        for r_idx, signature in enumerate(signatures):
+            signature_to_r_idxs[signature.tobytes()].append(r_idx)
         facts = set()
-        for good in good_equivalences:
-            for bad in bad_equivalences:
-                # there must exist a selected feature that distinguishes them
-                exists_distinguishing_feature = False
-                for f_idx in selected_feature_idxs:
-                    condition_good = rule_to_feature_to_condition[good][f_idx]
-                    condition_bad = rule_to_feature_to_condition[bad][f_idx]
-                    effect_good = rule_to_feature_to_effect[good][f_idx]
-                    effect_bad = rule_to_feature_to_effect[bad][f_idx]
-                    assert condition_good is not None and condition_bad is not None and \
-                        effect_good is not None and effect_bad is not None
-                    if condition_good != condition_bad or \
-                        effect_good != effect_bad:
-                        exists_distinguishing_feature = True
-                        break
-                if not exists_distinguishing_feature:
+        for r_idxs in signature_to_r_idxs.values():
+            good_r_idxs = [r_idx for r_idx in r_idxs if is_good[r_idx]]
+            bad_r_idxs = [r_idx for r_idx in r_idxs if not is_good[r_idx]]
+            for good in good_r_idxs:
+                for bad in bad_r_idxs:
                     facts.add(self._create_d2_separate_fact(good, bad))
         return facts
 
-    def ground(self, facts=[]):
-        facts.append(("base", []))
-        self.ctl.ground(facts)  # ground a set of facts
+    def add_facts(self, facts: Iterable[Tuple[str, Tuple[Symbol, ...]]]):
+        """ Add facts to the base program while they are generated.
+
+        Facts are written into a text buffer that is passed to clingo in chunks,
+        such that no list of all facts must be kept in memory.
+        Returns the number of added facts.
+        """
+        buffer = io.StringIO()
+        num_buffered_facts = 0
+        num_facts = 0
+        for name, arguments in facts:
+            buffer.write(f"{name}({','.join(str(argument) for argument in arguments)}).\n")
+            num_buffered_facts += 1
+            num_facts += 1
+            if num_buffered_facts == FACT_CHUNK_SIZE:
+                self.ctl.add("base", [], buffer.getvalue())
+                buffer = io.StringIO()
+                num_buffered_facts = 0
+        if num_buffered_facts > 0:
+            self.ctl.add("base", [], buffer.getvalue())
+        return num_facts
+
+    def ground(self, facts: List = None):
+        """ Ground the given parametrized facts, e.g., d2_separate parts.
+
+        The base program, including the facts from add_facts, is grounded in the first call.
+        Later calls only ground the given parts and the solver keeps what it learned in previous solve calls.
+        """
+        parts = [] if facts is None else list(facts)
+        if not self.is_base_grounded:
+            parts.append(("base", []))
+            self.is_base_grounded = True
+        self.ctl.ground(parts)
 
     def solve(self):
         """ https://potassco.org/clingo/python-api/current/clingo/solving.html """
@@ -404,6 +437,7 @@ class ASPFactory:
 
     def print_statistics(self):
         print("Clingo statistics:")
+        print("Arguments:", " ".join(self.arguments))
         print(self.ctl.statistics["summary"])
         print("Solution cost:", self.ctl.statistics["summary"]["costs"])  # Note: we add +1 cost to each feature
         print("Total time:", self.ctl.statistics["summary"]["times"]["total"])
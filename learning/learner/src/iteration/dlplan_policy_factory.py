@@ -45,7 +45,7 @@ class ExplicitDlplanPolicyFactory(DlplanPolicyFactory):
         selected_features = set()
         for symbol in symbols:
             if symbol.name == "select":
-                f_idx = symbol.arguments[0].number
+                f_idx = int(iteration_data.asp_f_idx_to_f_idx[symbol.arguments[0].number])
                 selected_features.add(iteration_data.feature_pool[f_idx].dlplan_feature)
         return selected_features
 
@@ -60,7 +60,7 @@ class ExplicitDlplanPolicyFactory(DlplanPolicyFactory):
         for symbol in symbols:
             if symbol.name in {"c_b_pos", "c_b_neg", "c_n_gt", "c_n_eq", "e_b_pos", "e_b_neg", "e_b_bot", "e_n_dec", "e_n_inc", "e_n_bot"}:
                 r_idx = symbol.arguments[0].number
-                f_idx = symbol.arguments[1].number
+                f_idx = int(iteration_data.asp_f_idx_to_f_idx[symbol.arguments[1].number])
                 feature = iteration_data.feature_pool[f_idx].dlplan_feature
                 if feature not in selected_features:
                     continue
@@ -96,27 +96,15 @@ class D2sepDlplanPolicyFactory(DlplanPolicyFactory):
     """
     def make_dlplan_policy_from_answer_set(self, symbols: List[Symbol], preprocessing_data: PreprocessingData, iteration_data: IterationData):
         policy_builder = preprocessing_data.domain_data.policy_builder
-        dlplan_features = set()
+        # Expand the selected features of the ASP encoding to their representatives in the feature pool
+        selected_f_idxs = []
         for symbol in symbols:
             if symbol.name == "select":
-                f_idx = symbol.arguments[0].number
-                dlplan_features.add(iteration_data.feature_pool[f_idx].dlplan_feature)
+                selected_f_idxs.append(int(iteration_data.asp_f_idx_to_f_idx[symbol.arguments[0].number]))
+        selected_f_idxs.sort()
         rules = set()
         for symbol in symbols:
             if symbol.name == "good":
                 r_idx = symbol.arguments[0].number
-                rule = iteration_data.state_pair_equivalences[r_idx]
-                conditions = set()
-                for condition in rule.get_conditions():
-                    f_idx = int(condition.get_named_element().get_key()[1:])
-                    dlplan_feature = iteration_data.feature_pool[f_idx].dlplan_feature
-                    if dlplan_feature in dlplan_features:
-                        conditions.add(condition)
-                effects = set()
-                for effect in rule.get_effects():
-                    f_idx = int(effect.get_named_element().get_key()[1:])
-                    dlplan_feature = iteration_data.feature_pool[f_idx].dlplan_feature
-                    if dlplan_feature in dlplan_features:
-                        effects.add(effect)
-                rules.add(policy_builder.make_rule(conditions, effects))
+                rules.add(iteration_data.state_pair_equivalences.make_rule(policy_builder, iteration_data.feature_pool, r_idx, selected_f_idxs))
         return policy_builder.make_policy(rules)
@@ -1,13 +1,23 @@
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from typing import List, Dict
+from itertools import repeat
+from typing import List, Dict, Tuple
 
+import numpy as np
 import pymimir as mm
+import dlplan.core as dlplan_core
 import dlplan.generator as dlplan_generator
 
 from .feature_pool import Feature
+from .feature_valuations import INFINITY, make_gfa_state_global_idx_to_row
+from .feature_valuations_utils import FEATURE_BATCH_SIZE, evaluate_features, read_cached_valuations
+from .iteration_cache import IterationCache
 from .iteration_data import IterationData
 
-from ..preprocessing import PreprocessingData, StateFinder
+from ..preprocessing import PreprocessingData, StateFinder, ResolvedTupleGraph
+from ..util import profiler, get_worker_data, set_worker_data
 
 
 class FeatureChange(Enum):
@@ -16,9 +26,15 @@ class FeatureChange(Enum):
     BOT = 2
 
 
+class PruningVerdict(Enum):
+    KEEP = 0
+    ZERO = 1
+    SOFT_CHANGES = 2
+
+
 def compute_feature_pool(preprocessing_data: PreprocessingData,
                          iteration_data: IterationData,
-                         gfa_state_id_to_tuple_graph: Dict[int, mm.TupleGraph],
+                         gfa_state_id_to_tuple_graph: Dict[int, ResolvedTupleGraph],
                          state_finder: StateFinder,
                          disable_feature_generation: bool,
                          enable_incomplete_feature_pruning: bool,
@@ -29,7 +45,22 @@ def compute_feature_pool(preprocessing_data: PreprocessingData,
                          distance_numerical_complexity_limit: int,
                          feature_limit: int,
                          additional_booleans: List[str],
-                         additional_numericals: List[str]):
+                         additional_numericals: List[str],
+                         iteration_cache: IterationCache = None,
+                         num_workers: int = 1,
+                         pool: ProcessPoolExecutor = None,
+                         previous_complexity_limit: int = None):
+    """ Generate features and prune those that are never zero, change by more than one,
+    or have the same feature changes on all tuple graph state pairs as a feature of smaller complexity.
+
+    With more than one worker, the features are split into shards that the workers of the pool,
+    see create_worker_pool, evaluate and prune with their own DenotationsCaches.
+    With an IterationCache, the valuations of features that were kept in earlier iterations are reused,
+    also by the workers that receive them with their shards.
+    With a previous_complexity_limit, the feature pool of the iteration data, which was computed for the same states
+    with that limit, is extended by the features of larger complexity only. dlplan generates all features again,
+    but only the new ones are evaluated and pruned against the kept ones.
+    """
     # Get concrete dlplan states of global states
     dlplan_ss_states = set()
     for gfa_state in iteration_data.gfa_states:
@@ -53,19 +84,24 @@ def compute_feature_pool(preprocessing_data: PreprocessingData,
 
     features = []
     if not disable_feature_generation:
-        [generated_booleans, generated_numericals, _, _] = feature_generator.generate(
-            syntactic_element_factory, dlplan_ss_states,
-            concept_complexity_limit,
-            role_complexity_limit,
-            boolean_complexity_limit,
-            count_numerical_complexity_limit,
-            distance_numerical_complexity_limit,
-            2147483647,  # max time limit,
-            feature_limit)
+        with profiler.stage("feature_generation"):
+            [generated_booleans, generated_numericals, _, _] = feature_generator.generate(
+                syntactic_element_factory, dlplan_ss_states,
+                concept_complexity_limit,
+                role_complexity_limit,
+                boolean_complexity_limit,
+                count_numerical_complexity_limit,
+                distance_numerical_complexity_limit,
+                2147483647,  # max time limit,
+                feature_limit)
         for numerical in generated_numericals:
             features.append(Feature(numerical, numerical.compute_complexity() + 1))
         for boolean in generated_booleans:
             features.append(Feature(boolean, boolean.compute_complexity() + 1 + 1))
+    if previous_complexity_limit is not None:
+        # Features up to the previous limit were already generated for the same states, and the additional features are kept from before.
+        features = [feature for feature in features if feature.dlplan_feature.compute_complexity() > previous_complexity_limit]
+        additional_numericals, additional_booleans = [], []
     for numerical in additional_numericals:
         numerical = syntactic_element_factory.parse_numerical(numerical)
         features.append(Feature(numerical, numerical.compute_complexity() + 1))
@@ -73,97 +109,242 @@ def compute_feature_pool(preprocessing_data: PreprocessingData,
         boolean = syntactic_element_factory.parse_boolean(boolean)
         features.append(Feature(boolean, boolean.compute_complexity() + 1 + 1))
     print("Features generated:", len(features))
+    profiler.count("features_generated", len(features))
+
+    gfa_states = iteration_data.gfa_states
+    gfa_state_global_idx_to_row = make_gfa_state_global_idx_to_row(np.array([gfa_state.get_global_index() for gfa_state in gfa_states], dtype=np.int64))
 
-    # Prune features that never reach 0/False
     if enable_incomplete_feature_pruning:
-        selected_features = []
-        for feature in features:
-            always_nnz = True
-            for instance_data in iteration_data.instance_datas:
-                for dlplan_state in instance_data.dlplan_ss.get_states().values():
-                    val = int(feature.dlplan_feature.evaluate(dlplan_state, instance_data.denotations_caches))
-                    if val == 0:
-                        always_nnz = False
-                        break
-            if not always_nnz:
-                selected_features.append(feature)
-        features = selected_features
-        print("Features after 0/1 pruning (incomplete):", len(selected_features))
+        transition_source_rows, transition_target_rows = _compute_transition_rows(preprocessing_data, gfa_states, gfa_state_global_idx_to_row)
+    else:
+        transition_source_rows, transition_target_rows = None, None
+    pair_source_rows, pair_target_rows = _compute_tuple_graph_pair_rows(preprocessing_data, gfa_states, gfa_state_id_to_tuple_graph, gfa_state_global_idx_to_row)
+    pruning_rows = (transition_source_rows, transition_target_rows, pair_source_rows, pair_target_rows)
 
-        # Prune features that decrease by more than 1 on a state transition
-        soft_changing_features = set()
-        for feature in features:
-            is_soft_changing = True
-            for gfa_state in iteration_data.gfa_states:
-                dlplan_source_ss_state = state_finder.get_dlplan_ss_state(gfa_state)
-                instance_idx = gfa_state.get_faithful_abstraction_index()
-                instance_data = preprocessing_data.instance_datas[instance_idx]
-                source_val = int(feature.dlplan_feature.evaluate(dlplan_source_ss_state, instance_data.denotations_caches))
-
-                gfa = instance_data.gfa
-                gfa_state_global_idx = gfa_state.get_global_index()
-                gfa_state_idx = gfa.get_abstract_state_index(gfa_state_global_idx)
-                gfa_states = gfa.get_states()
-                for gfa_state_prime_idx in gfa.get_forward_adjacent_state_indices(gfa_state_idx):
-                    gfa_state_prime = gfa_states[gfa_state_prime_idx]
-                    dlplan_target_ss_state = state_finder.get_dlplan_ss_state(gfa_state_prime)
-                    target_val = int(feature.dlplan_feature.evaluate(dlplan_target_ss_state, instance_data.denotations_caches))
-                    if source_val in {0, 2147483647} or target_val in {0, 2147483647}:
-                        # Allow arbitrary changes on border values
-                        continue
-                    if source_val > target_val and (source_val > target_val + 1):
-                        is_soft_changing = False
-                        break
-                    if target_val > source_val and (target_val > source_val + 1):
-                        is_soft_changing = False
-                        break
-                if not is_soft_changing:
-                    break
-            if is_soft_changing:
-                soft_changing_features.add(feature)
-        features = list(soft_changing_features)
-        print("Features after soft changes pruning (incomplete):", len(features))
+    if num_workers > 1:
+        with profiler.stage("sharded_feature_pruning"):
+            verdicts, keys = _compute_sharded_feature_verdicts(gfa_states, features, pruning_rows, enable_incomplete_feature_pruning, iteration_cache, num_workers, pool)
+    else:
+        verdicts, keys = [], []
+        for begin in range(0, len(features), FEATURE_BATCH_SIZE):
+            batch = features[begin:begin + FEATURE_BATCH_SIZE]
+            with profiler.stage("feature_evaluation"):
+                # Only read from the cache, such that valuations of pruned features are not kept.
+                valuations = evaluate_features(preprocessing_data, gfa_states, batch, iteration_cache, update_cache=False)
+            batch_verdicts, batch_keys = _compute_feature_verdicts(valuations, pruning_rows, enable_incomplete_feature_pruning)
+            verdicts.extend(batch_verdicts)
+            keys.extend(batch_keys)
 
-    # Prune features that do have same feature change a long all state pairs.
-    feature_changes = dict()
-    num_pruned = 0
-    for feature in features:
-        changes = []
-        for gfa_state in iteration_data.gfa_states:
-            instance_idx = gfa_state.get_faithful_abstraction_index()
-            instance_data = preprocessing_data.instance_datas[instance_idx]
-
-            if instance_data.gfa.is_deadend_state(gfa_state.get_faithful_abstract_state_index()):
-                continue
-
-            tuple_graph = gfa_state_id_to_tuple_graph[gfa_state.get_global_index()]
-            tuple_graph_vertices_by_distance = tuple_graph.get_vertices_grouped_by_distance()
-
-            dlplan_source_ss_state = state_finder.get_dlplan_ss_state(gfa_state)
-            source_val = int(feature.dlplan_feature.evaluate(dlplan_source_ss_state, instance_data.denotations_caches))
-
-            for tuple_vertex_group in tuple_graph_vertices_by_distance:
-                for tuple_vertex in tuple_vertex_group:
-                    for mimir_ss_state_prime in tuple_vertex.get_states():
-                        gfa_state_prime = state_finder.get_gfa_state_from_ss_state_idx(instance_idx, instance_data.mimir_ss.get_state_index(mimir_ss_state_prime))
-                        dlplan_target_ss_state = state_finder.get_dlplan_ss_state(gfa_state_prime)
-                        instance_prime_idx = gfa_state_prime.get_faithful_abstraction_index()
-                        instance_data_prime = preprocessing_data.instance_datas[instance_prime_idx]
-                        target_val = int(feature.dlplan_feature.evaluate(dlplan_target_ss_state, instance_data_prime.denotations_caches))
-                        if source_val < target_val:
-                            changes.append(FeatureChange.UP)
-                        elif source_val > target_val:
-                            changes.append(FeatureChange.DOWN)
-                        else:
-                            changes.append(FeatureChange.BOT)
-        existing_feature = feature_changes.get(tuple(changes), None)
-        if existing_feature is None:
-            feature_changes[tuple(changes)] = feature
+    # Merge verdicts in the original order of features, such that the first feature of smallest complexity is kept.
+    num_nnz_pruned = 0
+    num_soft_changes_pruned = 0
+    feature_changes = dict() if previous_complexity_limit is None else dict(iteration_data.feature_changes_to_feature)
+    for feature, verdict, key in zip(features, verdicts, keys):
+        if verdict == PruningVerdict.ZERO.value:
+            num_nnz_pruned += 1
+        elif verdict == PruningVerdict.SOFT_CHANGES.value:
+            num_soft_changes_pruned += 1
         else:
-            if existing_feature.complexity > feature.complexity:
-                feature_changes[tuple(changes)] = feature
-            num_pruned += 1
+            existing_feature = feature_changes.get(key, None)
+            if existing_feature is None or existing_feature.complexity > feature.complexity:
+                feature_changes[key] = feature
+
+    if enable_incomplete_feature_pruning:
+        print("Features after 0/1 pruning (incomplete):", len(features) - num_nnz_pruned)
+        print("Features after soft changes pruning (incomplete):", len(features) - num_nnz_pruned - num_soft_changes_pruned)
+    iteration_data.feature_changes_to_feature = feature_changes
     features = list(feature_changes.values())
     print("Features after relevant changes pruning (complete):", len(features))
+    profiler.count("features_after_pruning", len(features))
 
     return features
+
+
+def compute_feature_representatives(iteration_data: IterationData, enable_goal_separating_features: bool) -> np.ndarray:
+    """ Collapse features that the ASP encoding cannot distinguish into the representative of smallest complexity.
+
+    Features are equivalent if they are of the same type and have the same conditions and effects in all state pair classes,
+    and, with goal separating features, the same boolean valuations in all states.
+    Returns the indices of the representatives in increasing order.
+    """
+    state_pair_classes = iteration_data.state_pair_equivalences
+    columns = [
+        state_pair_classes.conditions.T.astype(np.int8),
+        state_pair_classes.effects.T.astype(np.int8),
+        np.array([[isinstance(feature.dlplan_feature, dlplan_core.Boolean)] for feature in iteration_data.feature_pool], dtype=np.int8).reshape(-1, 1)]
+    if enable_goal_separating_features:
+        columns.append((iteration_data.feature_valuations.valuations.T > 0).astype(np.int8))
+    signatures = np.ascontiguousarray(np.concatenate(columns, axis=1))
+
+    signature_to_f_idx = dict()
+    for f_idx in sorted(range(len(iteration_data.feature_pool)), key=lambda f_idx: (iteration_data.feature_pool[f_idx].complexity, f_idx)):
+        signature_to_f_idx.setdefault(signatures[f_idx].tobytes(), f_idx)
+    return np.array(sorted(signature_to_f_idx.values()), dtype=np.int64)
+
+
+def _compute_feature_verdicts(valuations: np.ndarray,
+                              pruning_rows: Tuple[np.ndarray, ...],
+                              enable_incomplete_feature_pruning: bool) -> Tuple[List[int], List[bytes]]:
+    """ Apply all pruning passes to a batch of features in a single sweep over their valuations.
+
+    Returns the PruningVerdict of each feature and the digest of its feature changes on the tuple graph state pairs,
+    which is None for pruned features.
+    """
+    transition_source_rows, transition_target_rows, pair_source_rows, pair_target_rows = pruning_rows
+    verdicts = np.full(valuations.shape[1], PruningVerdict.KEEP.value, dtype=np.int8)
+
+    if enable_incomplete_feature_pruning:
+        # Prune features that never reach 0/False
+        with profiler.stage("prune_zero"):
+            verdicts[~(valuations == 0).any(axis=0)] = PruningVerdict.ZERO.value
+
+        # Prune features that decrease by more than 1 on a state transition
+        with profiler.stage("prune_soft_changes"):
+            source_vals = valuations[transition_source_rows].astype(np.int64)
+            target_vals = valuations[transition_target_rows].astype(np.int64)
+            # Allow arbitrary changes on border values
+            is_border = (source_vals == 0) | (source_vals == INFINITY) | (target_vals == 0) | (target_vals == INFINITY)
+            is_hard_changing = (np.abs(source_vals - target_vals) > 1) & ~is_border
+            verdicts[is_hard_changing.any(axis=0) & (verdicts == PruningVerdict.KEEP.value)] = PruningVerdict.SOFT_CHANGES.value
+
+    # Prune features that do have same feature change a long all state pairs.
+    with profiler.stage("prune_relevant_changes"):
+        selected = verdicts == PruningVerdict.KEEP.value
+        selected_valuations = valuations[:, selected]
+        changes = _compute_feature_changes(selected_valuations[pair_source_rows], selected_valuations[pair_target_rows])
+        keys = [None] * len(verdicts)
+        for i, feature_changes_row in zip(np.flatnonzero(selected).tolist(), changes):
+            keys[i] = hashlib.blake2b(feature_changes_row.tobytes(), digest_size=16).digest()
+    return verdicts.tolist(), keys
+
+
+def set_up_feature_pruning_workers(preprocessing_data: PreprocessingData):
+    """ Set the data that workers forked afterwards read in _prune_feature_shard. """
+    set_worker_data(preprocessing_data=preprocessing_data)
+
+
+def _prune_feature_shard(shard: List[Tuple[bool, str]],
+                         cached_valuations: Tuple[np.ndarray, np.ndarray],
+                         gfa_state_global_idxs: np.ndarray,
+                         pruning_rows: Tuple[np.ndarray, ...],
+                         enable_incomplete_feature_pruning: bool) -> Tuple[List[int], List[bytes], List[Dict]]:
+    """ Rebuild the features of a shard from their string representation and compute their verdicts.
+
+    Each worker evaluates the valuations that are not given in cached_valuations, see read_cached_valuations,
+    with its own DenotationsCaches.
+    The stages recorded by the worker are returned, such that the parent can merge them into its profiler.
+    """
+    # The profiler of the worker is forked from the parent, hence, it is cleared before recording the stages of this shard.
+    iteration = profiler.iteration
+    profiler.reset()
+    profiler.set_iteration(iteration)
+    with profiler.stage("feature_evaluation"):
+        preprocessing_data = get_worker_data("preprocessing_data")
+        state_finder = preprocessing_data.state_finder
+        syntactic_element_factory = preprocessing_data.domain_data.syntactic_element_factory
+        dlplan_features = [syntactic_element_factory.parse_boolean(representation) if is_boolean else syntactic_element_factory.parse_numerical(representation) for is_boolean, representation in shard]
+        denotations_caches = [dlplan_core.DenotationsCaches() for _ in preprocessing_data.instance_datas]
+        if cached_valuations is None:
+            valuations = np.empty((len(gfa_state_global_idxs), len(dlplan_features)), dtype=np.int32)
+            is_evaluated = np.zeros((len(gfa_state_global_idxs), len(dlplan_features)), dtype=bool)
+        else:
+            valuations, is_evaluated = cached_valuations
+        for row in np.flatnonzero(~is_evaluated.all(axis=1)).tolist():
+            gfa_state_global_idx = int(gfa_state_global_idxs[row])
+            dlplan_ss_state = state_finder.get_dlplan_ss_state_from_global_idx(gfa_state_global_idx)
+            instance_idx = state_finder.get_instance_idx_from_global_idx(gfa_state_global_idx)
+            missing = np.flatnonzero(~is_evaluated[row])
+            valuations[row, missing] = np.fromiter(
+                (dlplan_features[j].evaluate(dlplan_ss_state, denotations_caches[instance_idx]) for j in missing.tolist()),
+                dtype=np.int32, count=len(missing))
+    verdicts, keys = _compute_feature_verdicts(valuations, pruning_rows, enable_incomplete_feature_pruning)
+    return verdicts, keys, profiler.to_dict()["stages"]
+
+
+def _compute_sharded_feature_verdicts(gfa_states: List[mm.GlobalFaithfulAbstractState],
+                                      features: List[Feature],
+                                      pruning_rows: Tuple[np.ndarray, ...],
+                                      enable_incomplete_feature_pruning: bool,
+                                      iteration_cache: IterationCache,
+                                      num_workers: int,
+                                      pool: ProcessPoolExecutor) -> Tuple[List[int], List[bytes]]:
+    """ Split the features into shards that are pruned by the workers of the pool and concatenate the verdicts in order.
+
+    The workers are forked before the IterationCache is filled, hence, the cached valuations of the features
+    of each shard are passed with the shard and only shards with cached features carry them.
+    The stages recorded in the workers are merged into the profiler, their wall and CPU times add up over all workers.
+    """
+    # dlplan features and states cannot be pickled, hence, shards consist of string representations and global indices.
+    representations = [(isinstance(feature.dlplan_feature, dlplan_core.Boolean), str(feature.dlplan_feature)) for feature in features]
+    gfa_state_global_idxs = np.array([gfa_state.get_global_index() for gfa_state in gfa_states], dtype=np.int64)
+    shard_size = max(1, min(FEATURE_BATCH_SIZE, -(-len(representations) // num_workers)))
+    shards = [representations[begin:begin + shard_size] for begin in range(0, len(representations), shard_size)]
+    cached_valuations = [None] * len(shards)
+    if iteration_cache is not None:
+        for i, shard in enumerate(shards):
+            feature_keys = [representation for _, representation in shard]
+            if (iteration_cache.find_columns(feature_keys) >= 0).any():
+                cached_valuations[i] = read_cached_valuations(iteration_cache, gfa_state_global_idxs.tolist(), feature_keys)
+    verdicts, keys = [], []
+    for shard_verdicts, shard_keys, shard_stages in pool.map(_prune_feature_shard, shards, cached_valuations, repeat(gfa_state_global_idxs), repeat(pruning_rows), repeat(enable_incomplete_feature_pruning)):
+        verdicts.extend(shard_verdicts)
+        keys.extend(shard_keys)
+        profiler.merge_stages(shard_stages)
+    return verdicts, keys
+
+
+def _compute_feature_changes(source_valuations: np.ndarray, target_valuations: np.ndarray) -> np.ndarray:
+    """ Compute the FeatureChange of each feature on each state pair.
+
+    Returns a C-contiguous matrix with a row for each feature and a column for each state pair.
+    """
+    changes = np.full(source_valuations.shape, FeatureChange.BOT.value, dtype=np.int8)
+    changes[source_valuations < target_valuations] = FeatureChange.UP.value
+    changes[source_valuations > target_valuations] = FeatureChange.DOWN.value
+    return np.ascontiguousarray(changes.T)
+
+
+def _compute_transition_rows(preprocessing_data: PreprocessingData,
+                             gfa_states: List[mm.GlobalFaithfulAbstractState],
+                             gfa_state_global_idx_to_row: np.ndarray):
+    """ Collect the rows of source and target of all forward transitions between global faithful abstract states.
+    """
+    source_global_idxs = []
+    target_global_idxs = []
+    for gfa_state in gfa_states:
+        instance_data = preprocessing_data.instance_datas[gfa_state.get_faithful_abstraction_index()]
+        gfa = instance_data.gfa
+        gfa_state_global_idx = gfa_state.get_global_index()
+        gfa_state_idx = gfa.get_abstract_state_index(gfa_state_global_idx)
+        instance_gfa_states = gfa.get_states()
+        for gfa_state_prime_idx in gfa.get_forward_adjacent_state_indices(gfa_state_idx):
+            source_global_idxs.append(gfa_state_global_idx)
+            target_global_idxs.append(instance_gfa_states[gfa_state_prime_idx].get_global_index())
+    return gfa_state_global_idx_to_row[np.array(source_global_idxs, dtype=np.int64)], gfa_state_global_idx_to_row[np.array(target_global_idxs, dtype=np.int64)]
+
+
+def _compute_tuple_graph_pair_rows(preprocessing_data: PreprocessingData,
+                                   gfa_states: List[mm.GlobalFaithfulAbstractState],
+                                   gfa_state_global_idx_to_tuple_graph: Dict[int, ResolvedTupleGraph],
+                                   gfa_state_global_idx_to_row: np.ndarray):
+    """ Collect the rows of source and target of all state pairs in the tuple graphs of alive global faithful abstract states.
+    """
+    source_global_idxs = []
+    target_global_idxs = []
+    for gfa_state in gfa_states:
+        instance_idx = gfa_state.get_faithful_abstraction_index()
+        instance_data = preprocessing_data.instance_datas[instance_idx]
+
+        if instance_data.gfa.is_deadend_state(gfa_state.get_faithful_abstract_state_index()):
+            continue
+
+        gfa_state_global_idx = gfa_state.get_global_index()
+        tuple_graph = gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
+        for t_idxs in tuple_graph.t_idxs_by_distance:
+            for t_idx in t_idxs.tolist():
+                gfa_state_prime_global_idxs = tuple_graph.t_idx_to_gfa_state_global_idxs[t_idx]
+                source_global_idxs.append(np.full(len(gfa_state_prime_global_idxs), gfa_state_global_idx, dtype=np.int64))
+                target_global_idxs.append(gfa_state_prime_global_idxs)
+    if not source_global_idxs:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return gfa_state_global_idx_to_row[np.concatenate(source_global_idxs)], gfa_state_global_idx_to_row[np.concatenate(target_global_idxs)]
@@ -0,0 +1,51 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+# dlplan evaluates undefined numericals, e.g., unreachable distances, to the maximum int.
+INFINITY = np.iinfo(np.int32).max
+
+
+@dataclass
+class FeatureValuations:
+    """
+    FeatureValuations stores the valuations of the feature pool F
+    on all global faithful abstract states of an iteration in a dense matrix.
+
+    Rows correspond to global faithful abstract states and columns to features in F.
+    Booleans are stored as 0/1 and undefined numericals as INFINITY.
+    """
+    _gfa_state_global_idxs: np.ndarray
+    _gfa_state_global_idx_to_row: np.ndarray
+    _valuations: np.ndarray
+
+    @property
+    def gfa_state_global_idxs(self):
+        return self._gfa_state_global_idxs
+
+    @property
+    def gfa_state_global_idx_to_row(self):
+        return self._gfa_state_global_idx_to_row
+
+    @property
+    def valuations(self):
+        return self._valuations
+
+    def get_rows(self, gfa_state_global_idxs: np.ndarray) -> np.ndarray:
+        """ Get the row indices of the given global faithful abstract states.
+        """
+        return self._gfa_state_global_idx_to_row[gfa_state_global_idxs]
+
+    def get_valuations(self, gfa_state_global_idx: int) -> np.ndarray:
+        """ Get the valuations of all features in the global faithful abstract state.
+        """
+        return self._valuations[self._gfa_state_global_idx_to_row[gfa_state_global_idx]]
+
+
+def make_gfa_state_global_idx_to_row(gfa_state_global_idxs: np.ndarray) -> np.ndarray:
+    """ Invert the given row to global index mapping, missing global indices map to -1.
+    """
+    gfa_state_global_idx_to_row = np.full(int(gfa_state_global_idxs.max(initial=-1)) + 1, -1, dtype=np.int64)
+    gfa_state_global_idx_to_row[gfa_state_global_idxs] = np.arange(len(gfa_state_global_idxs), dtype=np.int64)
+    return gfa_state_global_idx_to_row
@@ -1,24 +1,103 @@
-from typing import List, Dict, Union
+from typing import List, Tuple
 
+import numpy as np
+import pymimir as mm
+
+from .feature_pool import Feature
+from .feature_valuations import FeatureValuations, make_gfa_state_global_idx_to_row
+from .iteration_cache import IterationCache
 from .iteration_data import IterationData
 
 from ..preprocessing import PreprocessingData
 
 
+# Number of features that are evaluated together on all states.
+FEATURE_BATCH_SIZE = 1000
+
+
+def evaluate_features(
+        preprocessing_data: PreprocessingData,
+        gfa_states: List[mm.GlobalFaithfulAbstractState],
+        features: List[Feature],
+        iteration_cache: IterationCache = None,
+        update_cache: bool = True) -> np.ndarray:
+    """ Evaluate features on representative concrete states of the given global faithful abstract states.
+
+    Returns a matrix with a row for each state and a column for each feature.
+    With an IterationCache, only valuations that were not computed in earlier iterations are evaluated,
+    and the new valuations are added to the cache if update_cache is set.
+    """
+    if iteration_cache is not None:
+        return _evaluate_features_incrementally(preprocessing_data, gfa_states, features, iteration_cache, update_cache)
+
+    dlplan_ss_states_and_caches = []
+    for gfa_state in gfa_states:
+        instance_data = preprocessing_data.instance_datas[gfa_state.get_faithful_abstraction_index()]
+        dlplan_ss_states_and_caches.append((preprocessing_data.state_finder.get_dlplan_ss_state(gfa_state), instance_data.denotations_caches))
+
+    valuations = np.empty((len(gfa_states), len(features)), dtype=np.int32)
+    for begin in range(0, len(features), FEATURE_BATCH_SIZE):
+        dlplan_features = [feature.dlplan_feature for feature in features[begin:begin + FEATURE_BATCH_SIZE]]
+        end = begin + len(dlplan_features)
+        for row, (dlplan_ss_state, denotations_caches) in enumerate(dlplan_ss_states_and_caches):
+            valuations[row, begin:end] = np.fromiter(
+                (dlplan_feature.evaluate(dlplan_ss_state, denotations_caches) for dlplan_feature in dlplan_features),
+                dtype=np.int32, count=len(dlplan_features))
+    return valuations
+
+
+def read_cached_valuations(
+        iteration_cache: IterationCache,
+        gfa_state_global_idxs: List[int],
+        feature_keys: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """ Read the cached valuations of the given global indices and feature strings.
+
+    Returns the valuations and whether each valuation is evaluated, which is False for entries without a row or column.
+    """
+    rows = iteration_cache.find_rows(gfa_state_global_idxs)
+    columns = iteration_cache.find_columns(feature_keys)
+    cached_rows, cached_columns = np.flatnonzero(rows >= 0), np.flatnonzero(columns >= 0)
+    valuations = np.empty((len(gfa_state_global_idxs), len(feature_keys)), dtype=np.int32)
+    is_evaluated = np.zeros((len(gfa_state_global_idxs), len(feature_keys)), dtype=bool)
+    valuations[np.ix_(cached_rows, cached_columns)] = iteration_cache.valuations[np.ix_(rows[cached_rows], columns[cached_columns])]
+    is_evaluated[np.ix_(cached_rows, cached_columns)] = iteration_cache.is_evaluated[np.ix_(rows[cached_rows], columns[cached_columns])]
+    return valuations, is_evaluated
+
+
+def _evaluate_features_incrementally(
+        preprocessing_data: PreprocessingData,
+        gfa_states: List[mm.GlobalFaithfulAbstractState],
+        features: List[Feature],
+        iteration_cache: IterationCache,
+        update_cache: bool) -> np.ndarray:
+    gfa_state_global_idxs = [gfa_state.get_global_index() for gfa_state in gfa_states]
+    feature_keys = [str(feature.dlplan_feature) for feature in features]
+    if update_cache:
+        iteration_cache.reserve(gfa_state_global_idxs, feature_keys)
+    valuations, is_evaluated = read_cached_valuations(iteration_cache, gfa_state_global_idxs, feature_keys)
+    rows = iteration_cache.find_rows(gfa_state_global_idxs)
+    columns = iteration_cache.find_columns(feature_keys)
+    for i in np.flatnonzero(~is_evaluated.all(axis=1)).tolist():
+        gfa_state = gfa_states[i]
+        dlplan_ss_state = preprocessing_data.state_finder.get_dlplan_ss_state(gfa_state)
+        denotations_caches = preprocessing_data.instance_datas[gfa_state.get_faithful_abstraction_index()].denotations_caches
+        missing = np.flatnonzero(~is_evaluated[i])
+        valuations[i, missing] = np.fromiter(
+            (features[j].dlplan_feature.evaluate(dlplan_ss_state, denotations_caches) for j in missing.tolist()),
+            dtype=np.int32, count=len(missing))
+        if update_cache:
+            iteration_cache.valuations[rows[i], columns[missing]] = valuations[i, missing]
+            iteration_cache.is_evaluated[rows[i], columns[missing]] = True
+    return valuations
+
+
 def compute_per_state_feature_valuations(
         preprocessing_data: PreprocessingData,
-        iteration_data: IterationData) -> None:
+        iteration_data: IterationData,
+        iteration_cache: IterationCache = None) -> FeatureValuations:
     """ Evaluate features on representative concrete state of all global faithful abstract states.
     """
-    gfa_state_global_idx_to_feature_evaluations: Dict[int, List[Union[bool, int]]] = dict()
-    for gfa_state in iteration_data.gfa_states:
-        instance_idx = gfa_state.get_faithful_abstraction_index()
-        instance_data = preprocessing_data.instance_datas[instance_idx]
-        dlplan_ss_state = preprocessing_data.state_finder.get_dlplan_ss_state(gfa_state)
-        global_state_global_idx = gfa_state.get_global_index()
-        state_feature_valuations: List[Union[bool, int]] = []
-        for feature in iteration_data.feature_pool:
-            state_feature_valuations.append(feature.dlplan_feature.evaluate(dlplan_ss_state, instance_data.denotations_caches))
-        gfa_state_global_idx_to_feature_evaluations[global_state_global_idx] = state_feature_valuations
+    gfa_state_global_idxs = np.array([gfa_state.get_global_index() for gfa_state in iteration_data.gfa_states], dtype=np.int64)
+    valuations = evaluate_features(preprocessing_data, iteration_data.gfa_states, iteration_data.feature_pool, iteration_cache)
 
-    return gfa_state_global_idx_to_feature_evaluations
\ No newline at end of file
+    return FeatureValuations(gfa_state_global_idxs, make_gfa_state_global_idx_to_row(gfa_state_global_idxs), valuations)
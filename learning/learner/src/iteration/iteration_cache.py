@@ -0,0 +1,93 @@
+from dataclasses import dataclass, field
+from typing import List, Dict, Set, Tuple
+
+import numpy as np
+
+from .state_pair_equivalence import StatePairEquivalence
+from .tuple_graph_equivalence import TupleGraphEquivalence
+
+
+# Maximum number of cached valuations, i.e., 4 bytes for the valuation and 1 byte for whether it is evaluated.
+MAX_NUM_CACHED_VALUATIONS = 50000000
+
+
+@dataclass
+class IterationCache:
+    """
+    Store data that is kept across iterations of learning sketches,
+    such that later iterations only process newly selected global faithful abstract states.
+
+    Feature valuations are keyed by the feature string and the global index.
+    Only valuations of features in the feature pool are cached, not those of features that are pruned.
+    State pair equivalences and tuple graph equivalences of each state are stored
+    with cached rule indices that are remapped to the rules of each iteration.
+    When the feature pool changes, the rules are remapped to the new pool by feature identity.
+    """
+    # Feature valuations, rows correspond to global indices and columns to features.
+    gfa_state_global_idx_to_row: Dict[int, int] = field(default_factory=dict)
+    feature_key_to_column: Dict[str, int] = field(default_factory=dict)
+    valuations: np.ndarray = field(default_factory=lambda: np.zeros((0, 0), dtype=np.int32))
+    is_evaluated: np.ndarray = field(default_factory=lambda: np.zeros((0, 0), dtype=bool))
+
+    # Rules over the feature pool with key feature_pool_key.
+    feature_pool_key: Tuple[str, ...] = None
+    conditions: List[np.ndarray] = field(default_factory=list)
+    effects: List[np.ndarray] = field(default_factory=list)
+    signature_to_r_idx: Dict[bytes, int] = field(default_factory=dict)
+    gfa_state_global_idx_to_state_pair_equivalence: Dict[int, StatePairEquivalence] = field(default_factory=dict)
+    gfa_state_global_idx_to_tuple_graph_equivalence: Dict[int, TupleGraphEquivalence] = field(default_factory=dict)
+    # Maps cached rule indices to rule indices of the current iteration, -1 if unused.
+    r_idx_to_iteration_r_idx: np.ndarray = None
+
+    def find_rows(self, gfa_state_global_idxs: List[int]) -> np.ndarray:
+        """ Get the rows of the given global indices, -1 for global indices without a row. """
+        return np.array([self.gfa_state_global_idx_to_row.get(gfa_state_global_idx, -1) for gfa_state_global_idx in gfa_state_global_idxs], dtype=np.int64)
+
+    def find_columns(self, feature_keys: List[str]) -> np.ndarray:
+        """ Get the columns of the given feature strings, -1 for features without a column. """
+        return np.array([self.feature_key_to_column.get(feature_key, -1) for feature_key in feature_keys], dtype=np.int64)
+
+    def reserve(self, gfa_state_global_idxs: List[int], feature_keys: List[str]):
+        """ Add rows and columns for the given global indices and feature strings.
+
+        If the valuation matrices would hold more than MAX_NUM_CACHED_VALUATIONS entries,
+        the rows and columns of all other global indices and features are evicted first.
+        """
+        num_new_rows = len(set(gfa_state_global_idx for gfa_state_global_idx in gfa_state_global_idxs if gfa_state_global_idx not in self.gfa_state_global_idx_to_row))
+        num_new_columns = len(set(feature_key for feature_key in feature_keys if feature_key not in self.feature_key_to_column))
+        if (len(self.gfa_state_global_idx_to_row) + num_new_rows) * (len(self.feature_key_to_column) + num_new_columns) > MAX_NUM_CACHED_VALUATIONS:
+            self._evict(set(gfa_state_global_idxs), set(feature_keys))
+        for gfa_state_global_idx in gfa_state_global_idxs:
+            if gfa_state_global_idx not in self.gfa_state_global_idx_to_row:
+                self.gfa_state_global_idx_to_row[gfa_state_global_idx] = len(self.gfa_state_global_idx_to_row)
+        for feature_key in feature_keys:
+            if feature_key not in self.feature_key_to_column:
+                self.feature_key_to_column[feature_key] = len(self.feature_key_to_column)
+        self._grow()
+
+    def _evict(self, kept_gfa_state_global_idxs: Set[int], kept_feature_keys: Set[str]):
+        """ Keep only the rows and columns of the given global indices and feature strings. """
+        kept_rows = [(gfa_state_global_idx, row) for gfa_state_global_idx, row in self.gfa_state_global_idx_to_row.items() if gfa_state_global_idx in kept_gfa_state_global_idxs]
+        kept_columns = [(feature_key, column) for feature_key, column in self.feature_key_to_column.items() if feature_key in kept_feature_keys]
+        selection = np.ix_(np.array([row for _, row in kept_rows], dtype=np.int64), np.array([column for _, column in kept_columns], dtype=np.int64))
+        self.valuations = self.valuations[selection]
+        self.is_evaluated = self.is_evaluated[selection]
+        self.gfa_state_global_idx_to_row = {gfa_state_global_idx: row for row, (gfa_state_global_idx, _) in enumerate(kept_rows)}
+        self.feature_key_to_column = {feature_key: column for column, (feature_key, _) in enumerate(kept_columns)}
+
+    def _grow(self):
+        """ Grow each dimension of the valuation matrices geometrically if it is too small for its rows or columns. """
+        num_rows, num_columns = len(self.gfa_state_global_idx_to_row), len(self.feature_key_to_column)
+        capacity_rows, capacity_columns = self.valuations.shape
+        if num_rows <= capacity_rows and num_columns <= capacity_columns:
+            return
+        if num_rows > capacity_rows:
+            capacity_rows = max(num_rows, 2 * capacity_rows)
+        if num_columns > capacity_columns:
+            capacity_columns = max(num_columns, 2 * capacity_columns)
+        valuations = np.zeros((capacity_rows, capacity_columns), dtype=np.int32)
+        valuations[:self.valuations.shape[0], :self.valuations.shape[1]] = self.valuations
+        is_evaluated = np.zeros((capacity_rows, capacity_columns), dtype=bool)
+        is_evaluated[:self.is_evaluated.shape[0], :self.is_evaluated.shape[1]] = self.is_evaluated
+        self.valuations = valuations
+        self.is_evaluated = is_evaluated
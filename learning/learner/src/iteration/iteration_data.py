@@ -1,10 +1,12 @@
 from dataclasses import dataclass
-from typing import List, Dict, Union
+from typing import List, Dict
 
+import numpy as np
 import pymimir as mm
-import dlplan.policy as dlplan_policy
 
 from .feature_pool import Feature
+from .feature_valuations import FeatureValuations
+from .state_pair_classes import StatePairClasses
 from .state_pair_equivalence import StatePairEquivalence
 from .tuple_graph_equivalence import TupleGraphEquivalence
 
@@ -20,9 +22,14 @@ class IterationData:
     gfa_states: List[mm.GlobalFaithfulAbstractState] = None
 
     feature_pool: List[Feature] = None
-    gfa_state_global_idx_to_feature_evaluations: Dict[int, List[Union[bool, int]]] = None
+    # Maps the digest of the feature changes on the tuple graph state pairs to the feature kept in the feature pool.
+    feature_changes_to_feature: Dict[bytes, Feature] = None
+    feature_valuations: FeatureValuations = None
 
-    state_pair_equivalences: List[dlplan_policy.Rule] = None
+    state_pair_equivalences: StatePairClasses = None
     gfa_state_global_idx_to_state_pair_equivalence: Dict[int, StatePairEquivalence] = None
 
     gfa_state_global_idx_to_tuple_graph_equivalence: Dict[int, TupleGraphEquivalence] = None
+
+    # Maps features in the ASP encoding to the representatives of equivalent features in the feature pool.
+    asp_f_idx_to_f_idx: np.ndarray = None
@@ -1,8 +1,9 @@
 import math
+import operator
 
 from collections import defaultdict, deque
 from termcolor import colored
-from typing import Dict, List, Deque, MutableSet
+from typing import Dict, List, Deque, MutableSet, Tuple
 
 import pymimir as mm
 import dlplan.core as dlplan_core
@@ -13,11 +14,73 @@ from .iteration_data import IterationData
 from ..preprocessing import PreprocessingData, InstanceData
 
 
+# Checks of conditions on the source value and effects on the source and target values.
+_CONDITION_CHECKS = {
+    dlplan_policy.PositiveBooleanCondition: lambda source: source > 0,
+    dlplan_policy.NegativeBooleanCondition: lambda source: source == 0,
+    dlplan_policy.GreaterNumericalCondition: lambda source: source > 0,
+    dlplan_policy.EqualNumericalCondition: lambda source: source == 0,
+}
+_EFFECT_CHECKS = {
+    dlplan_policy.PositiveBooleanEffect: lambda source, target: target > 0,
+    dlplan_policy.NegativeBooleanEffect: lambda source, target: target == 0,
+    dlplan_policy.UnchangedBooleanEffect: operator.eq,
+    dlplan_policy.IncrementNumericalEffect: operator.lt,
+    dlplan_policy.DecrementNumericalEffect: operator.gt,
+    dlplan_policy.UnchangedNumericalEffect: operator.eq,
+}
+
+
+def _get_check(checks, element):
+    for element_type, check in checks.items():
+        if isinstance(element, element_type):
+            return check
+    raise RuntimeError(f"Cannot parse {str(element)}")
+
+
 class Sketch:
     def __init__(self, dlplan_policy: dlplan_policy.Policy, width: int):
         self.dlplan_policy = dlplan_policy
         self.width = width
 
+        # Verification cache that is valid as long as the sketch does not change.
+        # Selected features are evaluated once per global faithful abstract state
+        # and rules are checked on the resulting values instead of dlplan states.
+        self._named_features = list(dlplan_policy.get_booleans()) + list(dlplan_policy.get_numericals())
+        key_to_pos = {named_feature.get_key(): pos for pos, named_feature in enumerate(self._named_features)}
+        self._rules = []
+        for rule in dlplan_policy.get_rules():
+            conditions = [(key_to_pos[condition.get_named_element().get_key()], _get_check(_CONDITION_CHECKS, condition)) for condition in rule.get_conditions()]
+            effects = [(key_to_pos[effect.get_named_element().get_key()], _get_check(_EFFECT_CHECKS, effect)) for effect in rule.get_effects()]
+            self._rules.append((conditions, effects))
+        self._gfa_state_global_idx_to_values: Dict[int, Tuple[int, ...]] = dict()
+        self._gfa_state_global_idx_pair_to_compatible: Dict[Tuple[int, int], bool] = dict()
+
+    def _get_values(self, preprocessing_data: PreprocessingData, gfa_state_global_idx: int) -> Tuple[int, ...]:
+        """ Get the values of the selected features in the representative state of the global faithful abstract state, booleans are 0/1. """
+        values = self._gfa_state_global_idx_to_values.get(gfa_state_global_idx)
+        if values is None:
+            state_finder = preprocessing_data.state_finder
+            dlplan_ss_state = state_finder.get_dlplan_ss_state_from_global_idx(gfa_state_global_idx)
+            denotations_caches = preprocessing_data.instance_datas[state_finder.get_instance_idx_from_global_idx(gfa_state_global_idx)].denotations_caches
+            values = tuple(int(named_feature.get_element().evaluate(dlplan_ss_state, denotations_caches)) for named_feature in self._named_features)
+            self._gfa_state_global_idx_to_values[gfa_state_global_idx] = values
+        return values
+
+    def _is_compatible(self, preprocessing_data: PreprocessingData, gfa_root_global_idx: int, gfa_state_prime_global_idx: int) -> bool:
+        """ Returns True iff some rule of the sketch is compatible with the state pair given by global indices. """
+        key = (gfa_root_global_idx, gfa_state_prime_global_idx)
+        compatible = self._gfa_state_global_idx_pair_to_compatible.get(key)
+        if compatible is None:
+            source_values = self._get_values(preprocessing_data, gfa_root_global_idx)
+            target_values = self._get_values(preprocessing_data, gfa_state_prime_global_idx)
+            compatible = any(
+                all(check(source_values[pos]) for pos, check in conditions) and
+                all(check(source_values[pos], target_values[pos]) for pos, check in effects)
+                for conditions, effects in self._rules)
+            self._gfa_state_global_idx_pair_to_compatible[key] = compatible
+        return compatible
+
     def _verify_bounded_width(self,
                               preprocessing_data: PreprocessingData,
                               iteration_data: IterationData,
@@ -58,43 +121,30 @@ class Sketch:
                 continue
 
             tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_root_global_idx]
-            tuple_graph_vertices_by_distance = tuple_graph.get_vertices_grouped_by_distance()
-            tuple_graph_states_by_distance = tuple_graph.get_states_grouped_by_distance()
-
-            dlplan_ss_root = preprocessing_data.state_finder.get_dlplan_ss_state(gfa_root)
 
             ḧas_bounded_width = False
             min_compatible_distance = math.inf
 
-            mapped_instance_idx = gfa_root.get_faithful_abstraction_index()
-            mapped_instance_data = preprocessing_data.instance_datas[mapped_instance_idx]
+            for s_distance, t_idxs in enumerate(tuple_graph.t_idxs_by_distance):
+                for mapped_gfa_state_prime_global_idx in tuple_graph.gfa_state_global_idxs_by_distance[s_distance].tolist():
 
-            for s_distance, tuple_vertex_group in enumerate(tuple_graph_vertices_by_distance):
-                for mimir_ss_state_prime in tuple_graph_states_by_distance[s_distance]:
-                    mapped_gfa_state_prime = preprocessing_data.state_finder.get_gfa_state_from_ss_state_idx(mapped_instance_idx, mapped_instance_data.mimir_ss.get_state_index(mimir_ss_state_prime))
-                    mapped_gfa_state_prime_global_idx = mapped_gfa_state_prime.get_global_index()
-                    dlplan_ss_state_prime = preprocessing_data.state_finder.get_dlplan_ss_state(mapped_gfa_state_prime)
-
-                    if self.dlplan_policy.evaluate(dlplan_ss_root, dlplan_ss_state_prime, instance_data.denotations_caches) is not None:
+                    if self._is_compatible(preprocessing_data, gfa_root_global_idx, mapped_gfa_state_prime_global_idx):
                         min_compatible_distance = min(min_compatible_distance, s_distance)
                         subgoal_states_per_r_reachable_state[gfa_root_global_idx].add(mapped_gfa_state_prime_global_idx)
                         # Important: unmap the mapped gfa state to the original instance_data.gfa
                         # since the goal is to check whether sketch solves the given instance_data.
-                        unmapped_gfa_state_prime_idx = instance_data.gfa.get_abstract_state_index(mapped_gfa_state_prime.get_global_index())
+                        unmapped_gfa_state_prime_idx = instance_data.gfa.get_abstract_state_index(mapped_gfa_state_prime_global_idx)
                         if unmapped_gfa_state_prime_idx not in visited:
                             visited.add(unmapped_gfa_state_prime_idx)
                             queue.append(unmapped_gfa_state_prime_idx)
 
                 # Check whether there exists a subgoal tuple for which all underlying states are subgoal states
                 found_subgoal_tuple = False
-                for tuple_vertex in tuple_vertex_group:
+                for t_idx in t_idxs.tolist():
                     is_subgoal_tuple = True
-                    for mimir_ss_state_prime in tuple_vertex.get_states():
-                        mapped_gfa_state_prime = preprocessing_data.state_finder.get_gfa_state_from_ss_state_idx(mapped_instance_idx, mapped_instance_data.mimir_ss.get_state_index(mimir_ss_state_prime))
-                        mapped_gfa_state_prime_global_idx = mapped_gfa_state_prime.get_global_index()
-                        dlplan_ss_state_prime = preprocessing_data.state_finder.get_dlplan_ss_state(mapped_gfa_state_prime)
+                    for mapped_gfa_state_prime_global_idx in tuple_graph.t_idx_to_gfa_state_global_idxs[t_idx].tolist():
 
-                        if self.dlplan_policy.evaluate(dlplan_ss_root, dlplan_ss_state_prime, instance_data.denotations_caches) is not None:
+                        if self._is_compatible(preprocessing_data, gfa_root_global_idx, mapped_gfa_state_prime_global_idx):
                             min_compatible_distance = min(min_compatible_distance, s_distance)
                             subgoal_states_per_r_reachable_state[gfa_root_global_idx].add(mapped_gfa_state_prime_global_idx)
                         else:
@@ -119,7 +169,7 @@ class Sketch:
                 print(instance_data.instance_filepath)
                 print("Instance:", instance_data.idx)
                 print("Source_state:", gfa_root_global_idx)
-                print("Dlplan state:", str(dlplan_ss_root))
+                print("Dlplan state:", str(preprocessing_data.state_finder.get_dlplan_ss_state(gfa_root)))
                 return False, []
 
         print("Sketch solves:", instance_data.mimir_ss.get_problem().get_filepath())
@@ -158,9 +208,6 @@ class Sketch:
                     stack.pop(-1)
         return True
 
-    def _compute_state_b_values(self, booleans: List[dlplan_policy.NamedBoolean], numericals: List[dlplan_policy.NamedNumerical], state: dlplan_core.State, denotations_caches: dlplan_core.DenotationsCaches):
-        return tuple([boolean.get_element().evaluate(state, denotations_caches) for boolean in booleans] + [numerical.get_element().evaluate(state, denotations_caches) > 0 for numerical in numericals])
-
     def _verify_goal_separating_features(self,
                                          preprocessing_data: PreprocessingData,
                                          iteration_data: IterationData,
@@ -170,13 +217,8 @@ class Sketch:
         """
         goal_b_values = set()
         nongoal_b_values = set()
-        booleans = self.dlplan_policy.get_booleans()
-        numericals = self.dlplan_policy.get_numericals()
         for gfa_state_idx, gfa_state in enumerate(instance_data.gfa.get_states()):
-            new_instance_idx = gfa_state.get_abstraction_index()
-            new_instance_data = preprocessing_data.instance_datas[new_instance_idx]
-            dlplan_ss_state = preprocessing_data.state_finder.get_dlplan_ss_state(gfa_state)
-            b_values = self._compute_state_b_values(booleans, numericals, dlplan_ss_state, new_instance_data.denotations_caches)
+            b_values = tuple(value > 0 for value in self._get_values(preprocessing_data, gfa_state.get_global_index()))
             separating = True
             if instance_data.gfa.is_goal_state(gfa_state_idx):
                 goal_b_values.add(b_values)
@@ -189,7 +231,7 @@ class Sketch:
             if not separating:
                 print("Features do not separate goals from non goals")
                 print("Booleans:")
-                print("State:", str(dlplan_ss_state))
+                print("State:", str(preprocessing_data.state_finder.get_dlplan_ss_state(gfa_state)))
                 print("b_values:", b_values)
                 return False
         return True
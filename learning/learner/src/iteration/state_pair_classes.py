@@ -0,0 +1,66 @@
+from dataclasses import dataclass
+from typing import List, Iterable
+
+import numpy as np
+import dlplan.core as dlplan_core
+import dlplan.policy as dlplan_policy
+
+from .feature_pool import Feature
+
+
+@dataclass
+class StatePairClasses:
+    """
+    Immutable data class.
+
+    StatePairClasses stores the rules over the feature pool F that classify state pairs.
+
+    Row r_idx of conditions holds whether each feature is positive in the source state,
+    and row r_idx of effects holds the sign of its change from the source to the target state.
+    dlplan Rules are only constructed for the classes that are needed.
+    """
+    _conditions: np.ndarray
+    _effects: np.ndarray
+
+    @property
+    def conditions(self):
+        return self._conditions
+
+    @property
+    def effects(self):
+        return self._effects
+
+    def __len__(self):
+        return len(self._conditions)
+
+    def make_rule(self,
+                  policy_builder: dlplan_policy.PolicyFactory,
+                  feature_pool: List[Feature],
+                  r_idx: int,
+                  f_idxs: Iterable[int]) -> dlplan_policy.Rule:
+        """ Create the rule of class r_idx restricted to the given features. """
+        conditions = set()
+        effects = set()
+        for f_idx in f_idxs:
+            condition = self._conditions[r_idx, f_idx]
+            effect = self._effects[r_idx, f_idx]
+            dlplan_feature = feature_pool[f_idx].dlplan_feature
+            if isinstance(dlplan_feature, dlplan_core.Boolean):
+                boolean = policy_builder.make_boolean(f"f{f_idx}", dlplan_feature)
+                conditions.add(policy_builder.make_pos_condition(boolean) if condition else policy_builder.make_neg_condition(boolean))
+                if effect > 0:
+                    effects.add(policy_builder.make_pos_effect(boolean))
+                elif effect < 0:
+                    effects.add(policy_builder.make_neg_effect(boolean))
+                else:
+                    effects.add(policy_builder.make_bot_effect(boolean))
+            elif isinstance(dlplan_feature, dlplan_core.Numerical):
+                numerical = policy_builder.make_numerical(f"f{f_idx}", dlplan_feature)
+                conditions.add(policy_builder.make_gt_condition(numerical) if condition else policy_builder.make_eq_condition(numerical))
+                if effect > 0:
+                    effects.add(policy_builder.make_inc_effect(numerical))
+                elif effect < 0:
+                    effects.add(policy_builder.make_dec_effect(numerical))
+                else:
+                    effects.add(policy_builder.make_bot_effect(numerical))
+        return policy_builder.make_rule(conditions, effects)
@@ -1,66 +1,178 @@
 import math
 
+import numpy as np
+
 from collections import defaultdict
 from typing import List, Dict
 
-import dlplan.core as dlplan_core
-import dlplan.policy as dlplan_policy
-
+from .iteration_cache import IterationCache
+from .state_pair_classes import StatePairClasses
 from .state_pair_equivalence import StatePairEquivalence
-from .feature_pool import Feature
 from .iteration_data import IterationData
+from .tuple_graph_equivalence_utils import remap_tuple_graph_equivalence
 
 from ..preprocessing import PreprocessingData
 
 
-def make_conditions(policy_builder: dlplan_policy.PolicyFactory,
-    feature_pool: List[Feature],
-    feature_valuations):
-    """ Create conditions over all features that are satisfied in source_idx """
-    conditions = set()
-    for f_idx, (feature, val) in enumerate(zip(feature_pool, feature_valuations)):
-        if isinstance(feature.dlplan_feature, dlplan_core.Boolean):
-            if val:
-                conditions.add(policy_builder.make_pos_condition(policy_builder.make_boolean(f"f{f_idx}", feature.dlplan_feature)))
-            else:
-                conditions.add(policy_builder.make_neg_condition(policy_builder.make_boolean(f"f{f_idx}", feature.dlplan_feature)))
-        elif isinstance(feature.dlplan_feature, dlplan_core.Numerical):
-            if val > 0:
-                conditions.add(policy_builder.make_gt_condition(policy_builder.make_numerical(f"f{f_idx}", feature.dlplan_feature)))
-            else:
-                conditions.add(policy_builder.make_eq_condition(policy_builder.make_numerical(f"f{f_idx}", feature.dlplan_feature)))
-    return conditions
-
-def make_effects(policy_builder: dlplan_policy.PolicyFactory,
-    feature_pool: List[Feature],
-    source_feature_valuations,
-    target_feature_valuations):
-    """ Create effects over all features that are satisfied in (source_idx,target_idx) """
-    effects = set()
-    for f_idx, (feature, source_val, target_val) in enumerate(zip(feature_pool, source_feature_valuations, target_feature_valuations)):
-        if isinstance(feature.dlplan_feature, dlplan_core.Boolean):
-            if source_val and not target_val:
-                effects.add(policy_builder.make_neg_effect(policy_builder.make_boolean(f"f{f_idx}", feature.dlplan_feature)))
-            elif not source_val and target_val:
-                effects.add(policy_builder.make_pos_effect(policy_builder.make_boolean(f"f{f_idx}", feature.dlplan_feature)))
-            else:
-                effects.add(policy_builder.make_bot_effect(policy_builder.make_boolean(f"f{f_idx}", feature.dlplan_feature)))
-        elif isinstance(feature.dlplan_feature, dlplan_core.Numerical):
-            if source_val > target_val:
-                effects.add(policy_builder.make_dec_effect(policy_builder.make_numerical(f"f{f_idx}", feature.dlplan_feature)))
-            elif source_val < target_val:
-                effects.add(policy_builder.make_inc_effect(policy_builder.make_numerical(f"f{f_idx}", feature.dlplan_feature)))
-            else:
-                effects.add(policy_builder.make_bot_effect(policy_builder.make_numerical(f"f{f_idx}", feature.dlplan_feature)))
-    return effects
+def compute_effects(source_valuations: np.ndarray, target_valuations: np.ndarray) -> np.ndarray:
+    """ Compute the sign of the change of each feature from source to target valuations. """
+    return (target_valuations > source_valuations).astype(np.int8) - (target_valuations < source_valuations).astype(np.int8)
+
+
+def _compute_state_pair_equivalence(preprocessing_data: PreprocessingData,
+                                    iteration_data: IterationData,
+                                    gfa_state_global_idx: int,
+                                    conditions: List[np.ndarray],
+                                    effects: List[np.ndarray],
+                                    signature_to_r_idx: Dict[bytes, int],
+                                    previous_state_pair_equivalence: StatePairEquivalence = None,
+                                    previous_effects: np.ndarray = None,
+                                    kept_f_idxs: np.ndarray = None,
+                                    added_f_idxs: np.ndarray = None) -> StatePairEquivalence:
+    """ Classify the state pairs of the tuple graph rooted in the given state and add new classes.
+
+    With a previous state pair equivalence over an earlier feature pool, the effects of the kept features
+    are taken from the previous effects of the rule of each pair and only the effects of the added features are computed.
+    """
+    feature_valuations = iteration_data.feature_valuations
+    tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
+
+    r_idx_to_distance = dict()
+    r_idx_to_subgoal_gfa_state_ids = defaultdict(set)
+    subgoal_gfa_state_id_to_r_idx = dict()
+
+    source_valuations = feature_valuations.get_valuations(gfa_state_global_idx)
+    source_conditions = source_valuations > 0
+    packed_source_conditions = np.packbits(source_conditions).tobytes()
+
+    for s_distance, gfa_state_prime_global_idxs in enumerate(tuple_graph.gfa_state_global_idxs_by_distance):
+        if not len(gfa_state_prime_global_idxs):
+            continue
+        target_rows = feature_valuations.get_rows(gfa_state_prime_global_idxs)
+        if previous_state_pair_equivalence is None:
+            target_effects = compute_effects(source_valuations, feature_valuations.valuations[target_rows])
+        else:
+            previous_subgoal_gfa_state_id_to_r_idx = previous_state_pair_equivalence.subgoal_gfa_state_id_to_r_idx
+            target_effects = np.empty((len(gfa_state_prime_global_idxs), len(source_valuations)), dtype=np.int8)
+            target_effects[:, kept_f_idxs] = previous_effects[[previous_subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx] for gfa_state_prime_global_idx in gfa_state_prime_global_idxs.tolist()]]
+            target_effects[:, added_f_idxs] = compute_effects(source_valuations[added_f_idxs], feature_valuations.valuations[np.ix_(target_rows, added_f_idxs)])
+
+        for gfa_state_prime_global_idx, pair_effects in zip(gfa_state_prime_global_idxs.tolist(), target_effects):
+            signature = packed_source_conditions + pair_effects.tobytes()
+            r_idx = signature_to_r_idx.get(signature)
+            if r_idx is None:
+                r_idx = len(conditions)
+                signature_to_r_idx[signature] = r_idx
+                conditions.append(source_conditions)
+                effects.append(pair_effects)
+            r_idx_to_distance[r_idx] = min(r_idx_to_distance.get(r_idx, math.inf), s_distance)
+            r_idx_to_subgoal_gfa_state_ids[r_idx].add(gfa_state_prime_global_idx)
+            subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx] = r_idx
+
+    return StatePairEquivalence(r_idx_to_subgoal_gfa_state_ids, r_idx_to_distance, subgoal_gfa_state_id_to_r_idx)
+
+
+def remap_state_pair_equivalence(state_pair_equivalence: StatePairEquivalence, r_idx_to_iteration_r_idx: np.ndarray) -> StatePairEquivalence:
+    """ Rename the rules of a state pair equivalence, rules that are renamed to the same rule are merged. """
+    r_idx_to_iteration_r_idx = r_idx_to_iteration_r_idx.tolist()
+    r_idx_to_subgoal_gfa_state_ids = dict()
+    for r_idx, subgoal_gfa_state_ids in state_pair_equivalence.r_idx_to_subgoal_gfa_state_ids.items():
+        iteration_r_idx = r_idx_to_iteration_r_idx[r_idx]
+        merged_subgoal_gfa_state_ids = r_idx_to_subgoal_gfa_state_ids.get(iteration_r_idx)
+        r_idx_to_subgoal_gfa_state_ids[iteration_r_idx] = subgoal_gfa_state_ids if merged_subgoal_gfa_state_ids is None else merged_subgoal_gfa_state_ids | subgoal_gfa_state_ids
+    r_idx_to_closest_subgoal_distance = dict()
+    for r_idx, distance in state_pair_equivalence.r_idx_to_closest_subgoal_distance.items():
+        iteration_r_idx = r_idx_to_iteration_r_idx[r_idx]
+        r_idx_to_closest_subgoal_distance[iteration_r_idx] = min(r_idx_to_closest_subgoal_distance.get(iteration_r_idx, math.inf), distance)
+    return StatePairEquivalence(
+        r_idx_to_subgoal_gfa_state_ids,
+        r_idx_to_closest_subgoal_distance,
+        {gfa_state_prime_global_idx: r_idx_to_iteration_r_idx[r_idx] for gfa_state_prime_global_idx, r_idx in state_pair_equivalence.subgoal_gfa_state_id_to_r_idx.items()})
+
+
+def _remap_cached_rules(preprocessing_data: PreprocessingData,
+                        iteration_data: IterationData,
+                        iteration_cache: IterationCache):
+    """ Remap the cached rules and equivalences to the feature pool of this iteration by feature identity.
+
+    The conditions and effects of features that remain in the pool are kept.
+    If features were only removed, rules that differ only in removed features are merged
+    and all cached equivalences are renamed.
+    If features were added, the effects of the added features are computed from the valuations of this iteration,
+    which can split rules, such that the cached equivalences of states outside of this iteration are dropped
+    and the tuple graph equivalences are recomputed.
+    """
+    feature_pool_key = tuple(str(feature.dlplan_feature) for feature in iteration_data.feature_pool)
+    if iteration_cache.feature_pool_key == feature_pool_key:
+        return
+    previous_feature_pool_key = () if iteration_cache.feature_pool_key is None else iteration_cache.feature_pool_key
+    feature_key_to_previous_f_idx = {feature_key: f_idx for f_idx, feature_key in enumerate(previous_feature_pool_key)}
+    f_idx_to_previous_f_idx = np.array([feature_key_to_previous_f_idx.get(feature_key, -1) for feature_key in feature_pool_key], dtype=np.int64)
+    kept_f_idxs = np.flatnonzero(f_idx_to_previous_f_idx >= 0)
+    added_f_idxs = np.flatnonzero(f_idx_to_previous_f_idx < 0)
+    num_previous_rules = len(iteration_cache.conditions)
+    previous_f_idxs = f_idx_to_previous_f_idx[kept_f_idxs]
+    previous_conditions = np.array(iteration_cache.conditions, dtype=bool).reshape(num_previous_rules, len(previous_feature_pool_key))[:, previous_f_idxs]
+    previous_effects = np.array(iteration_cache.effects, dtype=np.int8).reshape(num_previous_rules, len(previous_feature_pool_key))[:, previous_f_idxs]
+    previous_state_pair_equivalences = iteration_cache.gfa_state_global_idx_to_state_pair_equivalence
+    previous_tuple_graph_equivalences = iteration_cache.gfa_state_global_idx_to_tuple_graph_equivalence
+
+    iteration_cache.feature_pool_key = feature_pool_key
+    iteration_cache.conditions = []
+    iteration_cache.effects = []
+    iteration_cache.signature_to_r_idx = dict()
+    iteration_cache.gfa_state_global_idx_to_state_pair_equivalence = dict()
+    iteration_cache.gfa_state_global_idx_to_tuple_graph_equivalence = dict()
+    iteration_cache.r_idx_to_iteration_r_idx = None
+
+    if not len(added_f_idxs):
+        previous_r_idx_to_r_idx = np.empty(num_previous_rules, dtype=np.int64)
+        for previous_r_idx, (rule_conditions, rule_effects) in enumerate(zip(previous_conditions, previous_effects)):
+            signature = np.packbits(rule_conditions).tobytes() + rule_effects.tobytes()
+            r_idx = iteration_cache.signature_to_r_idx.get(signature)
+            if r_idx is None:
+                r_idx = len(iteration_cache.conditions)
+                iteration_cache.signature_to_r_idx[signature] = r_idx
+                iteration_cache.conditions.append(rule_conditions)
+                iteration_cache.effects.append(rule_effects)
+            previous_r_idx_to_r_idx[previous_r_idx] = r_idx
+        iteration_cache.gfa_state_global_idx_to_state_pair_equivalence = {gfa_state_global_idx: remap_state_pair_equivalence(state_pair_equivalence, previous_r_idx_to_r_idx) for gfa_state_global_idx, state_pair_equivalence in previous_state_pair_equivalences.items()}
+        iteration_cache.gfa_state_global_idx_to_tuple_graph_equivalence = {gfa_state_global_idx: remap_tuple_graph_equivalence(tuple_graph_equivalence, previous_r_idx_to_r_idx) for gfa_state_global_idx, tuple_graph_equivalence in previous_tuple_graph_equivalences.items()}
+    else:
+        for gfa_state in iteration_data.gfa_states:
+            gfa_state_global_idx = gfa_state.get_global_index()
+            previous_state_pair_equivalence = previous_state_pair_equivalences.get(gfa_state_global_idx)
+            if previous_state_pair_equivalence is None:
+                continue
+            iteration_cache.gfa_state_global_idx_to_state_pair_equivalence[gfa_state_global_idx] = _compute_state_pair_equivalence(
+                preprocessing_data, iteration_data, gfa_state_global_idx,
+                iteration_cache.conditions, iteration_cache.effects, iteration_cache.signature_to_r_idx,
+                previous_state_pair_equivalence, previous_effects, kept_f_idxs, added_f_idxs)
 
 
 def compute_state_pair_equivalences(preprocessing_data: PreprocessingData,
-                                    iteration_data: IterationData):
-    # We have to take a new policy_builder because our feature pool F uses indices 0,...,|F|
-    policy_builder = preprocessing_data.domain_data.policy_builder
-    rules = []
-    rule_repr_to_idx = dict()
+                                    iteration_data: IterationData,
+                                    iteration_cache: IterationCache = None):
+    """ Partition state pairs into classes with equal conditions and effects over the feature pool F.
+
+    Classes are identified by a packed signature of the condition bits and effect signs
+    of all features, such that no dlplan Rules must be constructed here.
+
+    With an IterationCache, the state pair equivalences of states from earlier iterations are reused
+    after remapping them to the feature pool of this iteration, see _remap_cached_rules,
+    and the cached rules are renamed to the rules used in this iteration.
+    """
+    if iteration_cache is not None:
+        _remap_cached_rules(preprocessing_data, iteration_data, iteration_cache)
+        conditions = iteration_cache.conditions
+        effects = iteration_cache.effects
+        signature_to_r_idx = iteration_cache.signature_to_r_idx
+        cached_state_pair_equivalences = iteration_cache.gfa_state_global_idx_to_state_pair_equivalence
+    else:
+        conditions = []
+        effects = []
+        signature_to_r_idx = dict()
+        cached_state_pair_equivalences = dict()
 
     gfa_state_id_to_state_pair_equivalence: Dict[int, StatePairEquivalence] = dict()
 
@@ -71,42 +183,28 @@ def compute_state_pair_equivalences(preprocessing_data: PreprocessingData,
         if instance_data.gfa.is_deadend_state(gfa_state.get_faithful_abstract_state_index()):
             continue
 
-        tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
-        tuple_graph_states_by_distance = tuple_graph.get_states_grouped_by_distance()
-
-        r_idx_to_distance = dict()
-        r_idx_to_subgoal_gfa_state_ids = defaultdict(set)
-        subgoal_gfa_state_id_to_r_idx = dict()
-
-        # add conditions
-        conditions = make_conditions(policy_builder,
-                                     iteration_data.feature_pool,
-                                     iteration_data.gfa_state_global_idx_to_feature_evaluations[gfa_state_global_idx])
-
-        for s_distance, mimir_ss_states_prime in enumerate(tuple_graph_states_by_distance):
-            for mimir_ss_state_prime in mimir_ss_states_prime:
-                gfa_state_prime = preprocessing_data.state_finder.get_gfa_state_from_ss_state_idx(instance_idx, instance_data.mimir_ss.get_state_index(mimir_ss_state_prime))
-                gfa_state_prime_global_idx = gfa_state_prime.get_global_index()
-
-                # add effects
-                effects = make_effects(policy_builder,
-                                        iteration_data.feature_pool,
-                                        iteration_data.gfa_state_global_idx_to_feature_evaluations[gfa_state_global_idx],
-                                        iteration_data.gfa_state_global_idx_to_feature_evaluations[gfa_state_prime_global_idx])
-
-                # add rule
-                rule = policy_builder.make_rule(conditions, effects)
-                rule_repr = repr(rule)
-                if rule_repr in rule_repr_to_idx:
-                    r_idx = rule_repr_to_idx[rule_repr]
-                else:
-                    r_idx = len(rules)
-                    rule_repr_to_idx[rule_repr] = r_idx
-                    rules.append(rule)
-                r_idx_to_distance[r_idx] = min(r_idx_to_distance.get(r_idx, math.inf), s_distance)
-                r_idx_to_subgoal_gfa_state_ids[r_idx].add(gfa_state_prime_global_idx)
-                subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx] = r_idx
-
-        gfa_state_id_to_state_pair_equivalence[gfa_state_global_idx] = StatePairEquivalence(r_idx_to_subgoal_gfa_state_ids, r_idx_to_distance, subgoal_gfa_state_id_to_r_idx)
-
-    return rules, gfa_state_id_to_state_pair_equivalence
+        state_pair_equivalence = cached_state_pair_equivalences.get(gfa_state_global_idx)
+        if state_pair_equivalence is None:
+            state_pair_equivalence = _compute_state_pair_equivalence(preprocessing_data, iteration_data, gfa_state_global_idx, conditions, effects, signature_to_r_idx)
+            cached_state_pair_equivalences[gfa_state_global_idx] = state_pair_equivalence
+        gfa_state_id_to_state_pair_equivalence[gfa_state_global_idx] = state_pair_equivalence
+
+    # Keep only the rules of the states in this iteration and number them consecutively.
+    r_idxs = np.arange(len(conditions), dtype=np.int64)
+    if iteration_cache is not None:
+        is_used = np.zeros(len(conditions), dtype=bool)
+        for state_pair_equivalence in gfa_state_id_to_state_pair_equivalence.values():
+            is_used[list(state_pair_equivalence.r_idx_to_subgoal_gfa_state_ids.keys())] = True
+        r_idxs = np.flatnonzero(is_used)
+        r_idx_to_iteration_r_idx = np.full(len(conditions), -1, dtype=np.int64)
+        r_idx_to_iteration_r_idx[r_idxs] = np.arange(len(r_idxs), dtype=np.int64)
+        iteration_cache.r_idx_to_iteration_r_idx = r_idx_to_iteration_r_idx
+        if len(r_idxs) < len(conditions):
+            gfa_state_id_to_state_pair_equivalence = {gfa_state_global_idx: remap_state_pair_equivalence(state_pair_equivalence, r_idx_to_iteration_r_idx) for gfa_state_global_idx, state_pair_equivalence in gfa_state_id_to_state_pair_equivalence.items()}
+
+    num_features = len(iteration_data.feature_pool)
+    state_pair_classes = StatePairClasses(
+        np.array([conditions[r_idx] for r_idx in r_idxs.tolist()], dtype=bool).reshape(len(r_idxs), num_features),
+        np.array([effects[r_idx] for r_idx in r_idxs.tolist()], dtype=np.int8).reshape(len(r_idxs), num_features))
+
+    return state_pair_classes, gfa_state_id_to_state_pair_equivalence
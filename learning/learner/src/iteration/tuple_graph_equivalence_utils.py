@@ -1,20 +1,69 @@
-from typing import List, Dict, MutableSet
+from typing import List, Dict, MutableSet, Iterable
 from collections import defaultdict
 
+import numpy as np
+
+from .iteration_cache import IterationCache
 from .tuple_graph_equivalence import TupleGraphEquivalence
 from .iteration_data import IterationData
 
 from ..preprocessing import PreprocessingData
 
 
+def _compute_tuple_graph_equivalence(preprocessing_data: PreprocessingData,
+                                     gfa_state_global_idx: int,
+                                     subgoal_gfa_state_id_to_r_idx: Dict[int, int]) -> TupleGraphEquivalence:
+    tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
+
+    t_idx_to_r_idxs: Dict[int, MutableSet[int]] = dict()
+    t_idx_to_distance: Dict[int, int] = dict()
+    r_idx_to_deadend_distance: Dict[int, int] = dict()
+
+    state_finder = preprocessing_data.state_finder
+
+    for s_distance, gfa_state_prime_global_idxs in enumerate(tuple_graph.gfa_state_global_idxs_by_distance):
+        for gfa_state_prime_global_idx in gfa_state_prime_global_idxs[state_finder.gfa_state_global_idx_to_is_deadend[gfa_state_prime_global_idxs]].tolist():
+            r_idx = subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx]
+            r_idx_to_deadend_distance[r_idx] = min(r_idx_to_deadend_distance.get(r_idx, float("inf")), s_distance)
+
+    for s_distance, t_idxs in enumerate(tuple_graph.t_idxs_by_distance):
+        for t_idx in t_idxs.tolist():
+            r_idxs = set(subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx] for gfa_state_prime_global_idx in tuple_graph.t_idx_to_gfa_state_global_idxs[t_idx].tolist())
+            t_idx_to_distance[t_idx] = s_distance
+            t_idx_to_r_idxs[t_idx] = r_idxs
+
+    return TupleGraphEquivalence(t_idx_to_r_idxs, t_idx_to_distance, r_idx_to_deadend_distance)
+
+
+def remap_tuple_graph_equivalence(tuple_graph_equivalence: TupleGraphEquivalence, r_idx_to_iteration_r_idx: np.ndarray) -> TupleGraphEquivalence:
+    """ Rename the rules of a tuple graph equivalence, rules that are renamed to the same rule are merged. """
+    r_idx_to_iteration_r_idx = r_idx_to_iteration_r_idx.tolist()
+    r_idx_to_deadend_distance = dict()
+    for r_idx, distance in tuple_graph_equivalence.r_idx_to_deadend_distance.items():
+        iteration_r_idx = r_idx_to_iteration_r_idx[r_idx]
+        r_idx_to_deadend_distance[iteration_r_idx] = min(r_idx_to_deadend_distance.get(iteration_r_idx, float("inf")), distance)
+    return TupleGraphEquivalence(
+        {t_idx: set(r_idx_to_iteration_r_idx[r_idx] for r_idx in r_idxs) for t_idx, r_idxs in tuple_graph_equivalence.t_idx_to_r_idxs.items()},
+        dict(tuple_graph_equivalence.t_idx_to_distance),
+        r_idx_to_deadend_distance)
+
+
 def compute_tuple_graph_equivalences(preprocessing_data: PreprocessingData,
-                                     iteration_data: IterationData) -> None:
+                                     iteration_data: IterationData,
+                                     iteration_cache: IterationCache = None) -> None:
     """ Computes information for all subgoal states, tuples and rules over F.
+
+    With an IterationCache, the tuple graph equivalences of states from earlier iterations are reused
+    and their cached rules are renamed to the rules of the state pair equivalences of this iteration.
     """
     num_nodes = 0
 
     gfa_state_id_to_tuple_graph_equivalence: Dict[int, TupleGraphEquivalence] = dict()
 
+    if iteration_cache is not None:
+        r_idx_to_iteration_r_idx = iteration_cache.r_idx_to_iteration_r_idx
+        is_renamed = not np.array_equal(r_idx_to_iteration_r_idx, np.arange(len(r_idx_to_iteration_r_idx)))
+
     for gfa_state in iteration_data.gfa_states:
         instance_idx = gfa_state.get_faithful_abstraction_index()
         instance_data = preprocessing_data.instance_datas[instance_idx]
@@ -23,41 +72,19 @@ def compute_tuple_graph_equivalences(preprocessing_data: PreprocessingData,
             continue
 
         gfa_state_global_idx = gfa_state.get_global_index()
-        tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
-        tuple_graph_vertices_by_distance = tuple_graph.get_vertices_grouped_by_distance()
-        tuple_graph_states_by_distance = tuple_graph.get_states_grouped_by_distance()
 
-        t_idx_to_r_idxs: Dict[int, MutableSet[int]] = dict()
-        t_idx_to_distance: Dict[int, int] = dict()
-        r_idx_to_deadend_distance: Dict[int, int] = dict()
-
-        for s_distance, mimir_ss_states_prime in enumerate(tuple_graph_states_by_distance):
-            for mimir_ss_state_prime in mimir_ss_states_prime:
-                gfa_state_prime = preprocessing_data.state_finder.get_gfa_state_from_ss_state_idx(instance_idx, instance_data.mimir_ss.get_state_index(mimir_ss_state_prime))
-                gfa_state_prime_global_idx = gfa_state_prime.get_global_index()
-                instance_prime_idx = gfa_state_prime.get_faithful_abstraction_index()
-                instance_data_prime = preprocessing_data.instance_datas[instance_prime_idx]
-                gfa_state_prime_idx = gfa_state_prime.get_index()
-
-                r_idx = iteration_data.gfa_state_global_idx_to_state_pair_equivalence[gfa_state_global_idx].subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx]
-
-                if instance_data_prime.gfa.is_deadend_state(gfa_state_prime_idx):
-                    r_idx_to_deadend_distance[r_idx] = min(r_idx_to_deadend_distance.get(r_idx, float("inf")), s_distance)
-
-        for s_distance, tuple_vertex_group in enumerate(tuple_graph_vertices_by_distance):
-            for tuple_vertex in tuple_vertex_group:
-                t_idx = tuple_vertex.get_index()
-                r_idxs = set()
-                for mimir_ss_state_prime in tuple_vertex.get_states():
-                    gfa_state_prime = preprocessing_data.state_finder.get_gfa_state_from_ss_state_idx(instance_idx, instance_data.mimir_ss.get_state_index(mimir_ss_state_prime))
-                    gfa_state_prime_global_idx = gfa_state_prime.get_global_index()
-                    r_idx = iteration_data.gfa_state_global_idx_to_state_pair_equivalence[gfa_state_global_idx].subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx]
-                    r_idxs.add(r_idx)
-                t_idx_to_distance[t_idx] = s_distance
-                t_idx_to_r_idxs[t_idx] = r_idxs
-                num_nodes += 1
+        if iteration_cache is None:
+            tuple_graph_equivalence = _compute_tuple_graph_equivalence(preprocessing_data, gfa_state_global_idx, iteration_data.gfa_state_global_idx_to_state_pair_equivalence[gfa_state_global_idx].subgoal_gfa_state_id_to_r_idx)
+        else:
+            tuple_graph_equivalence = iteration_cache.gfa_state_global_idx_to_tuple_graph_equivalence.get(gfa_state_global_idx)
+            if tuple_graph_equivalence is None:
+                tuple_graph_equivalence = _compute_tuple_graph_equivalence(preprocessing_data, gfa_state_global_idx, iteration_cache.gfa_state_global_idx_to_state_pair_equivalence[gfa_state_global_idx].subgoal_gfa_state_id_to_r_idx)
+                iteration_cache.gfa_state_global_idx_to_tuple_graph_equivalence[gfa_state_global_idx] = tuple_graph_equivalence
+            if is_renamed:
+                tuple_graph_equivalence = remap_tuple_graph_equivalence(tuple_graph_equivalence, r_idx_to_iteration_r_idx)
 
-        gfa_state_id_to_tuple_graph_equivalence[gfa_state_global_idx] = TupleGraphEquivalence(t_idx_to_r_idxs, t_idx_to_distance, r_idx_to_deadend_distance)
+        num_nodes += len(tuple_graph_equivalence.t_idx_to_r_idxs)
+        gfa_state_id_to_tuple_graph_equivalence[gfa_state_global_idx] = tuple_graph_equivalence
 
     print("Tuple graph equivalence construction statistics:")
     print("Num nodes:", num_nodes)
@@ -65,6 +92,33 @@ def compute_tuple_graph_equivalences(preprocessing_data: PreprocessingData,
     return gfa_state_id_to_tuple_graph_equivalence
 
 
+def make_bitset(idxs: Iterable[int]) -> int:
+    """ Represent a set of indices as bits of an integer. """
+    bitset = 0
+    for idx in idxs:
+        bitset |= 1 << idx
+    return bitset
+
+
+def compute_minimal_bitsets(bitsets: Iterable[int]) -> MutableSet[int]:
+    """ Returns the distinct bitsets that have no other bitset as strict subset.
+
+    Bitsets are deduplicated and swept by increasing cardinality,
+    such that each bitset only needs to be compared to the minimal bitsets with fewer elements.
+    """
+    bitsets_by_cardinality = defaultdict(set)
+    for bitset in bitsets:
+        bitsets_by_cardinality[bin(bitset).count("1")].add(bitset)
+    minimal_bitsets = set()
+    smaller_minimal_bitsets = []
+    for cardinality in sorted(bitsets_by_cardinality.keys()):
+        same_cardinality_minimal_bitsets = [bitset for bitset in bitsets_by_cardinality[cardinality]
+                                            if not any(minimal_bitset & bitset == minimal_bitset for minimal_bitset in smaller_minimal_bitsets)]
+        minimal_bitsets.update(same_cardinality_minimal_bitsets)
+        smaller_minimal_bitsets.extend(same_cardinality_minimal_bitsets)
+    return minimal_bitsets
+
+
 def minimize_tuple_graph_equivalences(preprocessing_data: PreprocessingData,
                                       iteration_data: IterationData):
     num_kept_nodes = 0
@@ -80,29 +134,20 @@ def minimize_tuple_graph_equivalences(preprocessing_data: PreprocessingData,
         gfa_state_global_idx = gfa_state.get_global_index()
         tuple_graph = preprocessing_data.gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
         tuple_graph_equivalence = iteration_data.gfa_state_global_idx_to_tuple_graph_equivalence[gfa_state_global_idx]
-        # compute order
-        order = defaultdict(set)
-        for t_idx_1 in tuple_graph_equivalence.t_idx_to_r_idxs.keys():
-            r_idxs_1 = frozenset(tuple_graph_equivalence.t_idx_to_r_idxs[t_idx_1])
-            for t_idx_2 in tuple_graph_equivalence.t_idx_to_r_idxs.keys():
-                if t_idx_1 == t_idx_2:
-                    continue
-                r_idxs_2 = frozenset(tuple_graph_equivalence.t_idx_to_r_idxs[t_idx_2])
-                if r_idxs_1.issubset(r_idxs_2) and r_idxs_1 != r_idxs_2:
-                    # t_2 gets dominated by t_1
-                    order[t_idx_2].add(t_idx_1)
-        # select tuple nodes according to order
+        # represent sets of rules as bitsets and keep tuples whose set of rules is not dominated by a strict subset
+        t_idx_to_r_idxs_bitset = {t_idx: make_bitset(r_idxs) for t_idx, r_idxs in tuple_graph_equivalence.t_idx_to_r_idxs.items()}
+        minimal_r_idxs_bitsets = compute_minimal_bitsets(t_idx_to_r_idxs_bitset.values())
+        # select first tuple in order of distance for each minimal set of rules
         selected_t_idxs = set()
-        representative_r_idxs = set()
-        for tuple_vertex_group in tuple_graph.get_vertices_grouped_by_distance():
-            for tuple_vertex in tuple_vertex_group:
-                t_idx = tuple_vertex.get_index()
-                r_idxs = frozenset(tuple_graph_equivalence.t_idx_to_r_idxs[t_idx])
-                if order.get(t_idx, 0) != 0:
+        representative_r_idxs_bitsets = set()
+        for t_idxs in tuple_graph.t_idxs_by_distance:
+            for t_idx in t_idxs.tolist():
+                r_idxs_bitset = t_idx_to_r_idxs_bitset[t_idx]
+                if r_idxs_bitset not in minimal_r_idxs_bitsets:
                     continue
-                if r_idxs in representative_r_idxs:
+                if r_idxs_bitset in representative_r_idxs_bitsets:
                     continue
-                representative_r_idxs.add(r_idxs)
+                representative_r_idxs_bitsets.add(r_idxs_bitset)
                 # found tuple with minimal number of rules
                 selected_t_idxs.add(t_idx)
 
@@ -0,0 +1,85 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import List
+
+from .iteration_data import IterationData
+from .sketch import Sketch
+
+from ..preprocessing import PreprocessingData, InstanceData
+from ..util import create_shared_value, get_worker_data, set_worker_data
+
+
+# The sketch that a worker verifies and its description, such that its verification cache is kept across instances.
+_sketch: Sketch = None
+_sketch_description: str = None
+
+
+def set_up_verification_workers(preprocessing_data: PreprocessingData):
+    """ Set the data that workers forked afterwards read in _solves.
+
+    min_unsolved_pos is the position of the first instance known to be unsolved, which is shared by all workers.
+    """
+    set_worker_data(preprocessing_data=preprocessing_data, min_unsolved_pos=create_shared_value("q", 0))
+
+
+def _solves(pos: int, instance_idx: int, sketch_description: str, width: int, enable_goal_separating_features: bool) -> bool:
+    """ Returns False iff the sketch does not solve the instance at position pos.
+
+    Instances after a known unsolved instance are skipped and count as solved.
+    """
+    global _sketch, _sketch_description
+    preprocessing_data = get_worker_data("preprocessing_data")
+    min_unsolved_pos = get_worker_data("min_unsolved_pos")
+    if pos > min_unsolved_pos.value:
+        return True
+    if sketch_description != _sketch_description:
+        # dlplan policies cannot be pickled, hence, the sketch is parsed from its description.
+        _sketch = Sketch(preprocessing_data.domain_data.policy_builder.parse_policy(sketch_description), width)
+        _sketch_description = sketch_description
+    # The verification does not read the iteration data.
+    if _sketch.solves(preprocessing_data, None, preprocessing_data.instance_datas[instance_idx], enable_goal_separating_features):
+        return True
+    with min_unsolved_pos.get_lock():
+        min_unsolved_pos.value = min(min_unsolved_pos.value, pos)
+    return False
+
+
+def compute_smallest_unsolved_instance(
+        preprocessing_data: PreprocessingData,
+        iteration_data: IterationData,
+        selected_instance_datas: List[InstanceData],
+        sketch: Sketch,
+        enable_goal_separating_features: bool,
+        num_workers: int = 1,
+        pool: ProcessPoolExecutor = None):
+    """ Returns the first instance in selected_instance_datas that the sketch does not solve or None.
+
+    With more than one worker, instances are verified concurrently by the workers of the pool, see create_worker_pool.
+    """
+    if num_workers <= 1 or len(selected_instance_datas) <= 1:
+        for instance_data in selected_instance_datas:
+            if not sketch.solves(preprocessing_data, iteration_data, instance_data, enable_goal_separating_features):
+                return instance_data
+        return None
+
+    shared_min_unsolved_pos = get_worker_data("min_unsolved_pos")
+    with shared_min_unsolved_pos.get_lock():
+        shared_min_unsolved_pos.value = len(selected_instance_datas)
+
+    sketch_description = str(sketch.dlplan_policy)
+    min_unsolved_pos = len(selected_instance_datas)
+    pos_by_future = {pool.submit(_solves, pos, instance_data.idx, sketch_description, sketch.width, enable_goal_separating_features): pos for pos, instance_data in enumerate(selected_instance_datas)}
+    pending = set(pos_by_future.keys())
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if not future.result():
+                min_unsolved_pos = min(min_unsolved_pos, pos_by_future[future])
+        # Instances after the first unsolved instance do not need to be verified.
+        for future in pending:
+            if pos_by_future[future] > min_unsolved_pos:
+                future.cancel()
+        pending = set(future for future in pending if not future.cancelled())
+
+    if min_unsolved_pos == len(selected_instance_datas):
+        return None
+    return selected_instance_datas[min_unsolved_pos]
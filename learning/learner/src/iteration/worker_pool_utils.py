@@ -0,0 +1,18 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from .feature_pool_utils import set_up_feature_pruning_workers
+from .verification_utils import set_up_verification_workers
+
+from ..preprocessing import PreprocessingData
+from ..util import create_process_pool
+
+
+def create_worker_pool(preprocessing_data: PreprocessingData, num_workers: int) -> ProcessPoolExecutor:
+    """ Create the pool of forked workers that prune features and verify sketches in all iterations.
+
+    The pool must be created before any clingo Control, because forking a process with running solver threads can deadlock.
+    Workers inherit the preprocessing data and receive everything that changes across iterations with their tasks.
+    """
+    set_up_feature_pruning_workers(preprocessing_data)
+    set_up_verification_workers(preprocessing_data)
+    return create_process_pool(num_workers)
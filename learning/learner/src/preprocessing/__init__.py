@@ -1,7 +1,10 @@
+from .cache_utils import compute_cache_key, load_tuple_graphs, save_tuple_graphs
 from .domain_data_utils import compute_domain_data
 from .domain_data import DomainData
 from .instance_data_utils import compute_instance_datas
 from .instance_data import InstanceData
 from .preprocessing_data import PreprocessingData
+from .resolved_tuple_graph import ResolvedTupleGraph
 from .state_finder import StateFinder
-from .tuple_graph_utils import compute_tuple_graphs
+from .tuple_graph_data import TupleGraphData
+from .tuple_graph_utils import compute_tuple_graphs, resolve_tuple_graphs
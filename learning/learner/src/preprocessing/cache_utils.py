@@ -0,0 +1,224 @@
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from pathlib import Path
+from typing import List, Dict, Union
+
+from .instance_data import InstanceData
+from .tuple_graph_data import TupleGraphData
+
+
+# The cache only stores the mappings from concrete to abstract states and the tuple graphs.
+# StateSpace and GlobalFaithfulAbstraction of pymimir and the dlplan state spaces cannot be serialized,
+# hence, they are recomputed in every run, and a warm cache mostly saves the computation of the tuple graphs.
+
+# Increment whenever the layout of the cached files changes.
+CACHE_VERSION = 2
+
+MANIFEST_FILENAME = "manifest.json"
+INSTANCE_DATAS_FILENAME = "instance_datas.npz"
+TUPLE_GRAPHS_FILENAME = "tuple_graphs.npz"
+
+
+def _hash_file(filepath: Path) -> str:
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def compute_cache_key(domain_filepath: Path,
+                      instance_filepaths: List[Path],
+                      disable_closed_Q: bool,
+                      max_num_states_per_instance: int,
+                      max_time_per_instance: int,
+                      width: int) -> str:
+    """ Compute a key that identifies the preprocessing artifacts of a run by content.
+
+    The time limit is part of the key because it decides which instances are kept.
+    """
+    key = {
+        "version": CACHE_VERSION,
+        "domain": _hash_file(domain_filepath),
+        "instances": sorted(_hash_file(instance_filepath) for instance_filepath in instance_filepaths),
+        "disable_closed_Q": disable_closed_Q,
+        "max_num_states_per_instance": max_num_states_per_instance,
+        "max_time_per_instance": max_time_per_instance,
+        "width": width,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def make_manifest(filepaths: List[str], num_ss_states: List[int], num_gfa_states: List[int]):
+    """ Describe the instances that the cached artifacts were computed for. """
+    return [{"instance_filepath": str(filepath), "num_ss_states": n_ss, "num_gfa_states": n_gfa}
+            for filepath, n_ss, n_gfa in zip(filepaths, num_ss_states, num_gfa_states)]
+
+
+def _hash_manifest(manifest) -> str:
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+def _load_manifest(cache_directory: Path):
+    with open(cache_directory / MANIFEST_FILENAME, "r") as f:
+        return json.load(f)
+
+
+def _save_manifest(cache_directory: Path, manifest):
+    """ Write atomically such that interrupted runs do not leave a corrupt cache behind. """
+    filepath = cache_directory / MANIFEST_FILENAME
+    tmp_filepath = filepath.with_suffix(".tmp")
+    with open(tmp_filepath, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+def _savez(filepath: Path, **arrays):
+    """ Write atomically such that interrupted runs do not leave a corrupt cache behind. """
+    tmp_filepath = filepath.with_suffix(".tmp")
+    with open(tmp_filepath, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_filepath, filepath)
+
+
+def make_offsets(counts: List[int]) -> np.ndarray:
+    """ Return the offsets of consecutive ranges with the given sizes in a flat array (CSR). """
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    return offsets
+
+
+def _concatenate(arrays: List[np.ndarray]):
+    """ Concatenate arrays into a flat array and offsets into it. """
+    offsets = make_offsets([len(array) for array in arrays])
+    flat = np.concatenate(arrays).astype(np.int32) if arrays else np.empty(0, dtype=np.int32)
+    return offsets, flat
+
+
+def _split(offsets: np.ndarray, flat: np.ndarray, begin: int, end: int):
+    """ Inverse of _concatenate restricted to the arrays in [begin, end). """
+    return [flat[offsets[i]:offsets[i + 1]] for i in range(begin, end)]
+
+
+def save_instance_datas(cache_directory: Union[Path, None], manifest, instance_datas: List[InstanceData]):
+    """ Store the mappings from concrete states to global faithful abstract states.
+
+    Invalidates the tuple graphs because they refer to the stored mappings.
+    """
+    if cache_directory is None:
+        return
+    os.makedirs(cache_directory, exist_ok=True)
+    (cache_directory / TUPLE_GRAPHS_FILENAME).unlink(missing_ok=True)
+    offsets, flat = _concatenate([np.array(list(instance_data.ss_state_idx_to_gfa_state_idx.values()), dtype=np.int32) for instance_data in instance_datas])
+    _savez(cache_directory / INSTANCE_DATAS_FILENAME, ss_state_idx_to_gfa_state_idx_offsets=offsets, ss_state_idx_to_gfa_state_idx=flat)
+    _save_manifest(cache_directory, manifest)
+
+
+def load_instance_datas(cache_directory: Union[Path, None], manifest) -> Union[List[Dict[int, int]], None]:
+    """ Load the mappings from concrete states to global faithful abstract states.
+
+    Returns None if the cache is missing or was computed for a different list of instances.
+    """
+    if cache_directory is None:
+        return None
+    try:
+        cached_manifest = _load_manifest(cache_directory)
+        if cached_manifest != manifest:
+            logging.info("Preprocessing cache does not match the instances, recomputing.")
+            return None
+        with np.load(cache_directory / INSTANCE_DATAS_FILENAME) as data:
+            offsets = data["ss_state_idx_to_gfa_state_idx_offsets"]
+            flat = data["ss_state_idx_to_gfa_state_idx"]
+    except (OSError, ValueError, KeyError):
+        return None
+    if len(offsets) != len(manifest) + 1:
+        logging.info("Preprocessing cache does not match the number of instances, recomputing.")
+        return None
+    return [dict(enumerate(array.tolist())) for array in _split(offsets, flat, 0, len(manifest))]
+
+
+def save_tuple_graphs(cache_directory: Union[Path, None], gfa_state_global_idx_to_tuple_graph: Dict[int, TupleGraphData]):
+    """ Store the tuple graphs as flat int32 arrays with offsets.
+
+    The tuple graphs refer to the mappings stored by save_instance_datas,
+    hence, the digest of its manifest is stored with them.
+    """
+    if cache_directory is None:
+        return
+    try:
+        manifest_digest = _hash_manifest(_load_manifest(cache_directory))
+    except (OSError, ValueError):
+        return
+    gfa_state_global_idxs = sorted(gfa_state_global_idx_to_tuple_graph.keys())
+    instance_idxs = []
+    num_state_layers = []
+    num_t_layers = []
+    ss_state_idxs_by_layer = []
+    t_idxs_by_layer = []
+    ss_state_idxs_by_t = []
+    for gfa_state_global_idx in gfa_state_global_idxs:
+        tuple_graph = gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
+        instance_idxs.append(tuple_graph.instance_idx)
+        num_state_layers.append(len(tuple_graph.ss_state_idxs_by_distance))
+        num_t_layers.append(len(tuple_graph.t_idxs_by_distance))
+        ss_state_idxs_by_layer.extend(tuple_graph.ss_state_idxs_by_distance)
+        t_idxs_by_layer.extend(tuple_graph.t_idxs_by_distance)
+        for t_idxs in tuple_graph.t_idxs_by_distance:
+            ss_state_idxs_by_t.extend(tuple_graph.t_idx_to_ss_state_idxs[t_idx] for t_idx in t_idxs.tolist())
+    state_layer_offsets = make_offsets(num_state_layers)
+    t_layer_offsets = make_offsets(num_t_layers)
+    ss_state_offsets, ss_state_idxs = _concatenate(ss_state_idxs_by_layer)
+    t_offsets, t_idxs = _concatenate(t_idxs_by_layer)
+    t_ss_state_offsets, t_ss_state_idxs = _concatenate(ss_state_idxs_by_t)
+    _savez(cache_directory / TUPLE_GRAPHS_FILENAME,
+           manifest_digest=np.array(manifest_digest),
+           gfa_state_global_idxs=np.array(gfa_state_global_idxs, dtype=np.int64),
+           instance_idxs=np.array(instance_idxs, dtype=np.int32),
+           state_layer_offsets=state_layer_offsets,
+           t_layer_offsets=t_layer_offsets,
+           ss_state_offsets=ss_state_offsets,
+           ss_state_idxs=ss_state_idxs,
+           t_offsets=t_offsets,
+           t_idxs=t_idxs,
+           t_ss_state_offsets=t_ss_state_offsets,
+           t_ss_state_idxs=t_ss_state_idxs)
+
+
+def load_tuple_graphs(cache_directory: Union[Path, None], num_instances: int) -> Union[Dict[int, TupleGraphData], None]:
+    """ Load the tuple graphs stored by save_tuple_graphs.
+
+    Returns None if there are none or if they were stored for a different manifest
+    or a manifest with a different number of instances.
+    """
+    if cache_directory is None:
+        return None
+    try:
+        manifest = _load_manifest(cache_directory)
+        with np.load(cache_directory / TUPLE_GRAPHS_FILENAME) as data:
+            data = dict(data)
+        manifest_digest = str(data["manifest_digest"])
+    except (OSError, ValueError, KeyError):
+        return None
+    if len(manifest) != num_instances or manifest_digest != _hash_manifest(manifest) or not np.all(data["instance_idxs"] < num_instances):
+        logging.info("Cached TupleGraphs do not match the instances, recomputing.")
+        return None
+    state_layer_offsets = data["state_layer_offsets"]
+    t_layer_offsets = data["t_layer_offsets"]
+    ss_state_idxs_by_layer = _split(data["ss_state_offsets"], data["ss_state_idxs"], 0, state_layer_offsets[-1])
+    t_idxs_by_layer = _split(data["t_offsets"], data["t_idxs"], 0, t_layer_offsets[-1])
+    t_ss_state_offsets = data["t_ss_state_offsets"]
+    t_ss_state_idxs = data["t_ss_state_idxs"]
+
+    gfa_state_global_idx_to_tuple_graph: Dict[int, TupleGraphData] = dict()
+    t_pos = 0
+    for i, (gfa_state_global_idx, instance_idx) in enumerate(zip(data["gfa_state_global_idxs"].tolist(), data["instance_idxs"].tolist())):
+        t_idxs_by_distance = t_idxs_by_layer[t_layer_offsets[i]:t_layer_offsets[i + 1]]
+        t_idx_to_ss_state_idxs = dict()
+        for t_idxs in t_idxs_by_distance:
+            for t_idx in t_idxs.tolist():
+                t_idx_to_ss_state_idxs[t_idx] = t_ss_state_idxs[t_ss_state_offsets[t_pos]:t_ss_state_offsets[t_pos + 1]]
+                t_pos += 1
+        gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx] = TupleGraphData(instance_idx, ss_state_idxs_by_layer[state_layer_offsets[i]:state_layer_offsets[i + 1]], t_idxs_by_distance, t_idx_to_ss_state_idxs)
+    return gfa_state_global_idx_to_tuple_graph
@@ -1,8 +1,9 @@
 import logging
-from typing import List, Tuple, Dict, Union
+from dataclasses import dataclass
+from typing import List, Tuple, Dict, Set, Union
 from pathlib import Path
-from collections import defaultdict
 
+import numpy as np
 import pymimir as mm
 import dlplan.core as dlplan_core
 import dlplan.state_space as dlplan_statespace
@@ -10,8 +11,33 @@ import dlplan.state_space as dlplan_statespace
 from .instance_data import InstanceData
 from .domain_data import DomainData
 from .domain_data_utils import compute_domain_data
+from .cache_utils import make_manifest, make_offsets, load_instance_datas, save_instance_datas
 
-from ..util import change_dir, write_file
+from ..util import change_dir, write_file, create_process_pool, get_worker_data, set_worker_data
+
+
+@dataclass
+class InstancePayload:
+    """
+    Picklable data computed by a worker from the mimir StateSpace and GlobalFaithfulAbstraction of an instance.
+
+    The parent process assembles the dlplan InstanceInfo and StateSpace from it.
+    """
+    num_states: int
+    initial_ss_state_idx: int
+    goal_ss_state_idxs: Set[int]
+    static_atoms: List[Tuple[str, List[str]]]
+    fluent_atoms: List[Tuple[int, str, List[str]]]
+    derived_atoms: List[Tuple[int, str, List[str]]]
+    goal_atoms: List[Tuple[str, List[str]]]
+    fluent_atom_offsets: np.ndarray
+    fluent_atom_ids: np.ndarray
+    derived_atom_offsets: np.ndarray
+    derived_atom_ids: np.ndarray
+    successor_offsets: np.ndarray
+    successors: np.ndarray
+    ss_state_idx_to_gfa_state_idx: Union[np.ndarray, None]
+    initial_gfa_state_idxs: List[int]
 
 
 def create_vocabulary_info(domain: mm.Domain) -> dlplan_core.VocabularyInfo:
@@ -31,81 +57,160 @@ def create_vocabulary_info(domain: mm.Domain) -> dlplan_core.VocabularyInfo:
     return vocabulary_info
 
 
-def create_instance_info(
-        vocabulary_info: dlplan_core.VocabularyInfo,
-        instance_id: int,
-        mimir_state_space: mm.StateSpace
-) -> Tuple[dlplan_core.InstanceInfo, Dict[Union[mm.FluentGroundAtom, mm.DerivedGroundAtom], dlplan_core.Atom]]:
-    instance_info = dlplan_core.InstanceInfo(instance_id, vocabulary_info)
+def compute_instance_atoms(mimir_state_space: mm.StateSpace):
+    """ Collect the atoms of the dlplan InstanceInfo as picklable tuples of predicate name and object names.
+
+    Returns the static initial atoms, the reached fluent and derived atoms with their mimir indices, and the goal atoms.
+    """
     pddl_factories = mimir_state_space.get_aag().get_pddl_factories()
     problem = mimir_state_space.get_aag().get_problem()
     # Static initial literals
+    static_atoms = []
     for literal in problem.get_static_initial_literals():
         if literal.get_atom().get_predicate().get_name() != "=":
             assert not literal.is_negated()
-            instance_info.add_static_atom(literal.get_atom().get_predicate().get_name(), [obj.get_name() for obj in literal.get_atom().get_objects()])
+            static_atoms.append((literal.get_atom().get_predicate().get_name(), [obj.get_name() for obj in literal.get_atom().get_objects()]))
     # Reached atoms
-    fluent_atom_id_to_dlplan_atom = dict()
-    derived_atom_id_to_dlplan_atom = dict()
+    fluent_atoms = []
+    derived_atoms = []
     for atom in pddl_factories.get_fluent_ground_atoms_from_indices(mimir_state_space.get_ssg().get_reached_fluent_ground_atoms()):
-        fluent_atom_id_to_dlplan_atom[atom.get_index()] = instance_info.add_atom(atom.get_predicate().get_name(), [obj.get_name() for obj in atom.get_objects()])
+        fluent_atoms.append((atom.get_index(), atom.get_predicate().get_name(), [obj.get_name() for obj in atom.get_objects()]))
     for atom in pddl_factories.get_derived_ground_atoms_from_indices(mimir_state_space.get_ssg().get_reached_derived_ground_atoms()):
-        derived_atom_id_to_dlplan_atom[atom.get_index()] = instance_info.add_atom(atom.get_predicate().get_name(), [obj.get_name() for obj in atom.get_objects()])
+        derived_atoms.append((atom.get_index(), atom.get_predicate().get_name(), [obj.get_name() for obj in atom.get_objects()]))
     # Goal literals
-    for literal in problem.get_static_goal_condition():
-        assert not literal.is_negated()
-        instance_info.add_static_atom(literal.get_atom().get_predicate().get_name() + "_g", [obj.get_name() for obj in literal.get_atom().get_objects()])
-    for literal in problem.get_fluent_goal_condition():
+    goal_atoms = []
+    for literal in list(problem.get_static_goal_condition()) + list(problem.get_fluent_goal_condition()) + list(problem.get_derived_goal_condition()):
         assert not literal.is_negated()
-        instance_info.add_static_atom(literal.get_atom().get_predicate().get_name() + "_g", [obj.get_name() for obj in literal.get_atom().get_objects()])
-    for literal in problem.get_derived_goal_condition():
-        assert not literal.is_negated()
-        instance_info.add_static_atom(literal.get_atom().get_predicate().get_name() + "_g", [obj.get_name() for obj in literal.get_atom().get_objects()])
+        goal_atoms.append((literal.get_atom().get_predicate().get_name() + "_g", [obj.get_name() for obj in literal.get_atom().get_objects()]))
+    return static_atoms, fluent_atoms, derived_atoms, goal_atoms
+
+
+def create_instance_info(
+        vocabulary_info: dlplan_core.VocabularyInfo,
+        instance_id: int,
+        static_atoms: List[Tuple[str, List[str]]],
+        fluent_atoms: List[Tuple[int, str, List[str]]],
+        derived_atoms: List[Tuple[int, str, List[str]]],
+        goal_atoms: List[Tuple[str, List[str]]]
+) -> Tuple[dlplan_core.InstanceInfo, Dict[int, dlplan_core.Atom], Dict[int, dlplan_core.Atom]]:
+    instance_info = dlplan_core.InstanceInfo(instance_id, vocabulary_info)
+    for predicate_name, object_names in static_atoms:
+        instance_info.add_static_atom(predicate_name, object_names)
+    fluent_atom_id_to_dlplan_atom = dict()
+    derived_atom_id_to_dlplan_atom = dict()
+    for atom_id, predicate_name, object_names in fluent_atoms:
+        fluent_atom_id_to_dlplan_atom[atom_id] = instance_info.add_atom(predicate_name, object_names)
+    for atom_id, predicate_name, object_names in derived_atoms:
+        derived_atom_id_to_dlplan_atom[atom_id] = instance_info.add_atom(predicate_name, object_names)
+    for predicate_name, object_names in goal_atoms:
+        instance_info.add_static_atom(predicate_name, object_names)
     return instance_info, fluent_atom_id_to_dlplan_atom, derived_atom_id_to_dlplan_atom
 
 
+def compute_state_atoms(mimir_state_space: mm.StateSpace):
+    """ Collect the fluent and derived atoms of all states in flat arrays of mimir atom indices with offsets (CSR).
+    """
+    fluent_atom_ids = []
+    derived_atom_ids = []
+    num_fluent_atoms = []
+    num_derived_atoms = []
+    for ss_state in mimir_state_space.get_states():
+        state = ss_state.get_state()
+        state_fluent_atom_ids = state.get_fluent_atoms()
+        state_derived_atom_ids = state.get_derived_atoms()
+        fluent_atom_ids.extend(state_fluent_atom_ids)
+        derived_atom_ids.extend(state_derived_atom_ids)
+        num_fluent_atoms.append(len(state_fluent_atom_ids))
+        num_derived_atoms.append(len(state_derived_atom_ids))
+    return make_offsets(num_fluent_atoms), np.array(fluent_atom_ids, dtype=np.int64), make_offsets(num_derived_atoms), np.array(derived_atom_ids, dtype=np.int64)
+
+
+def compute_forward_successors(mimir_state_space: mm.StateSpace):
+    """ Collect the forward successors of all states in a flat array with offsets (CSR).
+    """
+    ss_state_prime_idxs = []
+    num_ss_state_prime_idxs = []
+    for ss_state_idx in range(mimir_state_space.get_num_states()):
+        successors = set(mimir_state_space.get_forward_adjacent_state_indices(ss_state_idx))
+        ss_state_prime_idxs.extend(successors)
+        num_ss_state_prime_idxs.append(len(successors))
+    return make_offsets(num_ss_state_prime_idxs), np.array(ss_state_prime_idxs, dtype=np.int32)
+
+
+def make_atom_id_to_dlplan_atom_idx(atom_id_to_dlplan_atom: Dict[int, dlplan_core.Atom]) -> np.ndarray:
+    """ Create a lookup table from mimir atom indices to dlplan atom indices, missing atoms map to -1. """
+    atom_id_to_dlplan_atom_idx = np.full(max(atom_id_to_dlplan_atom.keys(), default=-1) + 1, -1, dtype=np.int32)
+    for atom_id, dlplan_atom in atom_id_to_dlplan_atom.items():
+        atom_id_to_dlplan_atom_idx[atom_id] = dlplan_atom.get_index()
+    return atom_id_to_dlplan_atom_idx
+
+
 def create_dlplan_statespace(
         instance_info: dlplan_core.InstanceInfo,
-        mimir_state_space: mm.StateSpace,
+        payload: InstancePayload,
         fluent_atom_id_to_dlplan_atom: Dict[int, dlplan_core.Atom],
         derived_atom_id_to_dlplan_atom: Dict[int, dlplan_core.Atom]
 ) -> dlplan_statespace.StateSpace:
+    # Translate the mimir atoms of all states to dlplan atom indices in bulk.
+    fluent_offsets, derived_offsets = payload.fluent_atom_offsets, payload.derived_atom_offsets
+    fluent_dlplan_atom_idxs = make_atom_id_to_dlplan_atom_idx(fluent_atom_id_to_dlplan_atom)[payload.fluent_atom_ids]
+    derived_dlplan_atom_idxs = make_atom_id_to_dlplan_atom_idx(derived_atom_id_to_dlplan_atom)[payload.derived_atom_ids]
+    successor_offsets = payload.successor_offsets
+
     dlplan_states: Dict[int, dlplan_core.State] = dict()
-    forward_successors = defaultdict(set)
-    mimir_ss_states = mimir_state_space.get_states()
-    for ss_state_idx, ss_state in enumerate(mimir_ss_states):
-        dlplan_state_atoms = []
-        for atom_id in ss_state.get_state().get_fluent_atoms():
-            dlplan_state_atoms.append(fluent_atom_id_to_dlplan_atom[atom_id])
-        for atom_id in ss_state.get_state().get_derived_atoms():
-            dlplan_state_atoms.append(derived_atom_id_to_dlplan_atom[atom_id])
-        dlplan_states[ss_state_idx] = dlplan_core.State(ss_state_idx, instance_info, dlplan_state_atoms)
-        for ss_state_prime_idx in mimir_state_space.get_forward_adjacent_state_indices(ss_state_idx):
-            forward_successors[ss_state_idx].add(ss_state_prime_idx)
-    dlplan_state_space = dlplan_statespace.StateSpace(instance_info, dlplan_states, mimir_state_space.get_initial_state(), forward_successors, mimir_state_space.get_goal_states())
+    forward_successors = dict()
+    for ss_state_idx in range(payload.num_states):
+        dlplan_state_atom_idxs = fluent_dlplan_atom_idxs[fluent_offsets[ss_state_idx]:fluent_offsets[ss_state_idx + 1]].tolist()
+        if derived_offsets[ss_state_idx] != derived_offsets[ss_state_idx + 1]:
+            dlplan_state_atom_idxs.extend(derived_dlplan_atom_idxs[derived_offsets[ss_state_idx]:derived_offsets[ss_state_idx + 1]].tolist())
+        dlplan_states[ss_state_idx] = dlplan_core.State(ss_state_idx, instance_info, dlplan_state_atom_idxs)
+        if successor_offsets[ss_state_idx] != successor_offsets[ss_state_idx + 1]:
+            forward_successors[ss_state_idx] = set(payload.successors[successor_offsets[ss_state_idx]:successor_offsets[ss_state_idx + 1]].tolist())
+    dlplan_state_space = dlplan_statespace.StateSpace(instance_info, dlplan_states, payload.initial_ss_state_idx, forward_successors, payload.goal_ss_state_idxs)
     return dlplan_state_space
 
 
+def _compute_instance_payload(instance_idx: int, compute_mapping: bool) -> InstancePayload:
+    """ Extract everything needed to construct the InstanceData of the given instance.
+
+    Reads the state spaces and abstractions set up in compute_instance_datas.
+    """
+    mimir_ss = get_worker_data("state_spaces")[instance_idx]
+    gfa = get_worker_data("abstractions")[instance_idx]
+    static_atoms, fluent_atoms, derived_atoms, goal_atoms = compute_instance_atoms(mimir_ss)
+    fluent_atom_offsets, fluent_atom_ids, derived_atom_offsets, derived_atom_ids = compute_state_atoms(mimir_ss)
+    successor_offsets, successors = compute_forward_successors(mimir_ss)
+
+    # Create mapping from concrete states to global faithful abstract states
+    ss_state_idx_to_gfa_state_idx = None
+    if compute_mapping:
+        ss_state_idx_to_gfa_state_idx = np.array([gfa.get_abstract_state_index(sp_state.get_state()) for sp_state in mimir_ss.get_states()], dtype=np.int32)
+
+    if get_worker_data("disable_closed_Q"):
+        initial_gfa_state_idxs = [gfa.get_initial_state(),]
+    else:
+        initial_gfa_state_idxs = [state_idx for state_idx in range(gfa.get_num_states()) if gfa.is_alive_state(state_idx)]
+
+    return InstancePayload(mimir_ss.get_num_states(), mimir_ss.get_initial_state(), set(mimir_ss.get_goal_states()),
+                           static_atoms, fluent_atoms, derived_atoms, goal_atoms,
+                           fluent_atom_offsets, fluent_atom_ids, derived_atom_offsets, derived_atom_ids,
+                           successor_offsets, successors, ss_state_idx_to_gfa_state_idx, initial_gfa_state_idxs)
+
+
 def compute_instance_datas(domain_filepath: Path,
                            instance_filepaths: List[Path],
                            disable_closed_Q: bool,
                            max_num_states_per_instance: int,
                            max_time_per_instance: int,
-                           enable_dump_files: bool) -> Tuple[List[InstanceData], DomainData]:
-    instance_datas: List[InstanceData] = []
+                           enable_dump_files: bool,
+                           cache_directory: Path = None,
+                           num_workers: int = 1) -> Tuple[List[InstanceData], DomainData]:
+    """ Construct the InstanceData of each instance that is kept by the global faithful abstraction.
 
-    state_space_options = mm.StateSpacesOptions()
-    state_space_options.state_space_options.max_num_states = max_num_states_per_instance
-    state_space_options.state_space_options.timeout_ms = max_time_per_instance
-    state_space_options.sort_ascending_by_num_states = True
-    state_spaces = mm.StateSpace.create(str(domain_filepath), [str(p) for p in instance_filepaths], state_space_options)
-    # Remove trivially solvable instances
-    instance_filespaths = []
-    num_ss_states = 0
-    for state_space in state_spaces:
-        if state_space.get_num_states() != state_space.get_num_goal_states():
-            instance_filespaths.append(state_space.get_problem().get_filepath())
-            num_ss_states += state_space.get_num_states()
+    With more than one worker, the per-instance data is extracted from mimir in forked worker
+    processes and the dlplan objects are assembled in the parent in instance order.
+    """
+    instance_datas: List[InstanceData] = []
 
     with change_dir("state_spaces", enable=enable_dump_files):
         # 1. Create mimir StateSpace and GlobalFaithfulAbstraction
@@ -133,43 +238,66 @@ def compute_instance_datas(domain_filepath: Path,
         state_spaces = mm.StateSpace.create(memories, state_space_options)
         logging.info("...done")
 
+        # Trivially solvable instances, where all states are goal states, have no alive states
+        # and thus contribute nothing to learning. We keep them because the global indices
+        # of the abstractions refer to them but do not count their states.
+        num_ss_states = sum(mimir_ss.get_num_states() for mimir_ss in state_spaces if mimir_ss.get_num_states() != mimir_ss.get_num_goal_states())
+
+        # Reuse the mappings from concrete to abstract states if they were computed for the same instances.
+        manifest = make_manifest([gfa.get_problem().get_filepath() for gfa in abstractions],
+                                 [mimir_ss.get_num_states() for mimir_ss in state_spaces],
+                                 [gfa.get_num_states() for gfa in abstractions])
+        cached_ss_state_idx_to_gfa_state_idxs = load_instance_datas(cache_directory, manifest)
+        if cached_ss_state_idx_to_gfa_state_idxs is not None:
+            logging.info("Loaded mappings from concrete to abstract states from preprocessing cache, state spaces and abstractions were recomputed.")
+
         # 2. Create DomainData
         vocabulary_info = create_vocabulary_info(state_spaces[0].get_aag().get_problem().get_domain())
         domain_data = compute_domain_data(str(domain_filepath), vocabulary_info)
 
-        # 3. Create InstanceData
-        instance_idx = 0
+        # 3. Extract picklable per-instance data from mimir
         assert len(state_spaces) == len(abstractions)
-        for mimir_ss, gfa in zip(state_spaces, abstractions):
+        set_worker_data(state_spaces=state_spaces, abstractions=abstractions, disable_closed_Q=disable_closed_Q)
+        compute_mapping = cached_ss_state_idx_to_gfa_state_idxs is None
+        if num_workers > 1:
+            with create_process_pool(num_workers) as pool:
+                payloads = list(pool.map(_compute_instance_payload, range(len(state_spaces)), [compute_mapping] * len(state_spaces)))
+        else:
+            payloads = [_compute_instance_payload(instance_idx, compute_mapping) for instance_idx in range(len(state_spaces))]
+
+        # 4. Create InstanceData
+        instance_idx = 0
+        for mimir_ss, gfa, payload in zip(state_spaces, abstractions, payloads):
             # Ensure that unsolvable instances were removed
             assert(mimir_ss.get_num_goal_states())
 
-            # 3.1. Create dlplan instance info
-            instance_info, fluent_atom_id_to_dlplan_atom, derived_atom_id_to_dlplan_atom = create_instance_info(vocabulary_info, instance_idx, mimir_ss)
+            # 4.1. Create dlplan instance info
+            instance_info, fluent_atom_id_to_dlplan_atom, derived_atom_id_to_dlplan_atom = create_instance_info(vocabulary_info, instance_idx, payload.static_atoms, payload.fluent_atoms, payload.derived_atoms, payload.goal_atoms)
 
-            # 3.2 Create dlplan state space
-            dlplan_ss = create_dlplan_statespace(instance_info, mimir_ss, fluent_atom_id_to_dlplan_atom, derived_atom_id_to_dlplan_atom)
+            # 4.2 Create dlplan state space
+            dlplan_ss = create_dlplan_statespace(instance_info, payload, fluent_atom_id_to_dlplan_atom, derived_atom_id_to_dlplan_atom)
 
             print(mimir_ss.get_problem().get_filepath(), gfa.get_problem().get_filepath())
 
-            # 3.3 Create mapping from concrete states to global faithful abstract states
-            ss_state_idx_to_gfa_state_idx = dict()
-            for ss_state_idx, sp_state in enumerate(mimir_ss.get_states()):
-                ss_state_idx_to_gfa_state_idx[ss_state_idx] = gfa.get_abstract_state_index(sp_state.get_state())
+            # 4.3 Create mapping from concrete states to global faithful abstract states
+            if cached_ss_state_idx_to_gfa_state_idxs is not None:
+                ss_state_idx_to_gfa_state_idx = cached_ss_state_idx_to_gfa_state_idxs[instance_idx]
+            else:
+                ss_state_idx_to_gfa_state_idx = dict(enumerate(payload.ss_state_idx_to_gfa_state_idx.tolist()))
 
             if enable_dump_files:
                 write_file(f"{instance_idx}.dot", dlplan_ss.to_dot(1))
 
-            if disable_closed_Q:
-                initial_gfa_state_idxs = [gfa.get_initial_state(),]
-            else:
-                initial_gfa_state_idxs = [state_idx for state_idx in range(gfa.get_num_states()) if gfa.is_alive_state(state_idx)]
+            initial_gfa_state_idxs = payload.initial_gfa_state_idxs
 
             logging.info(f"Created InstanceData with num concrete states: {mimir_ss.get_num_states()} and num abstract states: {gfa.get_num_states()}")
             instance_data = InstanceData(instance_idx, dlplan_core.DenotationsCaches(), mimir_ss.get_problem().get_filepath(), gfa, mimir_ss, dlplan_ss, ss_state_idx_to_gfa_state_idx, initial_gfa_state_idxs)
             instance_datas.append(instance_data)
             instance_idx += 1
 
+        if cached_ss_state_idx_to_gfa_state_idxs is None:
+            save_instance_datas(cache_directory, manifest, instance_datas)
+
     gfa_state_global_indices =  set()
     for instance_data in instance_datas:
         for gfa_state in instance_data.gfa.get_states():
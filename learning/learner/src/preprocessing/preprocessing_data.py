@@ -1,11 +1,10 @@
 from dataclasses import dataclass
 from typing import Dict, List
 
-import pymimir as mm
-
 from .domain_data import DomainData
 from .instance_data import InstanceData
 from .state_finder import StateFinder
+from .resolved_tuple_graph import ResolvedTupleGraph
 
 
 @dataclass
@@ -14,7 +13,7 @@ class PreprocessingData:
     _domain_data: DomainData
     _instance_datas: List[InstanceData]
     _state_finder: StateFinder
-    _gfa_state_global_idx_to_tuple_graph: Dict[int, mm.TupleGraph]
+    _gfa_state_global_idx_to_tuple_graph: Dict[int, ResolvedTupleGraph]
 
     @property
     def domain_data(self):
@@ -0,0 +1,30 @@
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+
+
+@dataclass
+class ResolvedTupleGraph:
+    """
+    Immutable data class.
+
+    ResolvedTupleGraph is a TupleGraphData whose states are resolved
+    to global faithful abstract state indices once during preprocessing,
+    such that the iteration stages need no StateFinder lookups.
+    """
+    _gfa_state_global_idxs_by_distance: List[np.ndarray]
+    _t_idxs_by_distance: List[np.ndarray]
+    _t_idx_to_gfa_state_global_idxs: Dict[int, np.ndarray]
+
+    @property
+    def gfa_state_global_idxs_by_distance(self):
+        return self._gfa_state_global_idxs_by_distance
+
+    @property
+    def t_idxs_by_distance(self):
+        return self._t_idxs_by_distance
+
+    @property
+    def t_idx_to_gfa_state_global_idxs(self):
+        return self._t_idx_to_gfa_state_global_idxs
@@ -1,5 +1,6 @@
 from typing import List
 
+import numpy as np
 import pymimir as mm
 import dlplan.core as dlplan_core
 
@@ -17,6 +18,28 @@ class StateFinder:
         self.fa_states_by_instance_idx = [fa.get_states() for fa in self.instance_datas[0].gfa.get_abstractions()]
         self.dlplan_ss_states_by_instance_id = [instance_data.dlplan_ss.get_states() for instance_data in instance_datas]
 
+        # Flat index maps such that the innermost loops need no pybind calls.
+        # Concrete state indices of instance i are stored in [ss_state_offsets[i], ss_state_offsets[i + 1]).
+        num_gfa_states = 1 + max((gfa_state.get_global_index() for gfa_states in self.gfa_states_by_instance_idx for gfa_state in gfa_states), default=-1)
+        self.gfa_state_global_idx_to_instance_idx = np.full(num_gfa_states, -1, dtype=np.int32)
+        self.gfa_state_global_idx_to_ss_state_idx = np.full(num_gfa_states, -1, dtype=np.int32)
+        self.gfa_state_global_idx_to_is_deadend = np.zeros(num_gfa_states, dtype=bool)
+        self.ss_state_offsets = np.zeros(len(instance_datas) + 1, dtype=np.int64)
+        ss_state_idx_to_gfa_state_global_idxs = []
+        for instance_idx, (instance_data, gfa_states) in enumerate(zip(instance_datas, self.gfa_states_by_instance_idx)):
+            gfa_state_idx_to_global_idx = np.array([gfa_state.get_global_index() for gfa_state in gfa_states], dtype=np.int64)
+            ss_state_idx_to_gfa_state_idx = np.fromiter(instance_data.ss_state_idx_to_gfa_state_idx.values(), dtype=np.int64, count=len(instance_data.ss_state_idx_to_gfa_state_idx))
+            ss_state_idx_to_gfa_state_global_idxs.append(gfa_state_idx_to_global_idx[ss_state_idx_to_gfa_state_idx])
+            self.ss_state_offsets[instance_idx + 1] = self.ss_state_offsets[instance_idx] + len(ss_state_idx_to_gfa_state_idx)
+            for gfa_state_idx, gfa_state in enumerate(gfa_states):
+                gfa_state_global_idx = gfa_state_idx_to_global_idx[gfa_state_idx]
+                if instance_data.gfa.is_deadend_state(gfa_state_idx):
+                    self.gfa_state_global_idx_to_is_deadend[gfa_state_global_idx] = True
+                if self.gfa_state_global_idx_to_instance_idx[gfa_state_global_idx] == -1:
+                    self.gfa_state_global_idx_to_instance_idx[gfa_state_global_idx] = gfa_state.get_faithful_abstraction_index()
+                    self.gfa_state_global_idx_to_ss_state_idx[gfa_state_global_idx] = self.get_ss_state_idx(gfa_state)
+        self.ss_state_idx_to_gfa_state_global_idx = np.concatenate(ss_state_idx_to_gfa_state_global_idxs) if ss_state_idx_to_gfa_state_global_idxs else np.empty(0, dtype=np.int64)
+
     def get_ss_state_idx(self, gfa_state: mm.GlobalFaithfulAbstractState) -> int:
         """ Get the index of the representative state in the complete concrete state space.
         """
@@ -31,10 +54,23 @@ class StateFinder:
     def get_dlplan_ss_state(self, gfa_state: mm.GlobalFaithfulAbstractState) -> dlplan_core.State:
         """ Get the representative dlplan state in the complete concrete dlplan state space.
         """
-        ss_state_idx = self.get_ss_state_idx(gfa_state)
-        dlplan_ss_state = self.dlplan_ss_states_by_instance_id[gfa_state.get_faithful_abstraction_index()][ss_state_idx]
+        return self.get_dlplan_ss_state_from_global_idx(gfa_state.get_global_index())
+
+    def get_dlplan_ss_state_from_global_idx(self, gfa_state_global_idx: int) -> dlplan_core.State:
+        """ Get the representative dlplan state of a global faithful abstract state index.
+        """
+        instance_idx = self.gfa_state_global_idx_to_instance_idx[gfa_state_global_idx]
+        ss_state_idx = self.gfa_state_global_idx_to_ss_state_idx[gfa_state_global_idx]
+
+        return self.dlplan_ss_states_by_instance_id[instance_idx][ss_state_idx]
+
+    def get_instance_idx_from_global_idx(self, gfa_state_global_idx: int) -> int:
+        """ Get the index of the instance that contains the representative state of a global faithful abstract state index.
+        """
+        return int(self.gfa_state_global_idx_to_instance_idx[gfa_state_global_idx])
 
-        return dlplan_ss_state
+    def is_deadend_global_idx(self, gfa_state_global_idx: int) -> bool:
+        return bool(self.gfa_state_global_idx_to_is_deadend[gfa_state_global_idx])
 
     def get_mimir_ss_state(self, gfa_state: mm.GlobalFaithfulAbstractState) -> mm.State:
         """ Get the representative mimir state in the complete concrete mimir state space.
@@ -50,4 +86,14 @@ class StateFinder:
         instance_data = self.instance_datas[instance_idx]
         gfa_state = self.gfa_states_by_instance_idx[instance_idx][instance_data.ss_state_idx_to_gfa_state_idx[ss_state_idx]]
 
-        return gfa_state
\ No newline at end of file
+        return gfa_state
+
+    def get_gfa_state_global_idx_from_ss_state_idx(self, instance_idx: int, ss_state_idx: int) -> int:
+        """ Get the global faithful abstract state index of a state index from a complete concrete mimir state space.
+        """
+        return int(self.ss_state_idx_to_gfa_state_global_idx[self.ss_state_offsets[instance_idx] + ss_state_idx])
+
+    def get_gfa_state_global_idxs_from_ss_state_idxs(self, instance_idx: int, ss_state_idxs: np.ndarray) -> np.ndarray:
+        """ Vectorized version of get_gfa_state_global_idx_from_ss_state_idx, e.g., for a whole layer of a tuple graph.
+        """
+        return self.ss_state_idx_to_gfa_state_global_idx[self.ss_state_offsets[instance_idx] + ss_state_idxs]
@@ -0,0 +1,35 @@
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+
+
+@dataclass
+class TupleGraphData:
+    """
+    Immutable data class.
+
+    TupleGraphData is a compact and picklable representation of a mimir TupleGraph.
+    States are represented by their indices in the complete concrete state space
+    of the instance that contains the root state.
+    """
+    _instance_idx: int
+    _ss_state_idxs_by_distance: List[np.ndarray]
+    _t_idxs_by_distance: List[np.ndarray]
+    _t_idx_to_ss_state_idxs: Dict[int, np.ndarray]
+
+    @property
+    def instance_idx(self):
+        return self._instance_idx
+
+    @property
+    def ss_state_idxs_by_distance(self):
+        return self._ss_state_idxs_by_distance
+
+    @property
+    def t_idxs_by_distance(self):
+        return self._t_idxs_by_distance
+
+    @property
+    def t_idx_to_ss_state_idxs(self):
+        return self._t_idx_to_ss_state_idxs
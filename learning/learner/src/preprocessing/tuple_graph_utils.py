@@ -1,23 +1,69 @@
-from typing import List, Dict
+from collections import defaultdict
+from typing import List, Dict, Tuple
 
+import numpy as np
 import pymimir as mm
 
 from .state_finder import StateFinder
 from .instance_data import InstanceData
 from .domain_data import DomainData
+from .tuple_graph_data import TupleGraphData
+from .resolved_tuple_graph import ResolvedTupleGraph
 
-from ..util import change_dir, write_file
+from ..util import change_dir, write_file, create_process_pool, get_worker_data, set_worker_data
 
 
-def compute_tuple_graphs(domain_data: DomainData, instance_datas: List[InstanceData], state_finder: StateFinder, width: int, enable_dump_files: bool):
-    """ Compute a tuple graph for each representative concrete state of each global faithful abstract state.
+def create_tuple_graph_data(instance_idx: int, mimir_ss: mm.StateSpace, tuple_graph: mm.TupleGraph) -> TupleGraphData:
+    """ Convert a mimir TupleGraph into the compact TupleGraphData.
     """
-    gfa_state_global_idx_to_tuple_graph: Dict[int, mm.TupleGraph] = dict()
+    ss_state_idxs_by_distance = []
+    for mimir_ss_states in tuple_graph.get_states_grouped_by_distance():
+        ss_state_idxs_by_distance.append(np.array([mimir_ss.get_state_index(mimir_ss_state) for mimir_ss_state in mimir_ss_states], dtype=np.int32))
+    t_idxs_by_distance = []
+    t_idx_to_ss_state_idxs = dict()
+    for tuple_vertex_group in tuple_graph.get_vertices_grouped_by_distance():
+        t_idxs = []
+        for tuple_vertex in tuple_vertex_group:
+            t_idx = tuple_vertex.get_index()
+            t_idxs.append(t_idx)
+            t_idx_to_ss_state_idxs[t_idx] = np.array([mimir_ss.get_state_index(mimir_ss_state) for mimir_ss_state in tuple_vertex.get_states()], dtype=np.int32)
+        t_idxs_by_distance.append(np.array(t_idxs, dtype=np.int32))
+    return TupleGraphData(instance_idx, ss_state_idxs_by_distance, t_idxs_by_distance, t_idx_to_ss_state_idxs)
+
+
+def _compute_tuple_graphs_of_instance(instance_idx: int, gfa_state_idxs: List[Tuple[int, int]]) -> List[Tuple[int, TupleGraphData]]:
+    """ Compute the tuple graphs of the given global faithful abstract states whose representative is in the given instance.
+
+    Reads the data set up in compute_tuple_graphs.
+    """
+    instance_data = get_worker_data("instance_datas")[instance_idx]
+    tuple_graph_factory = mm.TupleGraphFactory(instance_data.mimir_ss, get_worker_data("width"), True)
+    fa_states = get_worker_data("state_finder").fa_states_by_instance_idx[instance_idx]
+    enable_dump_files = get_worker_data("enable_dump_files")
+
+    tuple_graphs = []
+    for gfa_state_global_idx, fa_state_idx in gfa_state_idxs:
+        tuple_graph = tuple_graph_factory.create(fa_states[fa_state_idx].get_representative_state())
+        tuple_graphs.append((gfa_state_global_idx, create_tuple_graph_data(instance_idx, instance_data.mimir_ss, tuple_graph)))
+
+        with change_dir(f"tuple_graphs/{instance_idx}/{fa_state_idx}", enable=enable_dump_files):
+            if enable_dump_files:
+                write_file(f"{fa_state_idx}.dot", str(tuple_graph))
+
+    return tuple_graphs
 
-    tuple_graph_factories = []
-    for instance_data in instance_datas:
-        tuple_graph_factories.append(mm.TupleGraphFactory(instance_data.mimir_ss, width, True))
 
+def compute_tuple_graphs(domain_data: DomainData, instance_datas: List[InstanceData], state_finder: StateFinder, width: int, enable_dump_files: bool, num_workers: int = 1):
+    """ Compute a tuple graph for each representative concrete state of each global faithful abstract state.
+
+    With more than one worker, instances are sharded across forked worker processes
+    and the resulting TupleGraphDatas are merged by global index.
+    """
+    set_worker_data(instance_datas=instance_datas, state_finder=state_finder, width=width, enable_dump_files=enable_dump_files)
+
+    # Assign each global faithful abstract state to the instance that contains its representative state.
+    gfa_state_idxs_by_instance_idx: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+    gfa_state_global_idxs = set()
     for instance_data in instance_datas:
         gfa = instance_data.gfa
 
@@ -26,16 +72,35 @@ def compute_tuple_graphs(domain_data: DomainData, instance_datas: List[InstanceD
             if gfa.is_deadend_state(gfa_state.get_index()):
                 continue
 
-            if gfa_state.get_global_index() in gfa_state_global_idx_to_tuple_graph:
+            if gfa_state.get_global_index() in gfa_state_global_idxs:
                 continue
 
-            tuple_graph_factory = tuple_graph_factories[gfa_state.get_faithful_abstraction_index()]
-            ss_state = state_finder.get_mimir_ss_state(gfa_state)
-            tuple_graph = tuple_graph_factory.create(ss_state)
-            gfa_state_global_idx_to_tuple_graph[gfa_state.get_global_index()] = tuple_graph
+            gfa_state_global_idxs.add(gfa_state.get_global_index())
+            gfa_state_idxs_by_instance_idx[gfa_state.get_faithful_abstraction_index()].append((gfa_state.get_global_index(), gfa_state.get_faithful_abstract_state_index()))
 
-            with change_dir(f"tuple_graphs/{instance_data.idx}/{gfa_state.get_index()}", enable=enable_dump_files):
-                if enable_dump_files:
-                    write_file(f"{gfa_state.get_index()}.dot", str(tuple_graph))
+    # Schedule large instances first to balance the load.
+    instance_idxs = sorted(gfa_state_idxs_by_instance_idx.keys(), key=lambda instance_idx: len(gfa_state_idxs_by_instance_idx[instance_idx]), reverse=True)
+
+    gfa_state_global_idx_to_tuple_graph: Dict[int, TupleGraphData] = dict()
+    if num_workers > 1:
+        with create_process_pool(num_workers) as pool:
+            futures = [pool.submit(_compute_tuple_graphs_of_instance, instance_idx, gfa_state_idxs_by_instance_idx[instance_idx]) for instance_idx in instance_idxs]
+            for future in futures:
+                gfa_state_global_idx_to_tuple_graph.update(future.result())
+    else:
+        for instance_idx in instance_idxs:
+            gfa_state_global_idx_to_tuple_graph.update(_compute_tuple_graphs_of_instance(instance_idx, gfa_state_idxs_by_instance_idx[instance_idx]))
 
     return gfa_state_global_idx_to_tuple_graph
+
+
+def resolve_tuple_graphs(state_finder: StateFinder, gfa_state_global_idx_to_tuple_graph: Dict[int, TupleGraphData]) -> Dict[int, ResolvedTupleGraph]:
+    """ Map the concrete states of all tuple graphs to global faithful abstract state indices.
+    """
+    gfa_state_global_idx_to_resolved_tuple_graph: Dict[int, ResolvedTupleGraph] = dict()
+    for gfa_state_global_idx, tuple_graph in gfa_state_global_idx_to_tuple_graph.items():
+        instance_idx = tuple_graph.instance_idx
+        gfa_state_global_idxs_by_distance = [state_finder.get_gfa_state_global_idxs_from_ss_state_idxs(instance_idx, ss_state_idxs) for ss_state_idxs in tuple_graph.ss_state_idxs_by_distance]
+        t_idx_to_gfa_state_global_idxs = {t_idx: state_finder.get_gfa_state_global_idxs_from_ss_state_idxs(instance_idx, ss_state_idxs) for t_idx, ss_state_idxs in tuple_graph.t_idx_to_ss_state_idxs.items()}
+        gfa_state_global_idx_to_resolved_tuple_graph[gfa_state_global_idx] = ResolvedTupleGraph(gfa_state_global_idxs_by_distance, tuple_graph.t_idxs_by_distance, t_idx_to_gfa_state_global_idxs)
+    return gfa_state_global_idx_to_resolved_tuple_graph
@@ -1,4 +1,6 @@
 from .command import read_file, write_file, change_working_directory, create_experiment_workspace, change_dir
 from .console import add_console_handler, print_separation_line
+from .parallel import create_process_pool, create_shared_value, get_num_available_cores, get_worker_data, set_worker_data
 from .performance import memory_usage
+from .profiler import Profiler, profiler
 from .timer import CountDownTimer, Timer
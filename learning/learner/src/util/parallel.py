@@ -0,0 +1,54 @@
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Read by forked workers, see set_worker_data.
+_worker_data = dict()
+
+
+def get_num_available_cores() -> int:
+    """ Return the number of cores in the CPU affinity mask of this process. """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def set_worker_data(**data):
+    """ Set data that worker processes forked afterwards read with get_worker_data.
+
+    Workers inherit the data with the memory of the parent, such that it is not pickled
+    and can include pymimir and dlplan objects. Data set after forking is not visible to existing workers.
+    """
+    _worker_data.update(data)
+
+
+def get_worker_data(name: str):
+    """ Get the data set with set_worker_data before this worker was forked. """
+    return _worker_data[name]
+
+
+def _wait_for_workers(_) -> int:
+    get_worker_data("start_barrier").wait()
+    return os.getpid()
+
+
+def create_process_pool(num_workers: int) -> ProcessPoolExecutor:
+    """ Create a pool of forked worker processes.
+
+    Workers inherit the memory of the parent, including pymimir and dlplan objects
+    that cannot be pickled, hence, everything a worker reads must be set up with set_worker_data before creating the pool or passed with the tasks.
+    All workers are forked before returning, such that no worker is forked later, e.g., after clingo started its threads.
+    """
+    context = multiprocessing.get_context("fork")
+    set_worker_data(start_barrier=context.Barrier(num_workers))
+    pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=context)
+    # Each task blocks until all workers run one, hence, the pool has to start all of them.
+    list(pool.map(_wait_for_workers, range(num_workers)))
+    return pool
+
+
+def create_shared_value(typecode: str, value):
+    """ Create a value in shared memory that is visible to forked workers created afterwards. """
+    return multiprocessing.get_context("fork").Value(typecode, value)
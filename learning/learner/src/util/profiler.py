@@ -0,0 +1,150 @@
+import csv
+import json
+import os
+import resource
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+
+PROFILE_JSON_FILENAME = "profile.json"
+PROFILE_STAGES_CSV_FILENAME = "profile_stages.csv"
+PROFILE_COUNTERS_CSV_FILENAME = "profile_counters.csv"
+
+
+def _get_cpu_time() -> float:
+    """ Return the CPU time of this process and its terminated worker processes. """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def _get_peak_rss_kib() -> Union[int, None]:
+    """ Return the high-water mark VmHWM of the resident set size of this process, or None if it is unavailable. """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    """ Reset VmHWM of this process to its current resident set size, and return whether this is supported. """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class Profiler:
+    """ Record wall time, CPU time and peak RSS of pipeline stages and counters per iteration.
+
+    Stages and counters are keyed by iteration and name, repeated stages accumulate their times.
+    Stages outside of the learning iterations, e.g., preprocessing, have iteration None.
+
+    The peak RSS of a stage is the peak of the process that runs it, measured by resetting VmHWM when the stage starts.
+    Where VmHWM cannot be reset, it is the peak since the start of the process, which is marked by the peak_rss_scope "process".
+    """
+    def __init__(self):
+        self.iteration: Union[int, None] = None
+        self.stages: Dict[Tuple[Union[int, None], str], Dict] = dict()
+        self.counters: Dict[Tuple[Union[int, None], str], int] = dict()
+        # Peaks in KiB of the stages that are currently running, innermost last, and of the whole run.
+        self._stage_peak_rss_kibs: List[int] = []
+        self._run_peak_rss_kib = 0
+
+    def reset(self):
+        self.iteration = None
+        self.stages = dict()
+        self.counters = dict()
+        self._stage_peak_rss_kibs = []
+        self._run_peak_rss_kib = 0
+
+    def set_iteration(self, iteration: Union[int, None]):
+        self.iteration = iteration
+
+    def _update_peak_rss(self):
+        """ Fold the current VmHWM into the peaks of the running stages and of the whole run before it is reset. """
+        peak_rss_kib = _get_peak_rss_kib()
+        if peak_rss_kib is None:
+            return
+        self._stage_peak_rss_kibs = [max(stage_peak_rss_kib, peak_rss_kib) for stage_peak_rss_kib in self._stage_peak_rss_kibs]
+        self._run_peak_rss_kib = max(self._run_peak_rss_kib, peak_rss_kib)
+
+    @contextmanager
+    def stage(self, name: str):
+        self._update_peak_rss()
+        is_per_stage = _reset_peak_rss()
+        self._stage_peak_rss_kibs.append(0)
+        start_wall_time = time.perf_counter()
+        start_cpu_time = _get_cpu_time()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start_wall_time
+            cpu_time = _get_cpu_time() - start_cpu_time
+            self._update_peak_rss()
+            peak_rss_kib = self._stage_peak_rss_kibs.pop()
+            if not is_per_stage:
+                # ru_maxrss is in KiB on Linux
+                peak_rss_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.merge_stages([{
+                "iteration": self.iteration, "stage": name, "calls": 1, "wall_time_sec": wall_time, "cpu_time_sec": cpu_time,
+                "peak_rss_mib": peak_rss_kib / 1024, "peak_rss_scope": "stage" if is_per_stage else "process"}])
+
+    def merge_stages(self, stages: List[Dict]):
+        """ Accumulate stage records as returned by to_dict, e.g., the stages recorded by worker processes. """
+        for stage in stages:
+            record = self.stages.setdefault((stage["iteration"], stage["stage"]), {"calls": 0, "wall_time_sec": 0.0, "cpu_time_sec": 0.0, "peak_rss_mib": 0.0, "peak_rss_scope": "stage"})
+            record["calls"] += stage["calls"]
+            record["wall_time_sec"] += stage["wall_time_sec"]
+            record["cpu_time_sec"] += stage["cpu_time_sec"]
+            record["peak_rss_mib"] = max(record["peak_rss_mib"], stage["peak_rss_mib"])
+            if stage["peak_rss_scope"] != "stage":
+                record["peak_rss_scope"] = stage["peak_rss_scope"]
+            self._run_peak_rss_kib = max(self._run_peak_rss_kib, int(stage["peak_rss_mib"] * 1024))
+
+    def count(self, name: str, value: int = 1):
+        """ Add value to the counter with the given name in the current iteration. """
+        key = (self.iteration, name)
+        self.counters[key] = self.counters.get(key, 0) + int(value)
+
+    def to_dict(self) -> Dict:
+        """ Return the report with one entry per iteration and stage, and per iteration and counter.
+
+        The peak RSS of the run is the maximum over this process, its stages, and its terminated worker processes.
+        """
+        self._update_peak_rss()
+        # ru_maxrss is in KiB on Linux
+        run_peak_rss_kib = max(self._run_peak_rss_kib, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return {
+            "peak_rss_mib": run_peak_rss_kib / 1024,
+            "stages": [{"iteration": iteration, "stage": name, **record} for (iteration, name), record in self.stages.items()],
+            "counters": [{"iteration": iteration, "counter": name, "value": value} for (iteration, name), value in self.counters.items()]}
+
+    def write(self, directory: Path):
+        """ Write the report as JSON and as CSV files into the given directory. """
+        os.makedirs(directory, exist_ok=True)
+        report = self.to_dict()
+        stages, counters = report["stages"], report["counters"]
+        with open(directory / PROFILE_JSON_FILENAME, "w") as f:
+            json.dump(report, f, indent=2)
+        with open(directory / PROFILE_STAGES_CSV_FILENAME, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["iteration", "stage", "calls", "wall_time_sec", "cpu_time_sec", "peak_rss_mib", "peak_rss_scope"])
+            writer.writeheader()
+            writer.writerows(stages)
+        with open(directory / PROFILE_COUNTERS_CSV_FILENAME, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["iteration", "counter", "value"])
+            writer.writeheader()
+            writer.writerows(counters)
+
+
+# The profiler of the current learning run, such that stages can be recorded without passing it around.
+profiler = Profiler()
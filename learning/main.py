@@ -5,7 +5,7 @@ import argparse
 from pathlib import Path
 
 from learner.learner import learn_sketch_for_problem_class
-from learner.src.iteration import EncodingType
+from learner.src.iteration import EncodingType, PARALLEL_MODES, CONFIGURATIONS, OPT_STRATEGIES
 
 
 if __name__ == "__main__":
@@ -31,8 +31,20 @@ if __name__ == "__main__":
     parser.add_argument("--additional_booleans", nargs='*', default=None, help="Additional boolean features to include.")
     parser.add_argument("--additional_numericals", nargs='*', default=None, help="Additional numerical features to include.")
     parser.add_argument("--enable_dump_files", action='store_true', default=False, help="Whether data should be written to files.")
+    parser.add_argument("--num_workers", type=int, default=1, help="The number of worker processes used for preprocessing and verification.")
+    parser.add_argument("--cache_directory", type=Path, default=None, help="The directory for cached mappings to abstract states and tuple graphs. State spaces and abstractions are always recomputed. Default is the cache directory in the workspace.")
+    parser.add_argument("--disable_cache", action='store_true', default=False, help="Whether to disable the cache of mappings to abstract states and tuple graphs. Default is False.")
+    parser.add_argument("--asp_num_threads", type=int, default=None, help="The number of threads used by clingo. Default is the number of cores available to this process.")
+    parser.add_argument("--asp_parallel_mode", type=str, default="split", choices=PARALLEL_MODES, help="Whether clingo threads split the search space or compete. Default is split.")
+    parser.add_argument("--asp_configuration", type=str, default=None, choices=CONFIGURATIONS, help="The clingo solver configuration. Default is the clingo default.")
+    parser.add_argument("--asp_opt_strategy", type=str, default=None, choices=OPT_STRATEGIES, help="The clingo optimization strategy, bb for model-guided or usc for core-guided, optionally followed by a tactic. Default is the clingo default.")
+    parser.add_argument("--disable_incremental_iterations", action='store_true', default=False, help="Whether to recompute feature valuations and equivalences of all states in each iteration. Default is False.")
+    parser.add_argument("--initial_complexity_limit", type=int, default=None, help="The complexity limit of features in the first iteration, which is increased by one whenever no sketch exists. Each increase extends the feature pool by the features of the next complexity, but dlplan generates all features up to the limit again. Default is to use the complexity limits from the start.")
+    parser.add_argument("--disable_feature_collapsing", action='store_true', default=False, help="Whether to pass all features to the ASP instead of one representative of features that the ASP cannot distinguish. Default is False.")
 
     args = parser.parse_args()
+    if args.asp_num_threads is not None and args.asp_num_threads < 1:
+        parser.error("argument --asp_num_threads: must be positive")
 
     learn_sketch_for_problem_class(args.domain_filepath.resolve(),
                                    args.problems_directory.resolve(),
@@ -54,4 +66,14 @@ if __name__ == "__main__":
                                    args.feature_limit,
                                    args.additional_booleans,
                                    args.additional_numericals,
-                                   args.enable_dump_files)
+                                   args.enable_dump_files,
+                                   args.num_workers,
+                                   args.cache_directory.resolve() if args.cache_directory is not None else None,
+                                   args.disable_cache,
+                                   args.asp_num_threads,
+                                   args.asp_parallel_mode,
+                                   args.asp_configuration,
+                                   args.asp_opt_strategy,
+                                   args.disable_incremental_iterations,
+                                   args.initial_complexity_limit,
+                                   args.disable_feature_collapsing)
@@ -0,0 +1,55 @@
+import numpy as np
+
+from clingo import Function, Number
+
+from learner.src.iteration.asp import ASPFactory, EncodingType
+from learner.src.iteration.iteration_data import IterationData
+from learner.src.iteration.state_pair_classes import StatePairClasses
+
+
+def _make_unsatisfied_d2_pairs_pairwise(conditions, effects, good_r_idxs, selected_f_idxs):
+    """ The pairwise procedure that make_unsatisfied_d2_facts replaced. """
+    pairs = set()
+    for good in good_r_idxs:
+        for bad in range(len(conditions)):
+            if bad in good_r_idxs:
+                continue
+            if all(conditions[good, f_idx] == conditions[bad, f_idx] and effects[good, f_idx] == effects[bad, f_idx] for f_idx in selected_f_idxs):
+                pairs.add((good, bad))
+    return pairs
+
+
+def test_make_unsatisfied_d2_facts_matches_pairwise_procedure():
+    asp_factory = ASPFactory(EncodingType.D2, False, 4)
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        num_rules = int(rng.integers(1, 20))
+        num_features = int(rng.integers(1, 6))
+        conditions = rng.random((num_rules, num_features)) < 0.5
+        effects = rng.integers(-1, 2, size=(num_rules, num_features)).astype(np.int8)
+        # ASP features are a subset of the feature pool.
+        asp_f_idx_to_f_idx = np.flatnonzero(rng.random(num_features) < 0.7)
+        good_r_idxs = {r_idx for r_idx in range(num_rules) if rng.random() < 0.5}
+        selected_asp_f_idxs = [asp_f_idx for asp_f_idx in range(len(asp_f_idx_to_f_idx)) if rng.random() < 0.5]
+        symbols = [Function("good", [Number(r_idx)]) for r_idx in sorted(good_r_idxs)] \
+            + [Function("select", [Number(asp_f_idx)]) for asp_f_idx in selected_asp_f_idxs] \
+            + [Function("numerical", [Number(0)])]
+        iteration_data = IterationData(state_pair_equivalences=StatePairClasses(conditions, effects), asp_f_idx_to_f_idx=asp_f_idx_to_f_idx)
+
+        facts = asp_factory.make_unsatisfied_d2_facts(iteration_data, symbols)
+
+        expected = _make_unsatisfied_d2_pairs_pairwise(conditions, effects, good_r_idxs, asp_f_idx_to_f_idx[selected_asp_f_idxs].tolist())
+        assert {(name, good.number, bad.number) for name, (good, bad) in facts} == {("d2_separate", good, bad) for good, bad in expected}
+
+
+def test_make_unsatisfied_d2_facts_without_selected_features():
+    asp_factory = ASPFactory(EncodingType.D2, False, 4)
+    conditions = np.array([[True], [False], [True]])
+    effects = np.array([[1], [0], [-1]], dtype=np.int8)
+    iteration_data = IterationData(state_pair_equivalences=StatePairClasses(conditions, effects), asp_f_idx_to_f_idx=np.array([0]))
+    symbols = [Function("good", [Number(0)])]
+
+    facts = asp_factory.make_unsatisfied_d2_facts(iteration_data, symbols)
+
+    # Without selected features no pair of good and bad classes is separated.
+    assert {(good.number, bad.number) for _, (good, bad) in facts} == {(0, 1), (0, 2)}
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from learner.src.preprocessing.cache_utils import make_manifest, make_offsets, save_instance_datas, load_instance_datas, save_tuple_graphs, load_tuple_graphs, \
+    MANIFEST_FILENAME, TUPLE_GRAPHS_FILENAME
+from learner.src.preprocessing.tuple_graph_data import TupleGraphData
+
+
+def _make_instance_datas():
+    return [SimpleNamespace(ss_state_idx_to_gfa_state_idx={0: 0, 1: 2, 2: 1}),
+            SimpleNamespace(ss_state_idx_to_gfa_state_idx={}),
+            SimpleNamespace(ss_state_idx_to_gfa_state_idx={0: 1, 1: 0})]
+
+
+def _make_tuple_graphs():
+    return {
+        4: TupleGraphData(0, [np.array([0]), np.array([1, 2])], [np.array([0]), np.array([1, 2])], {0: np.array([0]), 1: np.array([1]), 2: np.array([1, 2])}),
+        # Tuple graphs can have empty layers and tuples without states.
+        0: TupleGraphData(2, [np.array([1]), np.array([], dtype=np.int32), np.array([0])], [np.array([3]), np.array([], dtype=np.int32)], {3: np.array([], dtype=np.int32)}),
+        7: TupleGraphData(2, [], [], {}),
+    }
+
+
+def _assert_equal_tuple_graphs(tuple_graphs_1, tuple_graphs_2):
+    assert tuple_graphs_1.keys() == tuple_graphs_2.keys()
+    for gfa_state_global_idx, tuple_graph_1 in tuple_graphs_1.items():
+        tuple_graph_2 = tuple_graphs_2[gfa_state_global_idx]
+        assert tuple_graph_1.instance_idx == tuple_graph_2.instance_idx
+        assert [array.tolist() for array in tuple_graph_1.ss_state_idxs_by_distance] == [array.tolist() for array in tuple_graph_2.ss_state_idxs_by_distance]
+        assert [array.tolist() for array in tuple_graph_1.t_idxs_by_distance] == [array.tolist() for array in tuple_graph_2.t_idxs_by_distance]
+        assert {t_idx: array.tolist() for t_idx, array in tuple_graph_1.t_idx_to_ss_state_idxs.items()} == {t_idx: array.tolist() for t_idx, array in tuple_graph_2.t_idx_to_ss_state_idxs.items()}
+
+
+def test_make_offsets():
+    assert make_offsets([]).tolist() == [0]
+    assert make_offsets([2, 0, 3]).tolist() == [0, 2, 2, 5]
+
+
+def test_instance_datas_round_trip(tmp_path):
+    manifest = make_manifest(["a.pddl", "b.pddl", "c.pddl"], [3, 0, 2], [3, 0, 2])
+    save_instance_datas(tmp_path, manifest, _make_instance_datas())
+
+    assert not list(tmp_path.glob("*.tmp"))
+    assert load_instance_datas(tmp_path, manifest) == [instance_data.ss_state_idx_to_gfa_state_idx for instance_data in _make_instance_datas()]
+    assert load_instance_datas(tmp_path, make_manifest(["a.pddl", "b.pddl", "c.pddl"], [3, 0, 2], [3, 0, 1])) is None
+    assert load_instance_datas(tmp_path / "missing", manifest) is None
+    assert load_instance_datas(None, manifest) is None
+
+
+def test_tuple_graphs_round_trip(tmp_path):
+    manifest = make_manifest(["a.pddl", "b.pddl", "c.pddl"], [3, 0, 2], [3, 0, 2])
+    save_instance_datas(tmp_path, manifest, _make_instance_datas())
+    save_tuple_graphs(tmp_path, _make_tuple_graphs())
+
+    assert not list(tmp_path.glob("*.tmp"))
+    _assert_equal_tuple_graphs(load_tuple_graphs(tmp_path, 3), _make_tuple_graphs())
+    assert load_tuple_graphs(tmp_path, 2) is None
+    assert load_tuple_graphs(None, 3) is None
+
+
+def test_tuple_graphs_are_rejected_for_other_manifest(tmp_path):
+    manifest = make_manifest(["a.pddl", "b.pddl", "c.pddl"], [3, 0, 2], [3, 0, 2])
+    save_instance_datas(tmp_path, manifest, _make_instance_datas())
+    save_tuple_graphs(tmp_path, _make_tuple_graphs())
+    tuple_graphs_bytes = (tmp_path / TUPLE_GRAPHS_FILENAME).read_bytes()
+
+    # Storing the mappings of other instances removes the tuple graphs.
+    save_instance_datas(tmp_path, make_manifest(["a.pddl", "b.pddl", "d.pddl"], [3, 0, 2], [3, 0, 2]), _make_instance_datas())
+    assert load_tuple_graphs(tmp_path, 3) is None
+
+    # Tuple graphs that are left over from other instances are rejected.
+    (tmp_path / TUPLE_GRAPHS_FILENAME).write_bytes(tuple_graphs_bytes)
+    assert load_tuple_graphs(tmp_path, 3) is None
+
+    # Without a manifest there is nothing to validate against.
+    (tmp_path / MANIFEST_FILENAME).unlink()
+    assert load_tuple_graphs(tmp_path, 3) is None
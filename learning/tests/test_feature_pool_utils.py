@@ -0,0 +1,123 @@
+from types import SimpleNamespace
+
+import numpy as np
+import dlplan.core as dlplan_core
+
+from learner.src.iteration import feature_pool_utils
+from learner.src.iteration.feature_pool import Feature
+from learner.src.iteration.feature_pool_utils import compute_feature_representatives
+from learner.src.iteration.feature_valuations import FeatureValuations
+from learner.src.iteration.iteration_data import IterationData
+from learner.src.iteration.state_pair_classes import StatePairClasses
+from learner.src.util import parallel
+
+
+def _make_dlplan_features():
+    vocabulary_info = dlplan_core.VocabularyInfo()
+    vocabulary_info.add_predicate("p", 1, False)
+    syntactic_element_factory = dlplan_core.SyntacticElementFactory(vocabulary_info)
+    return syntactic_element_factory.parse_boolean("b_empty(c_primitive(p,0))"), syntactic_element_factory.parse_numerical("n_count(c_primitive(p,0))")
+
+
+def _compute_feature_representatives_pairwise(conditions, effects, valuations, feature_pool, enable_goal_separating_features):
+    """ Keep each feature that is not equivalent to a feature of smaller complexity or index. """
+    def is_equivalent(f_idx_1, f_idx_2):
+        return isinstance(feature_pool[f_idx_1].dlplan_feature, dlplan_core.Boolean) == isinstance(feature_pool[f_idx_2].dlplan_feature, dlplan_core.Boolean) \
+            and np.array_equal(conditions[:, f_idx_1], conditions[:, f_idx_2]) \
+            and np.array_equal(effects[:, f_idx_1], effects[:, f_idx_2]) \
+            and (not enable_goal_separating_features or np.array_equal(valuations[:, f_idx_1] > 0, valuations[:, f_idx_2] > 0))
+
+    def key(f_idx):
+        return feature_pool[f_idx].complexity, f_idx
+
+    return [f_idx_1 for f_idx_1 in range(len(feature_pool))
+            if not any(key(f_idx_2) < key(f_idx_1) and is_equivalent(f_idx_1, f_idx_2) for f_idx_2 in range(len(feature_pool)))]
+
+
+def test_compute_feature_representatives_matches_pairwise_procedure():
+    boolean, numerical = _make_dlplan_features()
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        num_rules = int(rng.integers(0, 5))
+        num_states = int(rng.integers(1, 4))
+        num_features = int(rng.integers(1, 10))
+        # Few distinct values such that many features are equivalent.
+        conditions = rng.random((num_rules, num_features)) < 0.5
+        effects = rng.integers(0, 2, size=(num_rules, num_features)).astype(np.int8)
+        valuations = rng.integers(0, 2, size=(num_states, num_features)).astype(np.int32)
+        feature_pool = [Feature(boolean if rng.random() < 0.5 else numerical, int(rng.integers(1, 4))) for _ in range(num_features)]
+        for enable_goal_separating_features in [False, True]:
+            iteration_data = IterationData(
+                feature_pool=feature_pool,
+                feature_valuations=FeatureValuations(np.arange(num_states), np.arange(num_states), valuations),
+                state_pair_equivalences=StatePairClasses(conditions, effects))
+
+            representatives = compute_feature_representatives(iteration_data, enable_goal_separating_features)
+
+            assert representatives.tolist() == _compute_feature_representatives_pairwise(conditions, effects, valuations, feature_pool, enable_goal_separating_features)
+
+
+def test_compute_feature_representatives_prefers_smallest_complexity():
+    boolean, numerical = _make_dlplan_features()
+    conditions = np.array([[True, True, True, True]])
+    effects = np.array([[1, 1, 1, 1]], dtype=np.int8)
+    valuations = np.array([[1, 1, 1, 2]], dtype=np.int32)
+    feature_pool = [Feature(boolean, 3), Feature(boolean, 2), Feature(numerical, 5), Feature(numerical, 4)]
+    iteration_data = IterationData(
+        feature_pool=feature_pool,
+        feature_valuations=FeatureValuations(np.arange(1), np.arange(1), valuations),
+        state_pair_equivalences=StatePairClasses(conditions, effects))
+
+    # Booleans and numericals are never equivalent.
+    assert compute_feature_representatives(iteration_data, False).tolist() == [1, 3]
+    assert compute_feature_representatives(iteration_data, True).tolist() == [1, 3]
+
+
+class _StateFinder:
+    """ Finds the dlplan states of global indices and counts the lookups. """
+    def __init__(self, dlplan_states):
+        self.dlplan_states = dlplan_states
+        self.num_lookups = 0
+
+    def get_dlplan_ss_state_from_global_idx(self, gfa_state_global_idx):
+        self.num_lookups += 1
+        return self.dlplan_states[gfa_state_global_idx]
+
+    def get_instance_idx_from_global_idx(self, gfa_state_global_idx):
+        return 0
+
+
+def test_prune_feature_shard_reads_cached_valuations(monkeypatch):
+    vocabulary_info = dlplan_core.VocabularyInfo()
+    vocabulary_info.add_predicate("p", 1, False)
+    vocabulary_info.add_predicate("q", 1, False)
+    instance_info = dlplan_core.InstanceInfo(0, vocabulary_info)
+    atom_idxs = [instance_info.add_atom("p", ["a"]).get_index(), instance_info.add_atom("p", ["b"]).get_index(), instance_info.add_atom("q", ["a"]).get_index()]
+    dlplan_states = [dlplan_core.State(i, instance_info, [atom_idxs[j] for j in atoms]) for i, atoms in enumerate([[], [0], [0, 1], [1, 2]])]
+    syntactic_element_factory = dlplan_core.SyntacticElementFactory(vocabulary_info)
+    shard = [(False, "n_count(c_primitive(p,0))"), (True, "b_empty(c_primitive(q,0))"), (False, "n_count(c_primitive(q,0))"), (True, "b_empty(c_primitive(p,0))")]
+    valuations = np.array([[int(syntactic_element_factory.parse_boolean(representation).evaluate(dlplan_state)) if is_boolean else syntactic_element_factory.parse_numerical(representation).evaluate(dlplan_state)
+                            for is_boolean, representation in shard] for dlplan_state in dlplan_states], dtype=np.int32)
+    gfa_state_global_idxs = np.arange(len(dlplan_states), dtype=np.int64)
+    pruning_rows = (None, None, np.array([0, 1, 2, 3, 1]), np.array([1, 2, 3, 0, 3]))
+
+    def prune(cached_valuations):
+        state_finder = _StateFinder(dlplan_states)
+        monkeypatch.setitem(parallel._worker_data, "preprocessing_data", SimpleNamespace(
+            state_finder=state_finder,
+            domain_data=SimpleNamespace(syntactic_element_factory=syntactic_element_factory),
+            instance_datas=[None]))
+        verdicts, keys, _ = feature_pool_utils._prune_feature_shard(shard, cached_valuations, gfa_state_global_idxs, pruning_rows, False)
+        return verdicts, keys, state_finder.num_lookups
+
+    verdicts, keys, num_lookups = prune(None)
+    assert num_lookups == len(dlplan_states)
+    assert keys == feature_pool_utils._compute_feature_verdicts(valuations, pruning_rows, False)[1]
+
+    # All valuations are cached, hence, no state is looked up.
+    assert prune((valuations.copy(), np.ones(valuations.shape, dtype=bool))) == (verdicts, keys, 0)
+
+    # Only the states with valuations that are not cached are looked up.
+    is_evaluated = np.array([[True, True, True, True], [True, False, True, True], [False, False, False, False], [True, True, True, True]])
+    cached_valuations = np.where(is_evaluated, valuations, -1).astype(np.int32)
+    assert prune((cached_valuations, is_evaluated)) == (verdicts, keys, 2)
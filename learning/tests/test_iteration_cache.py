@@ -0,0 +1,120 @@
+import numpy as np
+import dlplan.core as dlplan_core
+
+from learner.src.iteration import iteration_cache as iteration_cache_module
+from learner.src.iteration.feature_pool import Feature
+from learner.src.iteration.iteration_cache import IterationCache
+from learner.src.iteration.iteration_data import IterationData
+from learner.src.iteration.state_pair_equivalence import StatePairEquivalence
+from learner.src.iteration.state_pair_equivalence_utils import remap_state_pair_equivalence, _remap_cached_rules
+from learner.src.iteration.tuple_graph_equivalence import TupleGraphEquivalence
+from learner.src.iteration.tuple_graph_equivalence_utils import remap_tuple_graph_equivalence
+
+
+def _fill(iteration_cache: IterationCache, gfa_state_global_idxs, feature_keys):
+    """ Reserve and write the valuation gfa_state_global_idx * 100 + len(feature_key) of each entry. """
+    iteration_cache.reserve(gfa_state_global_idxs, feature_keys)
+    rows = iteration_cache.find_rows(gfa_state_global_idxs)
+    columns = iteration_cache.find_columns(feature_keys)
+    for gfa_state_global_idx, row in zip(gfa_state_global_idxs, rows.tolist()):
+        for feature_key, column in zip(feature_keys, columns.tolist()):
+            iteration_cache.valuations[row, column] = gfa_state_global_idx * 100 + len(feature_key)
+            iteration_cache.is_evaluated[row, column] = True
+
+
+def _assert_valuations(iteration_cache: IterationCache, filled_entries):
+    """ Check that exactly the filled entries of the remaining rows and columns are evaluated and hold their valuation. """
+    for gfa_state_global_idx, row in iteration_cache.gfa_state_global_idx_to_row.items():
+        for feature_key, column in iteration_cache.feature_key_to_column.items():
+            is_filled = (gfa_state_global_idx, feature_key) in filled_entries
+            assert iteration_cache.is_evaluated[row, column] == is_filled
+            assert iteration_cache.valuations[row, column] == (gfa_state_global_idx * 100 + len(feature_key) if is_filled else 0)
+
+
+def test_reserve_grows_and_keeps_valuations():
+    iteration_cache = IterationCache()
+    _fill(iteration_cache, [5, 7], ["a", "bb"])
+    _fill(iteration_cache, [7, 9, 11], ["bb", "ccc"])
+    filled_entries = {(5, "a"), (5, "bb"), (7, "a"), (7, "bb"), (7, "ccc"), (9, "bb"), (9, "ccc"), (11, "bb"), (11, "ccc")}
+
+    assert iteration_cache.find_rows([5, 7, 9, 11, 13]).tolist() == [0, 1, 2, 3, -1]
+    assert iteration_cache.find_columns(["a", "bb", "ccc", "dddd"]).tolist() == [0, 1, 2, -1]
+    assert iteration_cache.valuations.shape[0] >= 4 and iteration_cache.valuations.shape[1] >= 3
+    _assert_valuations(iteration_cache, filled_entries)
+
+
+def test_reserve_evicts_under_tiny_cap(monkeypatch):
+    monkeypatch.setattr(iteration_cache_module, "MAX_NUM_CACHED_VALUATIONS", 6)
+    iteration_cache = IterationCache()
+    _fill(iteration_cache, [1, 2, 3], ["a", "bb"])
+    assert len(iteration_cache.gfa_state_global_idx_to_row) == 3
+
+    # 4 rows and 2 columns exceed the cap, such that only the requested rows and columns are kept.
+    _fill(iteration_cache, [3, 4], ["bb"])
+
+    assert iteration_cache.gfa_state_global_idx_to_row == {3: 0, 4: 1}
+    assert iteration_cache.feature_key_to_column == {"bb": 0}
+    _assert_valuations(iteration_cache, {(3, "bb"), (4, "bb")})
+
+    # Within the cap nothing is evicted.
+    _fill(iteration_cache, [5], ["a"])
+
+    assert set(iteration_cache.gfa_state_global_idx_to_row) == {3, 4, 5}
+    assert set(iteration_cache.feature_key_to_column) == {"bb", "a"}
+    _assert_valuations(iteration_cache, {(3, "bb"), (4, "bb"), (5, "a")})
+
+
+def test_remap_state_pair_equivalence_merges_rules():
+    state_pair_equivalence = StatePairEquivalence(
+        {0: {10, 11}, 1: {12}, 2: {13, 14}},
+        {0: 2, 1: 1, 2: 3},
+        {10: 0, 11: 0, 12: 1, 13: 2, 14: 2})
+
+    remapped = remap_state_pair_equivalence(state_pair_equivalence, np.array([1, 0, 1]))
+
+    assert remapped.r_idx_to_subgoal_gfa_state_ids == {1: {10, 11, 13, 14}, 0: {12}}
+    assert remapped.r_idx_to_closest_subgoal_distance == {1: 2, 0: 1}
+    assert remapped.subgoal_gfa_state_id_to_r_idx == {10: 1, 11: 1, 12: 0, 13: 1, 14: 1}
+    # The cached equivalence is left unchanged.
+    assert state_pair_equivalence.r_idx_to_subgoal_gfa_state_ids == {0: {10, 11}, 1: {12}, 2: {13, 14}}
+
+
+def test_remap_tuple_graph_equivalence_merges_rules():
+    tuple_graph_equivalence = TupleGraphEquivalence({0: {0, 2}, 1: {1}}, {0: 1, 1: 2}, {0: 4, 1: 3, 2: 2})
+
+    remapped = remap_tuple_graph_equivalence(tuple_graph_equivalence, np.array([0, 1, 0]))
+
+    assert remapped.t_idx_to_r_idxs == {0: {0}, 1: {1}}
+    assert remapped.t_idx_to_distance == {0: 1, 1: 2}
+    assert remapped.r_idx_to_deadend_distance == {0: 2, 1: 3}
+
+
+def test_remap_cached_rules_merges_rules_of_removed_features():
+    vocabulary_info = dlplan_core.VocabularyInfo()
+    vocabulary_info.add_predicate("p", 1, False)
+    vocabulary_info.add_predicate("q", 1, False)
+    syntactic_element_factory = dlplan_core.SyntacticElementFactory(vocabulary_info)
+    f_p = Feature(syntactic_element_factory.parse_boolean("b_empty(c_primitive(p,0))"), 2)
+    f_q = Feature(syntactic_element_factory.parse_boolean("b_empty(c_primitive(q,0))"), 2)
+    f_n = Feature(syntactic_element_factory.parse_numerical("n_count(c_primitive(p,0))"), 2)
+
+    # Rules 0 and 1 differ only in f_q.
+    iteration_cache = IterationCache(
+        feature_pool_key=tuple(str(feature.dlplan_feature) for feature in [f_p, f_q, f_n]),
+        conditions=[np.array([True, True, False]), np.array([True, False, False]), np.array([False, True, True])],
+        effects=[np.array([0, 1, -1], dtype=np.int8), np.array([0, 0, -1], dtype=np.int8), np.array([1, 0, 0], dtype=np.int8)],
+        gfa_state_global_idx_to_state_pair_equivalence={0: StatePairEquivalence({0: {1}, 1: {2}, 2: {3}}, {0: 2, 1: 1, 2: 1}, {1: 0, 2: 1, 3: 2})},
+        gfa_state_global_idx_to_tuple_graph_equivalence={0: TupleGraphEquivalence({0: {0, 1}, 1: {2}}, {0: 1, 1: 1}, {0: 3, 1: 5})})
+    iteration_data = IterationData(feature_pool=[f_n, f_p])
+
+    _remap_cached_rules(None, iteration_data, iteration_cache)
+
+    assert iteration_cache.feature_pool_key == (str(f_n.dlplan_feature), str(f_p.dlplan_feature))
+    assert [conditions.tolist() for conditions in iteration_cache.conditions] == [[False, True], [True, False]]
+    assert [effects.tolist() for effects in iteration_cache.effects] == [[-1, 0], [0, 1]]
+    state_pair_equivalence = iteration_cache.gfa_state_global_idx_to_state_pair_equivalence[0]
+    assert state_pair_equivalence.r_idx_to_subgoal_gfa_state_ids == {0: {1, 2}, 1: {3}}
+    assert state_pair_equivalence.r_idx_to_closest_subgoal_distance == {0: 1, 1: 1}
+    tuple_graph_equivalence = iteration_cache.gfa_state_global_idx_to_tuple_graph_equivalence[0]
+    assert tuple_graph_equivalence.t_idx_to_r_idxs == {0: {0}, 1: {1}}
+    assert tuple_graph_equivalence.r_idx_to_deadend_distance == {0: 3}
@@ -0,0 +1,146 @@
+import importlib
+
+import pytest
+
+from learner.src.util.profiler import Profiler
+
+
+# The package exports the profiler instance under the name of its module.
+profiler_module = importlib.import_module("learner.src.util.profiler")
+
+# Larger than the resident set size of the test process, such that the simulated peaks dominate ru_maxrss.
+GIB_IN_KIB = 1024 * 1024
+
+
+class _Memory:
+    """ Simulates the resident set size of this process and its high-water mark VmHWM in KiB. """
+    def __init__(self, rss_kib: int, is_resettable: bool = True):
+        self.rss_kib = rss_kib
+        self.peak_rss_kib = rss_kib
+        self.is_resettable = is_resettable
+
+    def set(self, rss_kib: int):
+        self.rss_kib = rss_kib
+        self.peak_rss_kib = max(self.peak_rss_kib, rss_kib)
+
+    def get_peak_rss_kib(self):
+        return self.peak_rss_kib
+
+    def reset_peak_rss(self):
+        if self.is_resettable:
+            self.peak_rss_kib = self.rss_kib
+        return self.is_resettable
+
+
+class _Clock:
+    def __init__(self):
+        self.time = 0.0
+
+    def advance(self, seconds: float):
+        self.time += seconds
+
+    def __call__(self):
+        return self.time
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    memory = _Memory(100 * GIB_IN_KIB)
+    monkeypatch.setattr(profiler_module, "_get_peak_rss_kib", memory.get_peak_rss_kib)
+    monkeypatch.setattr(profiler_module, "_reset_peak_rss", memory.reset_peak_rss)
+    return memory
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(profiler_module.time, "perf_counter", clock)
+    # CPU time advances at half the wall time.
+    monkeypatch.setattr(profiler_module, "_get_cpu_time", lambda: clock.time / 2)
+    return clock
+
+
+def _get_stages(profiler: Profiler):
+    return {(stage["iteration"], stage["stage"]): stage for stage in profiler.to_dict()["stages"]}
+
+
+def test_nested_stages(memory, clock):
+    profiler = Profiler()
+    with profiler.stage("outer"):
+        memory.set(300 * GIB_IN_KIB)
+        memory.set(150 * GIB_IN_KIB)
+        clock.advance(1.0)
+        with profiler.stage("inner"):
+            # The reset of the inner stage must not lose the earlier peak of the outer stage.
+            memory.set(200 * GIB_IN_KIB)
+            memory.set(120 * GIB_IN_KIB)
+            clock.advance(2.0)
+        memory.set(250 * GIB_IN_KIB)
+        clock.advance(4.0)
+    with profiler.stage("after"):
+        memory.set(130 * GIB_IN_KIB)
+
+    stages = _get_stages(profiler)
+    assert stages[(None, "outer")]["peak_rss_mib"] == 300 * 1024
+    assert stages[(None, "inner")]["peak_rss_mib"] == 200 * 1024
+    # The peak of a later stage is measured from its start.
+    assert stages[(None, "after")]["peak_rss_mib"] == 250 * 1024
+    assert stages[(None, "outer")]["wall_time_sec"] == 7.0
+    assert stages[(None, "outer")]["cpu_time_sec"] == 3.5
+    assert stages[(None, "inner")]["wall_time_sec"] == 2.0
+    assert all(stage["peak_rss_scope"] == "stage" for stage in stages.values())
+    assert profiler.to_dict()["peak_rss_mib"] == 300 * 1024
+
+
+def test_repeated_stages_accumulate(memory, clock):
+    profiler = Profiler()
+    for iteration, rss_kib in [(0, 140 * GIB_IN_KIB), (0, 120 * GIB_IN_KIB), (1, 110 * GIB_IN_KIB)]:
+        profiler.set_iteration(iteration)
+        with profiler.stage("asp"):
+            memory.set(rss_kib)
+            memory.set(100 * GIB_IN_KIB)
+            clock.advance(1.5)
+
+    stages = _get_stages(profiler)
+    assert stages[(0, "asp")]["calls"] == 2
+    assert stages[(0, "asp")]["wall_time_sec"] == 3.0
+    assert stages[(0, "asp")]["peak_rss_mib"] == 140 * 1024
+    assert stages[(1, "asp")]["calls"] == 1
+    assert stages[(1, "asp")]["peak_rss_mib"] == 110 * 1024
+
+
+def test_stages_without_resettable_peak_are_marked(monkeypatch, clock):
+    memory = _Memory(100 * GIB_IN_KIB, is_resettable=False)
+    monkeypatch.setattr(profiler_module, "_get_peak_rss_kib", memory.get_peak_rss_kib)
+    monkeypatch.setattr(profiler_module, "_reset_peak_rss", memory.reset_peak_rss)
+    profiler = Profiler()
+    with profiler.stage("stage"):
+        pass
+
+    stages = _get_stages(profiler)
+    assert stages[(None, "stage")]["peak_rss_scope"] == "process"
+
+
+def test_merge_worker_stages(memory, clock):
+    profiler = Profiler()
+    profiler.set_iteration(0)
+    with profiler.stage("feature_evaluation"):
+        memory.set(110 * GIB_IN_KIB)
+        clock.advance(1.0)
+    worker_stages = [
+        {"iteration": 0, "stage": "feature_evaluation", "calls": 1, "wall_time_sec": 2.0, "cpu_time_sec": 1.5, "peak_rss_mib": 120 * 1024, "peak_rss_scope": "stage"},
+        {"iteration": 0, "stage": "feature_evaluation", "calls": 2, "wall_time_sec": 3.0, "cpu_time_sec": 2.5, "peak_rss_mib": 90 * 1024, "peak_rss_scope": "stage"},
+        {"iteration": 0, "stage": "prune_zero", "calls": 1, "wall_time_sec": 0.5, "cpu_time_sec": 0.5, "peak_rss_mib": 400 * 1024, "peak_rss_scope": "process"},
+    ]
+    profiler.merge_stages(worker_stages)
+
+    stages = _get_stages(profiler)
+    # Times and calls add up over the parent and all workers, the peak is the largest peak of any process.
+    assert stages[(0, "feature_evaluation")]["calls"] == 4
+    assert stages[(0, "feature_evaluation")]["wall_time_sec"] == 6.0
+    assert stages[(0, "feature_evaluation")]["cpu_time_sec"] == 4.5
+    assert stages[(0, "feature_evaluation")]["peak_rss_mib"] == 120 * 1024
+    assert stages[(0, "feature_evaluation")]["peak_rss_scope"] == "stage"
+    assert stages[(0, "prune_zero")]["peak_rss_scope"] == "process"
+    # The peaks of workers count towards the peak of the run.
+    assert profiler.to_dict()["peak_rss_mib"] == 400 * 1024
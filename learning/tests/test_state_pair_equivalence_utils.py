@@ -0,0 +1,51 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from learner.src.iteration.feature_valuations import FeatureValuations
+from learner.src.iteration.iteration_data import IterationData
+from learner.src.iteration.state_pair_equivalence_utils import compute_effects, _compute_state_pair_equivalence
+
+
+def test_compute_effects():
+    source_valuations = np.array([0, 1, 2, 3], dtype=np.int32)
+    target_valuations = np.array([[1, 1, 0, 3], [0, 0, 5, 2]], dtype=np.int32)
+
+    assert compute_effects(source_valuations, target_valuations).tolist() == [[1, 0, -1, 0], [0, -1, 1, -1]]
+
+
+def test_packed_signatures_match_classes_of_conditions_and_effects():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        num_states = int(rng.integers(2, 12))
+        # More than 8 features such that conditions are packed into several bytes.
+        num_features = int(rng.integers(1, 20))
+        valuations = rng.integers(0, 3, size=(num_states, num_features)).astype(np.int32)
+        gfa_state_global_idx_to_tuple_graph = dict()
+        for gfa_state_global_idx in range(num_states):
+            targets = rng.permutation(num_states)[:int(rng.integers(0, num_states + 1))]
+            split = int(rng.integers(0, len(targets) + 1))
+            # Tuple graphs can have empty layers.
+            gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx] = SimpleNamespace(gfa_state_global_idxs_by_distance=[targets[:split], np.array([], dtype=np.int64), targets[split:]])
+        preprocessing_data = SimpleNamespace(gfa_state_global_idx_to_tuple_graph=gfa_state_global_idx_to_tuple_graph)
+        iteration_data = IterationData(feature_valuations=FeatureValuations(np.arange(num_states), np.arange(num_states), valuations))
+
+        conditions, effects, signature_to_r_idx = [], [], dict()
+        state_pair_equivalences = [_compute_state_pair_equivalence(preprocessing_data, iteration_data, gfa_state_global_idx, conditions, effects, signature_to_r_idx) for gfa_state_global_idx in range(num_states)]
+
+        # Classes are the distinct pairs of source conditions and effects.
+        key_to_r_idx = dict()
+        for gfa_state_global_idx, state_pair_equivalence in enumerate(state_pair_equivalences):
+            tuple_graph = gfa_state_global_idx_to_tuple_graph[gfa_state_global_idx]
+            r_idx_to_distance = dict()
+            for s_distance, gfa_state_prime_global_idxs in enumerate(tuple_graph.gfa_state_global_idxs_by_distance):
+                for gfa_state_prime_global_idx in gfa_state_prime_global_idxs.tolist():
+                    key = (tuple(valuations[gfa_state_global_idx] > 0), tuple(np.sign(valuations[gfa_state_prime_global_idx] - valuations[gfa_state_global_idx])))
+                    r_idx = state_pair_equivalence.subgoal_gfa_state_id_to_r_idx[gfa_state_prime_global_idx]
+                    assert key_to_r_idx.setdefault(key, r_idx) == r_idx
+                    assert (tuple(conditions[r_idx]), tuple(effects[r_idx])) == key
+                    r_idx_to_distance[r_idx] = min(r_idx_to_distance.get(r_idx, s_distance), s_distance)
+            assert state_pair_equivalence.r_idx_to_closest_subgoal_distance == r_idx_to_distance
+            assert {r_idx: len(gfa_state_ids) for r_idx, gfa_state_ids in state_pair_equivalence.r_idx_to_subgoal_gfa_state_ids.items()} \
+                == {r_idx: list(state_pair_equivalence.subgoal_gfa_state_id_to_r_idx.values()).count(r_idx) for r_idx in r_idx_to_distance}
+        assert len(conditions) == len(effects) == len(signature_to_r_idx) == len(key_to_r_idx)
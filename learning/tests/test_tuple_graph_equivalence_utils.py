@@ -0,0 +1,29 @@
+import numpy as np
+
+from learner.src.iteration.tuple_graph_equivalence_utils import compute_minimal_bitsets, make_bitset
+
+
+def _compute_minimal_sets_pairwise(sets):
+    """ The pairwise procedure that compute_minimal_bitsets replaced. """
+    return {r_idxs_1 for r_idxs_1 in sets if not any(r_idxs_2 < r_idxs_1 for r_idxs_2 in sets)}
+
+
+def test_make_bitset():
+    assert make_bitset([]) == 0
+    assert make_bitset([0, 3]) == 0b1001
+    assert make_bitset([70]) == 1 << 70
+
+
+def test_compute_minimal_bitsets_matches_pairwise_procedure():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        num_rules = int(rng.integers(1, 12))
+        sets = [frozenset(rng.choice(num_rules, size=int(rng.integers(0, num_rules + 1)), replace=False).tolist())
+                for _ in range(int(rng.integers(1, 30)))]
+        expected = {make_bitset(r_idxs) for r_idxs in _compute_minimal_sets_pairwise(set(sets))}
+        assert compute_minimal_bitsets(make_bitset(r_idxs) for r_idxs in sets) == expected
+
+
+def test_compute_minimal_bitsets_keeps_incomparable_and_drops_supersets():
+    assert compute_minimal_bitsets([0b011, 0b110, 0b111, 0b011]) == {0b011, 0b110}
+    assert compute_minimal_bitsets([0b101, 0]) == {0}